@@ -0,0 +1,168 @@
+from nanome.util import Color, Quaternion, Vector3, enums
+
+# Per scene state of a complex, like transform, visibility, colors and selection.
+# Complexes are stored in scene decks without this state, so the same structure
+# shown in many scenes is stored once, and each scene stores a delta.
+
+
+def _same(value):
+    return value
+
+
+# enums are IntEnums, but can also be plain ints on new objects
+def _enum(cls):
+    return (int, cls.safe_cast)
+
+
+PLAIN = (_same, _same)
+COLOR = (lambda color: color._color, lambda value: Color(whole_num=value))
+VECTOR3 = (lambda v: [v.x, v.y, v.z], lambda value: Vector3(*value))
+QUATERNION = (lambda q: [q.x, q.y, q.z, q.w], lambda value: Quaternion(*value))
+
+# canonical indices, all unset, compresses better than any other sequence
+INDICES = {'start': -1, 'step': 0}
+
+# level -> (attribute, canonical json value, (encode to json, decode from json))
+FIELDS = {
+    'complex': [
+        ('_index', INDICES, PLAIN),
+        ('_name', '', PLAIN),
+        ('_boxed', False, PLAIN),
+        ('_locked', False, PLAIN),
+        ('_visible', True, PLAIN),
+        ('_current_frame', 0, PLAIN),
+        ('_box_label', '', PLAIN),
+        ('_position', [0, 0, 0], VECTOR3),
+        ('_rotation', [0, 0, 0, 1], QUATERNION),
+    ],
+    'molecule': [
+        ('_index', INDICES, PLAIN),
+        ('_current_conformer', 0, PLAIN),
+    ],
+    'chain': [
+        ('_index', INDICES, PLAIN),
+    ],
+    'residue': [
+        ('_index', INDICES, PLAIN),
+        ('_ribboned', True, PLAIN),
+        ('_ribbon_size', 1.0, PLAIN),
+        ('_ribbon_mode', enums.RibbonMode.SecondaryStructure.value, _enum(enums.RibbonMode)),
+        ('_ribbon_color', 0, COLOR),
+        ('_labeled', False, PLAIN),
+        ('_label_text', '', PLAIN),
+    ],
+    'atom': [
+        ('_index', INDICES, PLAIN),
+        ('_selected', False, PLAIN),
+        ('_atom_mode', enums.AtomRenderingMode.BallStick.value, _enum(enums.AtomRenderingMode)),
+        ('_labeled', False, PLAIN),
+        ('_label_text', '', PLAIN),
+        ('_atom_color', 0, COLOR),
+        ('_atom_scale', 0.5, PLAIN),
+        ('_surface_rendering', False, PLAIN),
+        ('_surface_color', 0, COLOR),
+        ('_surface_opacity', 1.0, PLAIN),
+        ('_display_mode', 0xFFFFFFFF, PLAIN),
+    ],
+    'bond': [
+        ('_index', INDICES, PLAIN),
+    ],
+}
+
+# attributes holding colors, which shallow updates of existing structures don't always apply
+COLOR_ATTRIBUTES = {attr for fields in FIELDS.values() for attr, _, codec in fields if codec is COLOR}
+
+
+def _levels(complex):
+    yield 'complex', [complex]
+    yield 'molecule', list(complex.molecules)
+    yield 'chain', list(complex.chains)
+    yield 'residue', list(complex.residues)
+    yield 'atom', list(complex.atoms)
+    yield 'bond', list(complex.bonds)
+
+
+# returns json serializable per scene state of complex
+# columns equal to the canonical state are omitted, constant columns are stored as one value
+# index columns are stored as {start, step}, when evenly spaced as they usually are
+def extract_delta(complex):
+    delta = {}
+    for level, objects in _levels(complex):
+        if not objects:
+            continue
+        for attr, canonical, (encode, _) in FIELDS[level]:
+            values = [encode(getattr(obj, attr)) for obj in objects]
+            first = values[0]
+            if attr == '_index':
+                step = values[1] - first if len(values) > 1 else 0
+                if all(value == first + step * i for i, value in enumerate(values)):
+                    values = {'start': first, 'step': step}
+            else:
+                canonical = [canonical]
+                if all(value == first for value in values):
+                    values = [first]
+            if values != canonical:
+                delta[f'{level}.{attr}'] = values
+    return delta
+
+
+# set per scene state of complex from extract_delta, an empty delta sets the canonical state
+def apply_delta(complex, delta):
+    for level, objects in _levels(complex):
+        if not objects:
+            continue
+        for attr, canonical, (_, decode) in FIELDS[level]:
+            values = delta.get(f'{level}.{attr}', canonical if attr == '_index' else [canonical])
+            if isinstance(values, dict):
+                values = [values['start'] + values['step'] * i for i in range(len(objects))]
+            elif len(values) == 1:
+                values = values * len(objects)
+            if len(values) != len(objects):
+                raise ValueError(f'Delta {level}.{attr} does not match complex')
+            for obj, value in zip(objects, values):
+                setattr(obj, attr, decode(value))
+
+
+# returns {attribute: value} of the canonical state of structures at level, as set by an empty delta
+def canonical_state(level):
+    state = {}
+    for attr, canonical, (_, decode) in FIELDS[level]:
+        if attr == '_index':
+            state[attr] = decode(canonical['start'])
+        else:
+            state[attr] = decode(canonical)
+    return state
+
+
+# per scene state except indices of source that differs in target, a complex with the same content
+# returns [(target structure, [(attribute, value)])], levels limits the compared levels
+def diff_state(source, target, levels=None):
+    diff = []
+    for (level, sources), (_, targets) in zip(_levels(source), _levels(target)):
+        if levels is not None and level not in levels:
+            continue
+        if len(sources) != len(targets):
+            raise ValueError(f'Complexes have different {level} counts')
+        fields = [(attr, encode, decode) for attr, _, (encode, decode) in FIELDS[level] if attr != '_index']
+        for src, dst in zip(sources, targets):
+            values = []
+            for attr, encode, decode in fields:
+                value = encode(getattr(src, attr))
+                if value != encode(getattr(dst, attr)):
+                    values.append((attr, decode(value)))
+            if values:
+                diff.append((dst, values))
+    return diff
+
+
+# set state from diff_state, returns structures that changed, to send as shallow updates
+def apply_state(diff):
+    for obj, values in diff:
+        for attr, value in values:
+            setattr(obj, attr, value)
+    return [obj for obj, _ in diff]
+
+
+# copy per scene state except indices from source to target, a complex with the same content
+def copy_state(source, target, levels=None):
+    return apply_state(diff_state(source, target, levels))
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+
+class ContentCache:
+    """On-disk LRU cache of downloaded files, validated by server tag (ETag).
+
+    The cache directory is the index, so plugin processes sharing the same
+    directory stay consistent. Each entry is a data file plus a json sidecar,
+    and file mtime tracks last use for eviction.
+    """
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def __str__(self):
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0
+        return f'{self.hits} hits, {self.misses} misses ({rate:.0%} hit rate)'
+
+    def entry_paths(self, key):
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        data_path = os.path.join(self.cache_dir, name)
+        return data_path, data_path + '.json'
+
+    # returns cached tag for key, or None if not cached
+    def get_tag(self, key):
+        data_path, meta_path = self.entry_paths(key)
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get('key') != key or not os.path.exists(data_path):
+            return None
+        return meta.get('tag')
+
+    # copy cached file to out_path, returns False if entry was evicted
+    def fetch(self, key, out_path):
+        data_path, _ = self.entry_paths(key)
+        try:
+            shutil.copyfile(data_path, out_path)
+            os.utime(data_path)
+        except OSError:
+            return False
+        self.hits += 1
+        return True
+
+    # returns path of cached file for key, or None if not cached
+    # the file may be evicted by other processes, so open it right away
+    def get_path(self, key):
+        if self.get_tag(key) is None:
+            return None
+        data_path, _ = self.entry_paths(key)
+        try:
+            os.utime(data_path)
+        except OSError:
+            return None
+        self.hits += 1
+        return data_path
+
+    # add file at path to cache under key and tag, evicting old entries if needed
+    def store(self, key, tag, path):
+        size = os.path.getsize(path)
+        if size > self.max_size:
+            return
+
+        data_path, meta_path = self.entry_paths(key)
+        # drop old tag first so it never points at new data
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        os.close(fd)
+        try:
+            shutil.copyfile(path, temp_path)
+            os.replace(temp_path, data_path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+
+        with open(meta_path, 'w') as f:
+            json.dump({'key': key, 'tag': tag}, f)
+
+        self.evict()
+
+    # remove least recently used entries until cache fits in max_size
+    def evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.json') or entry.name.endswith('.tmp'):
+                continue
+            stats = entry.stat()
+            entries.append((stats.st_mtime, stats.st_size, entry.path))
+            total += stats.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            for p in [path, path + '.json']:
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+            total -= size
@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+import struct
+import tempfile
+from dataclasses import fields
+
+import numpy as np
+
+from .ContentCache import ContentCache
+from .OBJParser import MeshData, parse_obj
+
+CACHE_DIR = os.path.join(tempfile.gettempdir(), 'nanome-vault-mesh-cache')
+CACHE_SIZE = 1024 ** 3
+# bump when MeshData or the file layout changes
+FORMAT_VERSION = 2
+# array data offsets are aligned for memory mapping
+ALIGNMENT = 64
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def align(size):
+    return -(-size // ALIGNMENT) * ALIGNMENT
+
+
+# write mesh arrays to a flat file: header length, json header, aligned raw arrays
+def write_mesh(data: MeshData, path):
+    arrays = [np.ascontiguousarray(getattr(data, field.name)) for field in fields(MeshData)]
+
+    header = {}
+    offsets = []
+    offset = 0
+    for field, array in zip(fields(MeshData), arrays):
+        header[field.name] = [array.dtype.str, array.shape, offset]
+        offsets.append(offset)
+        offset = align(offset + array.nbytes)
+
+    header = json.dumps(header).encode('utf-8')
+    start = align(8 + len(header))
+
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for offset, array in zip(offsets, arrays):
+            f.seek(start + offset)
+            f.write(array.tobytes())
+
+
+# read mesh written by write_mesh, arrays are read-only memory maps of the file
+def read_mesh(path):
+    with open(path, 'rb') as f:
+        length, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(length))
+    start = align(8 + length)
+
+    arrays = {}
+    for name, (dtype, shape, offset) in header.items():
+        if 0 in shape:
+            arrays[name] = np.empty(shape, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(path, dtype, 'r', start + offset, tuple(shape))
+    return MeshData(**arrays)
+
+
+class MeshCache:
+    """On-disk cache of parsed OBJ meshes, keyed by OBJ file content.
+
+    Repeated loads of the same file skip parsing and memory map the cached
+    arrays. Storage, size limit and LRU eviction are handled by ContentCache.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_size=CACHE_SIZE):
+        self.cache = ContentCache(cache_dir, max_size)
+
+    # returns parsed mesh for OBJ file, from cache if possible
+    # parse(obj_path, weld) is called on cache miss
+    def parse(self, obj_path, weld=True, parse=parse_obj):
+        key = f'mesh-v{FORMAT_VERSION}:{hash_file(obj_path)}:weld={weld}'
+
+        path = self.cache.get_path(key)
+        if path is not None:
+            try:
+                return read_mesh(path)
+            except (OSError, ValueError):
+                pass
+
+        self.cache.misses += 1
+        data = parse(obj_path, weld)
+
+        fd, temp_path = tempfile.mkstemp(suffix='.mesh')
+        os.close(fd)
+        try:
+            write_mesh(data, temp_path)
+            self.cache.store(key, FORMAT_VERSION, temp_path)
+        finally:
+            os.remove(temp_path)
+        return data
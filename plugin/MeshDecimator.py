@@ -0,0 +1,136 @@
+from dataclasses import replace
+
+import numpy as np
+
+from .OBJParser import MeshData
+
+# max grid resolution attempts when searching for a triangle budget
+MAX_ITERATIONS = 8
+# finest grid resolution, cell keys of finer grids can overflow int64
+MAX_RESOLUTION = 2 ** 20
+
+
+# sum rows of values into bins, much faster than np.add.at
+def bin_sum(bins, values, count):
+    columns = [np.bincount(bins, values[:, i], count) for i in range(values.shape[1])]
+    return np.stack(columns, axis=1).astype(np.float32)
+
+
+# returns one int64 key per row of integer columns, equal for rows with equal columns
+def combine_keys(*columns):
+    ids = []
+    dims = []
+    for column in columns:
+        values, inverse = np.unique(column, return_inverse=True)
+        ids.append(inverse.reshape(-1))
+        dims.append(len(values))
+    if np.prod(dims, dtype=float) < 2 ** 63:
+        return np.ravel_multi_index(ids, dims)
+    _, inverse = np.unique(np.stack(ids, axis=1), axis=0, return_inverse=True)
+    return inverse.reshape(-1)
+
+
+# simplify mesh by merging all vertices in each cell of a grid with resolution
+# cells along the largest dimension, returns a new indexed MeshData
+def cluster_vertices(data: MeshData, resolution):
+    extent = data.max_bounds - data.min_bounds
+    size = max(extent.max(), 1e-6) / resolution
+    dims = np.floor(extent / size).astype(np.int64) + 1
+    cells = np.floor((data.vertices - data.min_bounds) / size).astype(np.int64)
+    cells = np.minimum(cells, dims - 1)
+    keys = np.ravel_multi_index(cells.T, dims)
+    if len(data.uvs):
+        # vertices on either side of a texture seam share positions but not UVs, so they
+        # are only merged when their UVs are in the same cell of a UV grid with resolution
+        uv_cells = np.floor(data.uvs * resolution).astype(np.int64)
+        keys = combine_keys(keys, uv_cells[:, 0], uv_cells[:, 1])
+    _, cluster = np.unique(keys, return_inverse=True)
+    cluster = cluster.reshape(-1)
+    n = cluster.max() + 1 if len(cluster) else 0
+
+    # average attributes of merged vertices
+    counts = np.bincount(cluster, minlength=n).astype(np.float32)[:, None]
+    vertices = bin_sum(cluster, data.vertices, n) / counts
+    uvs = bin_sum(cluster, data.uvs, n) / counts if len(data.uvs) else data.uvs
+    colors = bin_sum(cluster, data.colors, n) / counts if len(data.colors) else data.colors
+
+    normals = data.normals
+    if len(normals):
+        normals = bin_sum(cluster, normals, n)
+        lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+        normals /= np.where(lengths > 0, lengths, 1)
+
+    # drop triangles collapsed into a line or point, and duplicates
+    triangles = cluster[data.triangles].reshape(-1, 3)
+    a, b, c = triangles.T
+    keep = (a != b) & (b != c) & (a != c)
+    triangles = triangles[keep]
+    material_ids = data.material_ids[keep]
+    ordered = np.sort(triangles, axis=1).astype(np.int64)
+    if n ** 3 < 2 ** 63:
+        keys = np.ravel_multi_index(ordered.T, (n, n, n))
+        _, first = np.unique(keys, return_index=True)
+    else:
+        _, first = np.unique(ordered, axis=0, return_index=True)
+    first = np.sort(first)
+    triangles = triangles[first].ravel().astype(np.int32)
+    material_ids = material_ids[first]
+
+    return replace(
+        data, vertices=vertices, normals=normals, uvs=uvs, colors=colors,
+        triangles=triangles, material_ids=material_ids)
+
+
+# simplify mesh to at most max_triangles, returns data unchanged if already within budget
+# budgets too small for any triangles return the coarsest result that has some,
+# or data unchanged if every triangle is degenerate
+def decimate(data: MeshData, max_triangles):
+    count = len(data.triangles) // 3
+    if count <= max_triangles:
+        return data
+
+    # coarsest (resolution, result) with triangles, finest resolution without
+    nonempty = None
+    empty = 0
+
+    def cluster(resolution):
+        nonlocal nonempty, empty
+        result = cluster_vertices(data, resolution)
+        if not len(result.triangles):
+            empty = max(empty, resolution)
+        elif nonempty is None or resolution < nonempty[0]:
+            nonempty = (resolution, result)
+        return result
+
+    # triangle count of a surface grows with the square of the grid resolution
+    resolution = np.sqrt(max_triangles)
+    best = None
+    for _ in range(MAX_ITERATIONS):
+        result = cluster(resolution)
+        count = len(result.triangles) // 3
+        if count <= max_triangles:
+            if best is None or count > len(best.triangles) // 3:
+                best = result
+            if count >= 0.9 * max_triangles:
+                break
+        resolution *= 0.98 * np.sqrt(max_triangles / max(count, 1))
+
+    # coarsen until within budget
+    while best is None:
+        resolution /= 2
+        result = cluster(resolution)
+        if len(result.triangles) // 3 <= max_triangles:
+            best = result
+
+    if len(best.triangles):
+        return best
+
+    # budget leaves no triangles, refine until some are kept, then search between
+    while nonempty is None and empty < MAX_RESOLUTION:
+        cluster(min(empty * 2, MAX_RESOLUTION))
+    if nonempty is None:
+        # every triangle is degenerate, none are kept at any resolution
+        return data
+    for _ in range(MAX_ITERATIONS):
+        cluster((empty + nonempty[0]) / 2)
+    return nonempty[1]
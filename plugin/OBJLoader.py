@@ -1,38 +1,49 @@
+import asyncio
+import itertools
 import os
 import shutil
 import tempfile
-from dataclasses import dataclass
+import time
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
 from functools import partial
-from math import inf
+from typing import List
 
 import nanome
+import numpy as np
 from nanome import ui
 from nanome.api.shapes import Mesh
 from nanome.api.structure import Atom, Chain, Complex, Molecule, Residue
-from nanome.util import async_callback, Color, Vector3
+from nanome.util import async_callback, Color, Logs, Vector3
 from nanome.util.enums import ShapeAnchorType
 
+from .MeshCache import MeshCache
+from .MeshDecimator import decimate
+from .OBJParser import MeshData, parse_obj, split_materials
+
 BASE_DIR = os.path.dirname(os.path.realpath(__file__))
 MENU_PATH = os.path.join(BASE_DIR, 'menus', 'json', 'obj_menu.json')
 
-
-def flatten(iterable):
-    for item in iterable:
-        try:
-            yield from flatten(item)
-        except TypeError:
-            yield item
+# meshes with more triangles are simplified on load
+MAX_TRIANGLES = 300_000
+# quality step for +/- buttons, in percent of full resolution triangles
+QUALITY_STEP = 10
 
 
 @dataclass
 class OBJ:
     complex: Complex
-    mesh: Mesh
-    vertices: "list[Vector3]"
-    texture: tempfile.NamedTemporaryFile
-    min_bounds: Vector3
-    max_bounds: Vector3
+    meshes: List[Mesh]  # one per material
+    sources: List[MeshData]  # full resolution mesh per material, centered and fit to 10 units
+    materials: List[str]  # material name per mesh
+    mtllibs: List[str]
+    min_bounds: np.ndarray
+    max_bounds: np.ndarray
+    parts: List[MeshData] = field(default_factory=list)  # mesh per material at current quality
+    textures: List[tempfile.NamedTemporaryFile] = field(default_factory=list)
     scale: float = 1.0
+    quality: int = 100
+    decimate_time: float = 0.0
 
 
 class OBJLoader:
@@ -40,6 +51,7 @@ class OBJLoader:
         self.plugin = plugin
         self.objs: list[OBJ] = []
         self.selected_obj: OBJ = None
+        self.mesh_cache = MeshCache()
         self.create_menu()
 
     def create_menu(self):
@@ -53,6 +65,8 @@ class OBJLoader:
         self.lst_objs: ui.UIList = self.ln_list.get_content()
         self.lbl_obj: ui.Label = self.ln_obj.find_node('Name').get_content()
         self.inp_scale: ui.TextInput = self.ln_obj.find_node('Scale Input').get_content()
+        self.inp_quality: ui.TextInput = self.ln_obj.find_node('Quality Input').get_content()
+        self.lbl_triangles: ui.Label = self.ln_obj.find_node('Triangles').get_content()
 
         btn_scale_down: ui.Button = self.ln_obj.find_node('Scale Down').get_content()
         btn_scale_down.register_pressed_callback(partial(self.increment_scale, -1))
@@ -60,6 +74,12 @@ class OBJLoader:
         btn_scale_up: ui.Button = self.ln_obj.find_node('Scale Up').get_content()
         btn_scale_up.register_pressed_callback(partial(self.increment_scale, 1))
 
+        btn_quality_down: ui.Button = self.ln_obj.find_node('Quality Down').get_content()
+        btn_quality_down.register_pressed_callback(partial(self.increment_quality, -QUALITY_STEP))
+
+        btn_quality_up: ui.Button = self.ln_obj.find_node('Quality Up').get_content()
+        btn_quality_up.register_pressed_callback(partial(self.increment_quality, QUALITY_STEP))
+
         btn_back: ui.Button = self.ln_obj.find_node('Back').get_content()
         btn_back.register_pressed_callback(self.show_list)
 
@@ -93,183 +113,212 @@ class OBJLoader:
         self.ln_obj.enabled = True
         self.lbl_obj.text_value = btn.obj.complex.name
         self.inp_scale.input_text = btn.obj.scale
+        self.inp_quality.input_text = btn.obj.quality
+        self.lbl_triangles.text_value = self.get_triangles_text(btn.obj)
         self.plugin.update_menu(self.menu)
 
+    def get_triangles_text(self, obj: OBJ):
+        total = sum(len(data.triangles) for data in obj.sources) // 3
+        count = sum(len(data.triangles) for data in obj.parts) // 3
+        if count == total:
+            return f'{total:,} triangles'
+        return f'{count:,} of {total:,} triangles ({obj.decimate_time * 1000:.0f} ms)'
+
     def increment_scale(self, delta, btn):
         scale = float(self.inp_scale.input_text)
         self.inp_scale.input_text = f'{scale + delta:.1f}'
         self.plugin.update_content(self.inp_scale)
 
+    def increment_quality(self, delta, btn):
+        quality = int(float(self.inp_quality.input_text))
+        self.inp_quality.input_text = min(max(quality + delta, 1), 100)
+        self.plugin.update_content(self.inp_quality)
+
     @async_callback
     async def delete_obj(self, btn):
         obj = self.selected_obj
         self.objs.remove(obj)
-        await obj.mesh.destroy()
+        await asyncio.gather(*[mesh.destroy() for mesh in obj.meshes])
         await self.plugin.remove_from_workspace([obj.complex])
-        if obj.texture:
-            obj.texture.close()
+        for texture in obj.textures:
+            texture.close()
         self.show_list()
 
     @async_callback
     async def apply_scale(self, btn):
         obj: OBJ = self.selected_obj
         scale = float(self.inp_scale.input_text)
-        self.scale_obj(obj, scale)
+        quality = min(max(int(float(self.inp_quality.input_text)), 1), 100)
+        if scale == obj.scale and quality == obj.quality:
+            self.plugin.update_content(btn)
+            return
+
+        if quality != obj.quality:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(self.plugin.executor, self.set_quality, obj, quality)
+            self.inp_quality.input_text = quality
+            self.lbl_triangles.text_value = self.get_triangles_text(obj)
+            self.plugin.update_content(self.inp_quality, self.lbl_triangles)
 
-        complexes = await self.plugin.request_complexes([obj.complex.index])
-        obj.complex.position = complexes[0].position
-        obj.complex.rotation = complexes[0].rotation
-
-        await obj.mesh.upload()
-        await self.plugin.update_structures_deep([obj.complex])
+        self.scale_obj(obj, scale)
+        await asyncio.gather(*[mesh.upload() for mesh in obj.meshes])
+        self.update_bounds(obj)
         self.plugin.update_content(btn)
 
-    async def load(self, name, obj_path, tex_path=None):
-        mesh = Mesh()
-        mesh.color = Color.White()
+    async def load(self, name, obj_path, tex_path=None, weld=True, max_triangles=MAX_TRIANGLES):
+        obj = self.parse(name, obj_path, weld, max_triangles)
+        self.apply_materials(obj, default_texture=tex_path)
+        await self.add(obj)
 
-        with open(obj_path, 'r') as f:
-            lines = f.readlines()
+    # parse OBJ file into meshes, or load it from cache, safe to run in a worker thread
+    # weld=False emits one vertex per triangle corner
+    # meshes over max_triangles are simplified, set None to keep full resolution
+    def parse(self, name, obj_path, weld=True, max_triangles=MAX_TRIANGLES):
+        data = self.mesh_cache.parse(obj_path, weld, self.parse_data)
 
-        num_vertices = len(list(filter(lambda l: l.startswith('v '), lines)))
+        # scale to fit
+        center = (data.min_bounds + data.max_bounds) / 2
+        dimensions = data.max_bounds - data.min_bounds
+        scale = 10 / dimensions.max()
+
+        data.vertices = (data.vertices - center) * scale
+        data.min_bounds = (data.min_bounds - center) * scale
+        data.max_bounds = (data.max_bounds - center) * scale
+
+        sources = split_materials(data)
+        materials = [str(name) for name in data.materials] or ['']
+        meshes = []
+        for _ in sources:
+            mesh = Mesh()
+            mesh.color = Color.White()
+            meshes.append(mesh)
+
+        # create complex to anchor, with atoms at bounding box corners to make grabbable
+        complex = Complex()
+        complex.name = name
+        molecule = Molecule()
+        chain = Chain()
+        residue = Residue()
+        complex.add_molecule(molecule)
+        molecule.add_chain(chain)
+        chain.add_residue(residue)
+        for _ in range(8):
+            atom = Atom()
+            atom.set_visible(False)
+            residue.add_atom(atom)
 
-        def vertex_index(i):
-            if isinstance(i, str):
-                if i == '':
-                    return -1
-                i = int(i)
-            return i - 1 if i > 0 else num_vertices + i
+        mtllibs = [str(path) for path in data.mtllibs]
+        obj = OBJ(complex, meshes, sources, materials, mtllibs, data.min_bounds, data.max_bounds)
 
-        colors = []
-        normals = []
-        triangles = []
-        uvs = []
-        vertices = []
+        total = len(data.triangles) // 3
+        quality = 100
+        if max_triangles is not None and total > max_triangles:
+            quality = max(max_triangles * 100 // total, 1)
+        self.set_quality(obj, quality)
 
-        for line in lines:
-            items = line.split()
-            if not items:
+        self.scale_obj(obj, 10.0)
+        return obj
+
+    # parse OBJ file in the plugin's process pool, so parses run on all cores
+    # falls back to parsing in the calling thread if processes can't be used
+    def parse_data(self, obj_path, weld):
+        pool = self.plugin.get_process_pool()
+        if pool is not None:
+            try:
+                return pool.submit(parse_obj, obj_path, weld).result()
+            except (BrokenProcessPool, OSError, RuntimeError) as e:
+                Logs.warning(f'Parsing OBJ in thread, process pool failed: {e}')
+                self.plugin.disable_process_pool()
+        return parse_obj(obj_path, weld)
+
+    # set mesh colors and textures from parsed MTL materials
+    # textures maps texture paths used in materials to downloaded files
+    # default_texture is used for meshes without a material texture
+    def apply_materials(self, obj: OBJ, materials=None, textures=None, default_texture=None):
+        materials = materials or {}
+        textures = textures or {}
+        temp_files = {}
+        for mesh, part, name in zip(obj.meshes, obj.sources, obj.materials):
+            material = materials.get(name)
+            tex_path = default_texture
+            if material is not None:
+                r, g, b = (min(max(int(c * 255), 0), 255) for c in material.color)
+                a = min(max(int(material.opacity * 255), 0), 255)
+                mesh.color = Color(r, g, b, a)
+                tex_path = textures.get(material.texture, tex_path)
+
+            if tex_path is None or not len(part.uvs):
                 continue
 
-            type, *args = items
-            if type == 'v':
-                x, y, z, *c = map(float, args)
-                v = Vector3(x, y, z)
-                vertices.append(v)
-
-                if len(c) == 3:
-                    colors.append((*c, 1))
-
-            elif type == 'vn':
-                x, y, z = map(float, args)
-                normals.append((x, y, z))
-
-            elif type == 'vt':
-                u, v = map(float, args)
-                uvs.append((u, v))
-
-            elif type == 'f':
-                # args like "1/2/3 4/5/6 7/8/9"
-                verts = [tuple(map(vertex_index, v.split('/'))) for v in args]
-                a = verts[0]
-                for b, c in zip(verts[1:], verts[2:]):
-                    triangles.append((a, b, c))
-
-        # get bounds
-        min_bounds = Vector3(inf, inf, inf)
-        max_bounds = Vector3(-inf, -inf, -inf)
-        for vertex in vertices:
-            min_bounds.set(*map(min, zip(vertex, min_bounds)))
-            max_bounds.set(*map(max, zip(vertex, max_bounds)))
-
-        # scale to fit
-        center = (min_bounds + max_bounds) / 2
-        dimensions = max_bounds - min_bounds
-        scale = 10 / max(dimensions)
-
-        for i, v in enumerate(vertices):
-            vertices[i] = (v - center) * scale
-
-        # generate mesh lists
-        for a, b, c in triangles:
-            va, vb, vc = a[0], b[0], c[0]
-            mesh.vertices.extend(vertices[v] for v in (va, vb, vc))
-            if colors:
-                mesh.colors.extend(colors[v] for v in (va, vb, vc))
-            if len(a) >= 2 and a[1] != -1:
-                mesh.uv.extend(uvs[i] for i in (a[1], b[1], c[1]))
-            if len(a) >= 3 and a[2] != -1:
-                mesh.normals.extend(normals[i] for i in (a[2], b[2], c[2]))
-
-        texture = None
-        if not mesh.uv:
-            mesh.uv = [0, 0] * len(triangles)
-        elif tex_path is not None:
-            mesh.uv = list(flatten(mesh.uv))
-            ext = '.' + tex_path.split('.')[-1]
-            texture = tempfile.NamedTemporaryFile(suffix=ext)
-            mesh.texture_path = texture.name
-            shutil.copy(tex_path, texture.name)
-
-        if not mesh.colors:
-            mesh.colors = [1, 1, 1, 1] * len(mesh.vertices)
-
-        obj_vertices = mesh.vertices
-        mesh.triangles = list(range(len(obj_vertices)))
-        mesh.normals = list(flatten(mesh.normals))
-        mesh.vertices = list(flatten(mesh.vertices))
-
-        # create empty complex to anchor
-        complex = Complex()
-        complex.name = name
-
-        obj = OBJ(complex, mesh, obj_vertices, texture, min_bounds, max_bounds)
+            # copy each texture once, file must exist as long as the meshes
+            if tex_path not in temp_files:
+                ext = '.' + tex_path.split('.')[-1]
+                texture = tempfile.NamedTemporaryFile(suffix=ext)
+                shutil.copy(tex_path, texture.name)
+                temp_files[tex_path] = texture
+                obj.textures.append(texture)
+            mesh.texture_path = temp_files[tex_path].name
+
+    # simplify meshes to quality percent of full resolution triangles
+    def set_quality(self, obj: OBJ, quality: int):
+        obj.quality = quality
+        obj.parts = []
+
+        start = time.perf_counter()
+        for data in obj.sources:
+            if quality < 100:
+                total = len(data.triangles) // 3
+                data = decimate(data, max(total * quality // 100, 1))
+            obj.parts.append(data)
+        obj.decimate_time = time.perf_counter() - start
+
+        if quality < 100:
+            total = sum(len(data.triangles) for data in obj.sources) // 3
+            count = sum(len(data.triangles) for data in obj.parts) // 3
+            Logs.message(f'OBJ "{obj.complex.name}" simplified to {count} of {total} triangles in {obj.decimate_time:.2f}s')
+
+        for mesh, data in zip(obj.meshes, obj.parts):
+            mesh.triangles = data.triangles.tolist()
+            mesh.normals = data.normals.ravel().tolist()
+
+            if len(data.colors):
+                mesh.colors = data.colors.ravel().tolist()
+            else:
+                mesh.colors = [1, 1, 1, 1] * len(data.vertices)
+
+            if len(data.uvs):
+                mesh.uv = data.uvs.ravel().tolist()
+            else:
+                mesh.uv = [0, 0] * len(data.vertices)
+
+    # add parsed OBJ to workspace and upload mesh
+    async def add(self, obj: OBJ):
         self.objs.append(obj)
-        self.scale_obj(obj, 10.0)
 
-        res = await self.plugin.add_to_workspace([complex])
-        obj.complex.index = res[0].index
+        # keep workspace copy, its atoms have indices for shallow updates
+        res = await self.plugin.add_to_workspace([obj.complex])
+        obj.complex = res[0]
 
-        # anchor mesh to complex
-        anchor = mesh.anchors[0]
-        anchor.anchor_type = ShapeAnchorType.Complex
-        anchor.target = obj.complex.index
+        # anchor meshes to complex
+        for mesh in obj.meshes:
+            anchor = mesh.anchors[0]
+            anchor.anchor_type = ShapeAnchorType.Complex
+            anchor.target = obj.complex.index
 
-        await mesh.upload()
+        await asyncio.gather(*[mesh.upload() for mesh in obj.meshes])
         self.show_list()
 
+    # scale mesh vertices and bounding box atoms from unscaled data
     def scale_obj(self, obj: OBJ, scale: float):
-        complex = obj.complex
-        mesh = obj.mesh
         obj.scale = scale
+        for mesh, data in zip(obj.meshes, obj.parts):
+            mesh.vertices = (data.vertices * scale).ravel().tolist()
 
-        vertices = [v * scale for v in obj.vertices]
-        mesh.vertices = list(flatten(vertices))
-
-        min_bounds = Vector3(inf, inf, inf)
-        max_bounds = Vector3(-inf, -inf, -inf)
-        for vertex in vertices:
-            min_bounds.set(*map(min, zip(vertex, min_bounds)))
-            max_bounds.set(*map(max, zip(vertex, max_bounds)))
-
-        for molecule in complex.molecules:
-            complex.remove_molecule(molecule)
-
-        molecule = Molecule()
-        chain = Chain()
-        residue = Residue()
-
-        complex.add_molecule(molecule)
-        molecule.add_chain(chain)
-        chain.add_residue(residue)
+        bounds = [obj.min_bounds * scale, obj.max_bounds * scale]
+        corners = itertools.product(range(2), repeat=3)
+        for atom, (x, y, z) in zip(obj.complex.atoms, corners):
+            atom.position = Vector3(*map(float, [bounds[x][0], bounds[y][1], bounds[z][2]]))
 
-        # add atoms to bounding box to make grabbable
-        for x in range(2):
-            for y in range(2):
-                for z in range(2):
-                    atom = Atom()
-                    atom.set_visible(False)
-                    atom.position.x = [min_bounds, max_bounds][x].x
-                    atom.position.y = [min_bounds, max_bounds][y].y
-                    atom.position.z = [min_bounds, max_bounds][z].z
-                    residue.add_atom(atom)
+    # send bounding box atom positions to workspace
+    def update_bounds(self, obj: OBJ):
+        self.plugin.update_structures_shallow(list(obj.complex.atoms))
@@ -0,0 +1,320 @@
+from dataclasses import dataclass, replace
+
+import numpy as np
+
+# bytes of text parsed at once, bounds peak memory of intermediate arrays
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+@dataclass
+class MeshData:
+    vertices: np.ndarray  # (n, 3) float32
+    normals: np.ndarray  # (n, 3) float32, empty if missing
+    uvs: np.ndarray  # (n, 2) float32, empty if missing
+    colors: np.ndarray  # (n, 4) float32, empty if missing
+    triangles: np.ndarray  # (t * 3,) int32, indices into vertices
+    min_bounds: np.ndarray  # (3,) float32
+    max_bounds: np.ndarray  # (3,) float32
+    material_ids: np.ndarray  # (t,) int32, index into materials for each triangle
+    materials: np.ndarray  # (m,) str, material names, empty name for faces without usemtl
+    mtllibs: np.ndarray  # (k,) str, material library paths relative to the OBJ
+
+
+@dataclass
+class Material:
+    color: tuple = (1.0, 1.0, 1.0)
+    opacity: float = 1.0
+    texture: str = None  # path relative to the MTL file
+
+
+# parse whitespace separated float records into (n, width) array
+# short records are padded with nan, extra values are dropped
+def parse_floats(records, width):
+    values = np.fromstring(' '.join(records), dtype=np.float32, sep=' ')
+    n = len(records)
+    if n == 0:
+        return np.empty((0, width), dtype=np.float32)
+
+    counts = np.fromiter((len(r.split()) for r in records), dtype=np.int64, count=n)
+    if (counts == counts[0]).all():
+        values = values.reshape(n, counts[0])
+        if counts[0] >= width:
+            return values[:, :width]
+        out = np.full((n, width), np.nan, dtype=np.float32)
+        out[:, :counts[0]] = values
+        return out
+
+    # scatter mixed length records into padded rows
+    starts = np.cumsum(counts) - counts
+    rows = np.repeat(np.arange(n), counts)
+    cols = np.arange(len(values)) - np.repeat(starts, counts)
+    keep = cols < width
+    out = np.full((n, width), np.nan, dtype=np.float32)
+    out[rows[keep], cols[keep]] = values[keep]
+    return out
+
+
+# parse face corners like "1/2/3", "1//3", "1/2" or "1" into (n, 3) int array
+# missing indices are 0, which is never a valid OBJ index
+def parse_corners(corners):
+    n = len(corners)
+    if n == 0:
+        return np.zeros((0, 3), dtype=np.int64)
+
+    text = ' '.join(corners)
+    first = corners[0]
+    slashes = first.count('/')
+    skips_uv = '//' in first
+
+    # fast path, all corners share the format of the first
+    consistent = (
+        text.count('/') == slashes * n and
+        text.count('//') == (n if skips_uv else 0))
+
+    if consistent:
+        text = text.replace('//', ' 0 ').replace('/', ' ')
+        values = np.fromstring(text, dtype=np.int64, sep=' ').reshape(n, slashes + 1)
+        out = np.zeros((n, 3), dtype=np.int64)
+        out[:, :slashes + 1] = values
+        return out
+
+    out = np.zeros((n, 3), dtype=np.int64)
+    for i, corner in enumerate(corners):
+        for j, index in enumerate(corner.split('/')[:3]):
+            if index:
+                out[i, j] = int(index)
+    return out
+
+
+# convert OBJ indices to 0-based, -1 for missing
+# negative indices are relative to the number of elements defined before the face
+def resolve_indices(indices, counts_before):
+    return np.where(
+        indices > 0, indices - 1,
+        np.where(indices < 0, counts_before + indices, -1))
+
+
+# fan triangulate faces, returns (t, 3) array of corner indices
+def triangulate(corner_counts):
+    face_starts = np.cumsum(corner_counts) - corner_counts
+    tri_counts = np.maximum(corner_counts - 2, 0)
+    face = np.repeat(np.arange(len(corner_counts)), tri_counts)
+    tri_starts = np.cumsum(tri_counts) - tri_counts
+    j = np.arange(tri_counts.sum()) - np.repeat(tri_starts, tri_counts) + 1
+
+    a = face_starts[face]
+    b = a + j
+    return np.stack([a, b, b + 1], axis=1)
+
+
+# growable typed array, appends are amortized O(1)
+class Buffer:
+    def __init__(self, dtype, width, capacity=1024):
+        self.array = np.empty((capacity, width), dtype=dtype)
+        self.size = 0
+
+    def extend(self, values):
+        end = self.size + len(values)
+        if end > len(self.array):
+            capacity = max(end, 2 * len(self.array))
+            array = np.empty((capacity, self.array.shape[1]), dtype=self.array.dtype)
+            array[:self.size] = self.array[:self.size]
+            self.array = array
+        self.array[self.size:end] = values
+        self.size = end
+
+    @property
+    def data(self):
+        return self.array[:self.size]
+
+
+# parse OBJ file into mesh arrays, reading BLOCK_SIZE bytes of lines at a time
+# weld shares vertices between faces, set False to keep hard edges on meshes without normals
+def parse_obj(obj_path, weld=True):
+    positions = Buffer(np.float32, 3)
+    vertex_colors = Buffer(np.float32, 3)
+    vt = Buffer(np.float32, 2)
+    vn = Buffer(np.float32, 3)
+    # (v, vt, vn) indices of each triangle corner
+    corners = Buffer(np.int32, 3)
+    material_ids = Buffer(np.int32, 1)
+    materials = {'': 0}
+    material = 0
+    mtllibs = []
+
+    min_bounds = np.full(3, np.inf, dtype=np.float32)
+    max_bounds = np.full(3, -np.inf, dtype=np.float32)
+    has_colors = True
+    has_uvs = True
+    has_normals = True
+
+    with open(obj_path, 'r') as f:
+        while True:
+            block = f.readlines(BLOCK_SIZE)
+            if not block:
+                break
+            lines = np.array(''.join(block).replace('\t', ' ').splitlines(), dtype=object)
+            del block
+
+            prefixes = np.array([line[:2] for line in lines], dtype='<U2')
+            is_v = prefixes == 'v '
+            is_vt = prefixes == 'vt'
+            is_vn = prefixes == 'vn'
+            is_f = prefixes == 'f '
+            is_usemtl = prefixes == 'us'
+
+            for line in lines[prefixes == 'mt']:
+                mtllibs.extend(line.split()[1:])
+
+            # material of each face, from last usemtl before it
+            block_materials = [material]
+            for line in lines[is_usemtl]:
+                name = line[6:].strip()
+                block_materials.append(materials.setdefault(name, len(materials)))
+            face_materials = np.array(block_materials)[np.cumsum(is_usemtl)[is_f]]
+            material = block_materials[-1]
+
+            # number of each element defined before each face, for negative indices
+            v_before = positions.size + np.cumsum(is_v)[is_f]
+            vt_before = vt.size + np.cumsum(is_vt)[is_f]
+            vn_before = vn.size + np.cumsum(is_vn)[is_f]
+
+            v = parse_floats([line[2:] for line in lines[is_v]], 6)
+            if len(v):
+                positions.extend(v[:, :3])
+                min_bounds = np.minimum(min_bounds, v[:, :3].min(axis=0))
+                max_bounds = np.maximum(max_bounds, v[:, :3].max(axis=0))
+                has_colors = has_colors and not np.isnan(v[:, 3:6]).any()
+                if has_colors:
+                    vertex_colors.extend(v[:, 3:6])
+            del v
+
+            vt.extend(parse_floats([line[3:] for line in lines[is_vt]], 2))
+            vn.extend(parse_floats([line[3:] for line in lines[is_vn]], 3))
+
+            faces = [line[2:].split() for line in lines[is_f]]
+            del lines
+            if not faces:
+                continue
+            corner_counts = np.fromiter(map(len, faces), dtype=np.int64, count=len(faces))
+            indices = parse_corners([c for face in faces for c in face])
+            del faces
+
+            vi = resolve_indices(indices[:, 0], np.repeat(v_before, corner_counts))
+            ti = resolve_indices(indices[:, 1], np.repeat(vt_before, corner_counts))
+            ni = resolve_indices(indices[:, 2], np.repeat(vn_before, corner_counts))
+            has_uvs = has_uvs and (ti >= 0).all()
+            has_normals = has_normals and (ni >= 0).all()
+
+            c = triangulate(corner_counts).ravel()
+            corners.extend(np.stack([vi[c], ti[c], ni[c]], axis=1))
+            tri_counts = np.maximum(corner_counts - 2, 0)
+            material_ids.extend(np.repeat(face_materials, tri_counts)[:, None])
+
+    has_colors = has_colors and positions.size > 0
+    has_uvs = has_uvs and vt.size > 0 and corners.size > 0
+    has_normals = has_normals and vn.size > 0 and corners.size > 0
+
+    vi, ti, ni = corners.data.T
+
+    # drop unused materials, like the default for files that always set one
+    used, material_ids = np.unique(material_ids.data.ravel(), return_inverse=True)
+    material_ids = material_ids.reshape(-1).astype(np.int32)
+    materials = np.array(list(materials), dtype=str)[used]
+    mtllibs = np.array(mtllibs, dtype=str)
+    positions = positions.data
+    vertex_colors = vertex_colors.data
+    vt = vt.data
+    vn = vn.data
+
+    if weld:
+        # share output vertices between corners with the same indices
+        columns = [vi]
+        sizes = [len(positions)]
+        if has_uvs:
+            columns.append(ti)
+            sizes.append(len(vt))
+        if has_normals:
+            columns.append(ni)
+            sizes.append(len(vn))
+
+        if np.prod(sizes, dtype=object) < 2 ** 63:
+            # pack into one int64 key, much faster than unique rows
+            keys = np.ravel_multi_index(columns, sizes)
+            _, first, triangles = np.unique(keys, return_index=True, return_inverse=True)
+        else:
+            keys = np.stack(columns, axis=1)
+            _, first, triangles = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        vi, ti, ni = vi[first], ti[first], ni[first]
+        triangles = triangles.reshape(-1).astype(np.int32)
+    else:
+        # one output vertex per triangle corner
+        triangles = np.arange(len(vi), dtype=np.int32)
+
+    vertices = positions[vi]
+
+    colors = np.empty((0, 4), dtype=np.float32)
+    if has_colors:
+        colors = np.ones((len(vi), 4), dtype=np.float32)
+        colors[:, :3] = vertex_colors[vi]
+
+    uvs = np.empty((0, 2), dtype=np.float32)
+    if has_uvs:
+        uvs = vt[ti]
+
+    normals = np.empty((0, 3), dtype=np.float32)
+    if has_normals:
+        normals = vn[ni]
+
+    return MeshData(
+        vertices, normals, uvs, colors, triangles, min_bounds, max_bounds,
+        material_ids, materials, mtllibs)
+
+
+# split mesh into one mesh per material, each with only the vertices it uses
+def split_materials(data: MeshData):
+    if len(data.materials) <= 1:
+        return [data]
+
+    parts = []
+    triangles = data.triangles.reshape(-1, 3)
+    for i in range(len(data.materials)):
+        mask = data.material_ids == i
+        used, local = np.unique(triangles[mask], return_inverse=True)
+        parts.append(replace(
+            data,
+            vertices=data.vertices[used],
+            normals=data.normals[used] if len(data.normals) else data.normals,
+            uvs=data.uvs[used] if len(data.uvs) else data.uvs,
+            colors=data.colors[used] if len(data.colors) else data.colors,
+            triangles=local.reshape(-1).astype(np.int32),
+            material_ids=np.zeros(mask.sum(), dtype=np.int32),
+            materials=data.materials[i:i + 1]))
+    return parts
+
+
+# parse MTL file into dict of material name to Material
+def parse_mtl(mtl_path):
+    materials = {}
+    material = None
+    with open(mtl_path, 'r', errors='replace') as f:
+        for line in f:
+            values = line.split()
+            if not values:
+                continue
+            keyword = values[0]
+            if keyword == 'newmtl':
+                material = Material()
+                materials[line.strip()[6:].strip()] = material
+            elif material is None:
+                continue
+            elif keyword == 'Kd' and len(values) >= 4:
+                material.color = tuple(float(v) for v in values[1:4])
+            elif keyword == 'd' and len(values) >= 2:
+                material.opacity = float(values[1])
+            elif keyword == 'Tr' and len(values) >= 2:
+                material.opacity = 1 - float(values[1])
+            elif keyword == 'map_Kd' and len(values) >= 2:
+                # texture path is last, after any options
+                material.texture = values[-1].replace('\\', '/')
+    return materials
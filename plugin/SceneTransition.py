@@ -0,0 +1,428 @@
+import asyncio
+import copy
+import itertools
+import time
+import weakref
+from collections import defaultdict, deque
+
+import nanome
+import numpy as np
+from nanome.api.interactions import Interaction
+from nanome.api.structure import Workspace
+from nanome.util import Logs
+
+from .ComplexDelta import COLOR_ATTRIBUTES, FIELDS, apply_delta, apply_state, copy_state, diff_state, extract_delta
+from .WorkspaceSerializer import Scene, complex_hash, copy_complex
+
+# levels of complexes staged ahead of time, complex transforms can change without
+# complex updated callbacks, so the complex level is compared when applying
+STAGED_LEVELS = ('molecule', 'chain', 'residue', 'atom', 'bond')
+# recent transitions whose state is recognized in complex updates, which can arrive late
+SENT_HISTORY = 3
+
+
+class Timings:
+    """Durations of the named steps of an operation, for logging."""
+
+    def __init__(self):
+        self.start = self.last = time.perf_counter()
+        self.steps = {}
+
+    # end current step
+    def lap(self, name):
+        now = time.perf_counter()
+        self.steps[name] = self.steps.get(name, 0) + now - self.last
+        self.last = now
+
+    @property
+    def total(self):
+        return self.last - self.start
+
+    def __str__(self):
+        steps = ', '.join(f'{name} {duration * 1000:.0f}ms' for name, duration in self.steps.items())
+        return f'{self.total * 1000:.0f}ms ({steps})'
+
+
+def workspace_transform(workspace: Workspace):
+    p, r, s = workspace.position, workspace.rotation, workspace.scale
+    return (p.x, p.y, p.z, r.x, r.y, r.z, r.w, s.x, s.y, s.z)
+
+
+def interaction_key(interaction: Interaction):
+    return (int(interaction.kind), tuple(interaction.atom1_idx_arr), tuple(interaction.atom2_idx_arr))
+
+
+# match scene complexes to loaded (hash, complex) entries with the same content
+# returns loaded complex or None for each key, and loaded complexes left unmatched
+def match_complexes(keys, loaded):
+    remaining = list(loaded)
+    matches = []
+    for key in keys:
+        match = next((entry for entry in remaining if entry[0] == key), None)
+        if match is not None:
+            remaining.remove(match)
+        matches.append(match[1] if match is not None else None)
+    return matches, [complex for _, complex in remaining]
+
+
+# complex -> atom indices array, complexes keep their atom indices once loaded
+_atom_indices = weakref.WeakKeyDictionary()
+
+
+def atom_indices(complex):
+    indices = _atom_indices.get(complex)
+    if indices is None:
+        indices = np.fromiter((atom.index for atom in complex.atoms), dtype=np.int64)
+        _atom_indices[complex] = indices
+    return indices
+
+
+# returns sorted original atom indices and matching updated atom indices
+# for pairs of the same complex, before and after loading into the workspace
+def atom_index_table(original_complexes, updated_complexes):
+    originals = []
+    updates = []
+    for original, updated in zip(original_complexes, updated_complexes):
+        if updated is None:
+            continue
+        og_indices = atom_indices(original)
+        updated_indices = atom_indices(updated)
+        if len(og_indices) != len(updated_indices):
+            Logs.warning(f'Complex "{original.name}" atoms changed when loaded, skipping its interactions')
+            continue
+        originals.append(og_indices)
+        updates.append(updated_indices)
+
+    if not originals:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    originals = np.concatenate(originals)
+    updates = np.concatenate(updates)
+    # unset indices can't be referenced by interactions
+    mask = originals >= 0
+    order = np.argsort(originals[mask], kind='stable')
+    return originals[mask][order], updates[mask][order]
+
+
+# run in the worker pool, returns hash of an updated workspace complex,
+# and whether it has the content and state one of targets was loaded with
+def compare_update(complex, targets):
+    key = complex_hash(complex)
+    for target in targets:
+        try:
+            if complex_hash(target) == key and not diff_state(target, complex):
+                return key, True
+        except ValueError:
+            pass
+    return key, False
+
+
+# indices of scene complexes can collide with complexes in the workspace, add them without
+def without_indices(complex):
+    delta = extract_delta(complex)
+    apply_delta(complex, {key: value for key, value in delta.items() if not key.endswith('._index')})
+    return complex
+
+
+def update_interaction_lines(interaction_list, original_complexes, updated_complexes):
+    """Update atom indices in interactions to reflect the updated complexes.
+
+    This is a workaround for the fact that atom indices change every time a workspace
+    is reloaded into the room. original_complexes and updated_complexes are pairs of the
+    same complex, whose atoms align. Interactions referencing atoms that aren't in the
+    updated complexes are skipped.
+    """
+    og_sorted, updated_sorted = atom_index_table(original_complexes, updated_complexes)
+
+    # remap atom indices of all interactions at once
+    arrays = [arr for interaction in interaction_list for arr in (interaction.atom1_idx_arr, interaction.atom2_idx_arr)]
+    lengths = np.fromiter((len(arr) for arr in arrays), dtype=np.int64, count=len(arrays))
+    indices = np.fromiter(itertools.chain.from_iterable(arrays), dtype=np.int64, count=lengths.sum())
+    positions = np.searchsorted(og_sorted, indices)
+    positions[positions == len(og_sorted)] = 0
+    found = og_sorted[positions] == indices if len(og_sorted) else np.zeros(len(indices), dtype=bool)
+    mapped = updated_sorted[positions].tolist() if len(og_sorted) else []
+
+    # an interaction is valid if all indices of its two arrays were found
+    ends = np.cumsum(lengths)
+    missing = np.concatenate(([0], np.cumsum(~found)))
+    invalid = (missing[ends[1::2]] - missing[ends[1::2] - lengths[::2] - lengths[1::2]]) > 0
+
+    updated_interactions = []
+    for i, interaction in enumerate(interaction_list):
+        if invalid[i]:
+            continue
+        start = ends[2 * i] - lengths[2 * i]
+        middle = ends[2 * i]
+        interaction.atom1_idx_arr = tuple(mapped[start:middle])
+        interaction.atom2_idx_arr = tuple(mapped[middle:ends[2 * i + 1]])
+        interaction.index = -1
+        updated_interactions.append(interaction)
+
+    skipped = len(interaction_list) - len(updated_interactions)
+    if skipped:
+        Logs.warning(f'Skipped {skipped} interactions with atoms missing from the workspace')
+    return updated_interactions
+
+
+class StagedScene:
+    """Transition work for a scene done ahead of time, against the loaded complexes.
+
+    Only valid while the workspace generation it was prepared for is current.
+    """
+
+    def __init__(self, scene: Scene, keys, generation):
+        self.scene = scene
+        self.keys = keys
+        self.generation = generation
+        # loaded complex or None for each scene complex, None if loaded complexes unknown
+        self.matches = None
+        self.removed = []
+        # state changes of matched complexes, from diff_state
+        self.diff = []
+        # remapped interactions, None if complexes need to be added first
+        self.interactions = None
+        # copies of unmatched scene complexes without indices, to add to the workspace
+        self.additions = []
+
+
+class SceneTransition:
+    """Switches the workspace to a scene, changing only what differs from the loaded scene.
+
+    Complexes already in the workspace are matched to scene complexes by content hash,
+    and only get their per scene state (transform, selection, representation...) updated
+    with shallow updates. Other complexes, and complexes whose colors change, are added
+    or removed, and only interactions that differ are recreated.
+
+    The whole workspace is reloaded when the workspace is unknown, its complexes were
+    added or removed outside of scene switching, or the scene workspace transform differs.
+
+    Scenes likely to be selected next can be staged: hashing, matching, state diffs and
+    interaction remapping run in the background, so applying them only sends updates.
+    """
+
+    def __init__(self, plugin: nanome.PluginInstance):
+        self.plugin = plugin
+        # (hash, complex) of loaded scene complexes in the workspace, None if unknown
+        self.loaded = None
+        self.transform = None
+        # incremented when loaded complexes change, invalidates staged scenes
+        self.generation = 0
+        # [(scene, future of StagedScene)]
+        self.staged = []
+        # {workspace complex index: scene complex} of recent transitions
+        self.sent = deque(maxlen=SENT_HISTORY)
+        # complex updates being checked, the loaded complexes they replace are used by transitions
+        self.checks = set()
+
+    def set_loaded(self, loaded):
+        self.loaded = loaded
+        self.generation += 1
+
+    # keep workspace copy of complex up to date, from complex updated callbacks
+    # returns task resolving to whether the update changed the complex,
+    # updates caused by recent transitions have the state they loaded and are not changes
+    def on_complex_updated(self, complex):
+        task = asyncio.ensure_future(self.check_update(complex))
+        self.checks.add(task)
+        task.add_done_callback(self.checks.discard)
+        return task
+
+    async def check_update(self, complex):
+        if self.loaded is None or complex is None:
+            return True
+        previous = next((c for _, c in self.loaded if c.index == complex.index), None)
+        if previous is None:
+            return True
+
+        targets = [sent[complex.index] for sent in self.sent if complex.index in sent]
+        loop = asyncio.get_event_loop()
+        key, loaded_state = await loop.run_in_executor(self.plugin.executor, compare_update, complex, targets)
+        if loaded_state:
+            return False
+
+        for i, (_, loaded) in enumerate(self.loaded or []):
+            if loaded is previous:
+                # content may have been edited, only matched to scene complexes with the new hash
+                self.loaded[i] = (key, complex)
+                self.generation += 1
+                self.stage([scene for scene, _ in self.staged])
+        return True
+
+    # prepare transitions to scenes in the background, replacing previously staged scenes
+    def stage(self, scenes):
+        loop = asyncio.get_event_loop()
+        loaded = self.loaded and list(self.loaded)
+        self.staged = [
+            (scene, loop.run_in_executor(self.plugin.executor, self.prepare, scene, loaded, self.generation))
+            for scene in scenes]
+
+    # run in the worker pool, scene and loaded complexes are only read
+    def prepare(self, scene, loaded, generation):
+        complexes = scene.workspace.complexes
+        staged = StagedScene(scene, [complex_hash(c) for c in complexes], generation)
+        if loaded is None:
+            return staged
+
+        staged.matches, staged.removed = match_complexes(staged.keys, loaded)
+        for i, (target, match) in enumerate(zip(complexes, staged.matches)):
+            if match is None:
+                continue
+            diff = diff_state(target, match, STAGED_LEVELS)
+            if any(attr in COLOR_ATTRIBUTES for _, values in diff for attr, _ in values):
+                # like clearing the workspace on full reloads, add complexes again to change colors
+                staged.matches[i] = None
+                staged.removed.append(match)
+            else:
+                staged.diff.extend(diff)
+        staged.additions = [
+            without_indices(copy_complex(target))
+            for target, match in zip(complexes, staged.matches) if match is None]
+        if None not in staged.matches:
+            interactions = [copy.copy(interaction) for interaction in scene.interactions]
+            staged.interactions = update_interaction_lines(interactions, complexes, staged.matches)
+        return staged
+
+    # returns staged scene if it is still valid, otherwise prepares it now
+    async def take_staged(self, scene):
+        staged = None
+        for staged_scene, future in self.staged:
+            if staged_scene is scene:
+                try:
+                    staged = await future
+                except Exception as e:
+                    Logs.warning(f'Staging scene failed: {e}')
+                break
+        self.staged = []
+        if staged is not None and staged.generation == self.generation:
+            return staged, True
+
+        loop = asyncio.get_event_loop()
+        loaded = self.loaded and list(self.loaded)
+        staged = await loop.run_in_executor(self.plugin.executor, self.prepare, scene, loaded, self.generation)
+        return staged, False
+
+    # switch workspace to scene, returns complexes added to the workspace
+    async def apply(self, scene: Scene):
+        timings = Timings()
+        if self.checks:
+            await asyncio.wait(list(self.checks))
+        staged, prestaged = await self.take_staged(scene)
+        timings.lap('prepare')
+
+        shallow = await self.plugin.request_complex_list()
+        timings.lap('list')
+
+        stats = None
+        if self.can_diff(scene, shallow):
+            try:
+                added, stats = await self.apply_diff(staged, shallow, timings)
+            except Exception as e:
+                Logs.warning(f'Scene diff failed, reloading workspace: {e}')
+        if stats is None:
+            added, stats = await self.apply_full(scene, staged.keys, timings)
+
+        self.transform = workspace_transform(scene.workspace)
+        mode = 'staged' if prestaged else 'unstaged'
+        Logs.message(f'Scene transition {timings}, {mode}: {stats}')
+        return added
+
+    def can_diff(self, scene, shallow):
+        if self.loaded is None or self.transform != workspace_transform(scene.workspace):
+            return False
+        indices = sorted(complex.index for complex in shallow)
+        return indices == sorted(complex.index for _, complex in self.loaded)
+
+    async def apply_diff(self, staged, shallow, timings):
+        targets = staged.scene.workspace.complexes
+        matches = staged.matches
+
+        # complex list has current transforms, which don't trigger complex updated
+        for complex in shallow:
+            loaded = next(c for _, c in self.loaded if c.index == complex.index)
+            for attr, _, _ in FIELDS['complex']:
+                setattr(loaded, attr, getattr(complex, attr))
+
+        if staged.removed:
+            await self.plugin.remove_from_workspace(staged.removed)
+        timings.lap('remove')
+
+        new = staged.additions
+        added = await self.plugin.add_to_workspace(new) if new else []
+        added_iter = iter(added)
+        complexes = [match if match is not None else next(added_iter) for match in matches]
+        timings.lap('add')
+
+        changed = apply_state(staged.diff)
+        for target, match in zip(targets, matches):
+            if match is not None:
+                changed.extend(copy_state(target, match, ('complex',)))
+        if changed:
+            self.plugin.update_structures_shallow(changed)
+        self.set_loaded(list(zip(staged.keys, complexes)))
+        self.sent.append({complex.index: target for target, complex in zip(targets, complexes)})
+        timings.lap('update')
+
+        interactions = await self.update_interactions(staged.scene, complexes, staged.interactions)
+        timings.lap('interactions')
+
+        stats = (
+            f'{len(targets) - len(new)} complexes kept, {len(new)} added, {len(staged.removed)} removed, '
+            f'{len(changed)} structures updated, {interactions}')
+        return added, stats
+
+    # recreate interactions that differ between workspace and scene
+    # targets are the scene interactions remapped to complexes, if already known
+    async def update_interactions(self, scene, complexes, targets=None):
+        if targets is None:
+            interactions = [copy.copy(interaction) for interaction in scene.interactions]
+            targets = update_interaction_lines(interactions, scene.workspace.complexes, complexes)
+
+        current = defaultdict(list)
+        for interaction in await Interaction.get():
+            current[interaction_key(interaction)].append(interaction)
+
+        upload = []
+        for interaction in targets:
+            matches = current[interaction_key(interaction)]
+            if matches:
+                matches.pop()
+            else:
+                upload.append(interaction)
+
+        destroy = list(itertools.chain.from_iterable(current.values()))
+        if destroy:
+            Interaction.destroy_multiple(destroy)
+        if upload:
+            await Interaction.upload_multiple(upload)
+        kept = len(targets) - len(upload)
+        return f'{kept} interactions kept, {len(upload)} added, {len(destroy)} removed'
+
+    async def apply_full(self, scene, keys, timings):
+        # clear workspace first to fix a bug where structure color doesn't update
+        await self.plugin.update_workspace(Workspace())
+        current_interactions = await Interaction.get()
+        if current_interactions:
+            Interaction.destroy_multiple(current_interactions)
+        await self.plugin.update_workspace(scene.workspace)
+        timings.lap('reload')
+
+        shallow_comps = await self.plugin.request_complex_list()
+        complexes = []
+        if shallow_comps:
+            complexes = await self.plugin.request_complexes([cmp.index for cmp in shallow_comps])
+        timings.lap('request')
+
+        if scene.interactions:
+            interactions = [copy.copy(interaction) for interaction in scene.interactions]
+            updated_interactions = update_interaction_lines(interactions, scene.workspace.complexes, complexes)
+            await Interaction.upload_multiple(updated_interactions)
+        timings.lap('interactions')
+
+        loaded = None
+        if len(complexes) == len(keys) and None not in complexes:
+            loaded = list(zip(keys, complexes))
+            self.sent.append({complex.index: target for target, complex in zip(scene.workspace.complexes, complexes)})
+        self.set_loaded(loaded)
+
+        stats = f'workspace reloaded, {len(complexes)} complexes, {len(scene.interactions)} interactions'
+        return complexes, stats
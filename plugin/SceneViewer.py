@@ -1,7 +1,7 @@
 import asyncio
-import itertools
 import nanome
 import os
+import tempfile
 from functools import partial
 from nanome import ui
 from nanome.api.interactions import Interaction
@@ -10,7 +10,8 @@ from nanome.util import async_callback, Logs
 from nanome.util.enums import NotificationTypes
 
 from . import WorkspaceSerializer
-from .WorkspaceSerializer import Scene
+from .SceneTransition import SceneTransition
+from .WorkspaceSerializer import LazyScene, Scene
 
 BASE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'menus')
 MENU_PATH = os.path.join(BASE_DIR, 'json/scenes_menu.json')
@@ -34,10 +35,31 @@ CONFIRM_DELETE_SCENE = 'Delete this scene?\nThis action cannot be undone.'
 CONFIRM_RESET = 'Create new scene deck?\nUnsaved deck changes will be lost.'
 
 
+# decode scenes into their deck cache, run in the worker pool
+def load_scenes(scenes: 'list[LazyScene]'):
+    for scene in scenes:
+        try:
+            scene.load()
+        except Exception as e:
+            Logs.warning(f'Prefetching scene "{scene.name}" failed: {e}')
+
+
+# returns temp file with deck of scenes, run in the worker pool
+def build_deck(scenes: 'list[Scene]', level=WorkspaceSerializer.COMPRESSION_LEVEL):
+    # compressed into a temp file and uploaded from there, instead of held in memory
+    data = tempfile.TemporaryFile()
+    try:
+        WorkspaceSerializer.scenes_to_file(scenes, data, level)
+    except Exception:
+        data.close()
+        raise
+    return data
+
+
 class SaveRequest:
-    def __init__(self, name, scenes: 'list[Scene]'):
+    def __init__(self, name, data):
         self.name = name
-        self.data = WorkspaceSerializer.scenes_to_data(scenes)
+        self.data = data
         loop = asyncio.get_event_loop()
         self.future = loop.create_future()
 
@@ -45,6 +67,7 @@ class SaveRequest:
         return ('Browse', self.name, self.data)
 
     def send_response(self, response):
+        self.data.close()
         self.future.set_result(response)
 
 
@@ -60,6 +83,7 @@ class SceneViewer:
         self.saved = True
         self.ignore_changes = 0
         self.scene_changes = False
+        self.transition = SceneTransition(plugin)
 
         self.create_menu()
         self.create_scene_menu()
@@ -341,6 +365,38 @@ class SceneViewer:
         self.toggle_edit_mode(False)
         self.update_scenes()
         self.open_menu()
+        self.prefetch_scenes(0, 1, -1)
+
+    # returns decoded scene, decoding it in the worker pool if needed
+    async def load_scene(self, index):
+        scene = self.scenes[index]
+        if not isinstance(scene, LazyScene):
+            return scene
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.plugin.executor, scene.load)
+
+    # decode scenes at indices in the background, so they are ready when selected
+    def prefetch_scenes(self, *indices):
+        if not self.scenes:
+            return
+        scenes = [self.scenes[i % len(self.scenes)] for i in indices]
+        scenes = [scene for scene in scenes if isinstance(scene, LazyScene)]
+        if scenes:
+            loop = asyncio.get_event_loop()
+            loop.run_in_executor(self.plugin.executor, load_scenes, scenes)
+
+    # prepare transitions to scenes at indices in the background, so selecting them only sends updates
+    @async_callback
+    async def stage_scenes(self, *indices):
+        if not self.scenes:
+            return
+        scenes = []
+        for index in dict.fromkeys(i % len(self.scenes) for i in indices):
+            try:
+                scenes.append(await self.load_scene(index))
+            except Exception as e:
+                Logs.warning(f'Staging scene {index + 1} failed: {e}')
+        self.transition.stage(scenes)
 
     def move_scene(self, index, offset, btn=None):
         self.scenes.insert(index + offset, self.scenes.pop(index))
@@ -353,6 +409,13 @@ class SceneViewer:
         self.update_scenes()
         self.set_saved(False)
 
+    @async_callback
+    async def on_complex_updated(self, complex=None):
+        # complexes are changing while switching scenes
+        transitioning = self.ignore_changes
+        if await self.transition.on_complex_updated(complex) and not transitioning:
+            self.on_scene_changed()
+
     def on_scene_changed(self, *_):
         if not self.edit_mode or self.ignore_changes:
             return
@@ -383,7 +446,11 @@ class SceneViewer:
             return
 
         filename = f'{name}.nanoscenes'
-        request = SaveRequest(filename, self.scenes)
+        loop = asyncio.get_event_loop()
+        # copied, scenes can be added or removed while the deck is built
+        scenes = list(self.scenes)
+        data = await loop.run_in_executor(self.plugin.executor, build_deck, scenes, self.plugin.compression_level)
+        request = SaveRequest(filename, data)
         self.plugin.on_export_integration(request)
         response = await request.future
 
@@ -435,32 +502,28 @@ class SceneViewer:
         self.update_scenes()
         self.update_scene_info()
 
-        # clear workspace first to fix a bug where structure color doesn't update
-        scene = self.scenes[index]
+        try:
+            scene = await self.load_scene(index)
+        except Exception as e:
+            self.plugin.send_notification(NotificationTypes.error, f'Scene {index + 1} failed to load')
+            Logs.warning(e)
+            return
+        if self.selected_index != index:
+            # another scene was selected while decoding
+            return
+        self.prefetch_scenes(index - 1, index + 1)
+
         self.ignore_changes += 1
-        await self.plugin.update_workspace(Workspace())
-        current_interactions = await Interaction.get()
-        if current_interactions:
-            Interaction.destroy_multiple(current_interactions)
-        await self.plugin.update_workspace(scene.workspace)
-        shallow_comps = await self.plugin.request_complex_list()
-        updated_complexes = []
-        if shallow_comps:
-            updated_complexes = await self.plugin.request_complexes([cmp.index for cmp in shallow_comps])
-        if scene.interactions:
-            updated_interactions = self.update_interaction_lines(scene.interactions, scene.workspace.complexes, updated_complexes)
-            await Interaction.upload_multiple(updated_interactions)
-            # Update scene with new interactions and complexes.
-            scene.interactions = updated_interactions
-            scene.workspace.complexes = updated_complexes
-
-        for complex in updated_complexes:
-            complex.register_complex_updated_callback(self.on_scene_changed)
-            complex.register_selection_changed_callback(self.on_scene_changed)
-
-        # ignore updates 2 seconds after scene change
-        await asyncio.sleep(2)
-        self.ignore_changes -= 1
+        try:
+            added = await self.transition.apply(scene)
+            for complex in added:
+                complex.register_complex_updated_callback(self.on_complex_updated)
+                complex.register_selection_changed_callback(self.on_complex_updated)
+        finally:
+            self.ignore_changes -= 1
+
+        if self.selected_index == index:
+            self.stage_scenes(index - 1, index + 1)
 
     def set_saved(self, saved):
         self.saved = saved
@@ -502,8 +565,8 @@ class SceneViewer:
     async def update_scene(self, btn=None):
         workspace = await self.plugin.request_workspace()
         interactions = await Interaction.get()
-        self.scenes[self.selected_index].workspace = workspace
-        self.scenes[self.selected_index].interactions = interactions
+        scene = self.scenes[self.selected_index]
+        self.scenes[self.selected_index] = Scene(workspace, scene.name, scene.description, interactions)
         self.plugin.update_content(btn)
         self.set_saved(False)
         self.scene_changes = False
@@ -529,30 +592,3 @@ class SceneViewer:
         self.plugin.update_content(self.inp_scene_name, self.inp_scene_desc)
         self.plugin.update_content(self.lbl_scene_name, self.lbl_scene_desc)
         self.update_scene_desc_len()
-
-    @staticmethod
-    def update_interaction_lines(interaction_list, original_complexes, updated_complexes):
-        """Update atom indices in interactions to reflect the updated complexes.
-
-        This is a workaround for the fact that atom indices change every time a workspace
-        is reloaded into the room.
-        """
-        updated_interactions = []
-        atom_index_map = {}
-        og_atoms = itertools.chain.from_iterable(cmp.atoms for cmp in original_complexes)
-        updated_atoms = itertools.chain.from_iterable(
-            cmp.atoms for cmp in updated_complexes if cmp is not None)
-        # We are making the assumption that the og complex and updated complex
-        # are the same, so we can just zip the atoms together and they align.
-        for og_atom, updated_atom in zip(og_atoms, updated_atoms):
-            atom_index_map[og_atom.index] = updated_atom.index
-        for interaction in interaction_list:
-            try:
-                interaction.atom1_idx_arr = tuple(map(lambda x: atom_index_map[x], interaction.atom1_idx_arr))
-                interaction.atom2_idx_arr = tuple(map(lambda x: atom_index_map[x], interaction.atom2_idx_arr))
-            except Exception:
-                Logs.error("Updating interaction lines failed =(.")
-                break
-            interaction.index = -1
-            updated_interactions.append(interaction)
-        return updated_interactions
@@ -1,7 +1,12 @@
 import argparse
+import asyncio
+import multiprocessing
 import os
 import socket
 import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 
 import nanome
 from nanome.util import async_callback, Logs
@@ -9,11 +14,36 @@ from nanome.util.enums import Integrations, NotificationTypes
 
 from .menus import VaultMenu
 from .OBJLoader import OBJLoader
+from .OBJParser import parse_mtl
 from .SceneViewer import SceneViewer
-from .VaultManager import VaultManager
+from .VaultManager import AsyncVaultManager
 from . import WorkspaceSerializer
 
 EXPORT_LOCATIONS = ['Workspaces', 'Structures', 'Recordings', 'Pictures', 'Browse']
+# max concurrent downloads when loading multiple files
+LOAD_CONCURRENCY = 4
+# worker threads for parsing downloaded files
+PARSE_WORKERS = 4
+# worker processes for parsing OBJ files, 0 to parse in threads
+PARSE_PROCESSES = min(4, os.cpu_count() or 1)
+# textures used for OBJs without materials, as <name><ext>
+TEXTURE_EXTENSIONS = ['.png', '.jpg', '.jpeg']
+
+
+def read_file(file_path, parse):
+    with open(file_path, 'rb') as f:
+        return parse(f)
+
+
+# returns process pool for CPU heavy parsing, or None if processes aren't available
+def create_process_pool():
+    try:
+        # spawn, forking a process with running threads is unsafe
+        context = multiprocessing.get_context('spawn')
+        return ProcessPoolExecutor(PARSE_PROCESSES, mp_context=context)
+    except (OSError, ValueError) as e:
+        Logs.warning(f'Process pool unavailable, parsing in threads: {e}')
+        return None
 
 
 class Vault(nanome.AsyncPluginInstance):
@@ -34,12 +64,39 @@ class Vault(nanome.AsyncPluginInstance):
         external_url = self.custom_data[0]
         api_key = self.custom_data[1]
         internal_url = self.custom_data[2]
+        self.compression_level = self.custom_data[3]
 
+        self.executor = ThreadPoolExecutor(PARSE_WORKERS, thread_name_prefix='parse')
+        # each session runs in its own process, only start parse processes when an OBJ is loaded
+        self.process_pool = None
+        self.process_pool_available = PARSE_PROCESSES > 0
+        self.process_pool_lock = threading.Lock()
         self.menu = VaultMenu(self, external_url)
-        self.vault = VaultManager(api_key, internal_url)
+        self.vault = AsyncVaultManager(api_key, internal_url)
         self.obj_loader = OBJLoader(self)
         self.scene_viewer = SceneViewer(self)
-        self.extensions = self.vault.get_extensions()
+        self.extensions = self.vault.manager.get_extensions()
+
+    def on_stop(self):
+        self.executor.shutdown(wait=False)
+        self.disable_process_pool()
+
+    # returns process pool for CPU heavy parsing, created on first use, or None if unavailable
+    def get_process_pool(self):
+        with self.process_pool_lock:
+            if self.process_pool is None and self.process_pool_available:
+                self.process_pool = create_process_pool()
+                self.process_pool_available = self.process_pool is not None
+            return self.process_pool
+
+    # stop parse processes, and parse in threads from now on
+    def disable_process_pool(self):
+        with self.process_pool_lock:
+            pool = self.process_pool
+            self.process_pool = None
+            self.process_pool_available = False
+        if pool is not None:
+            pool.shutdown(wait=False)
 
     def on_run(self):
         self.on_presenter_change()
@@ -54,7 +111,7 @@ class Vault(nanome.AsyncPluginInstance):
             self.menu.open_for_integration(request)
         else:
             path = os.path.join(self.account, location)
-            r = self.vault.add_file(path, filename, data)
+            r = await self.vault.add_file(path, filename, data)
             request.send_response(r.ok)
 
     @async_callback
@@ -69,11 +126,11 @@ class Vault(nanome.AsyncPluginInstance):
             return
 
         self.account = info.account_id
-        self.vault.create_path(self.account)
+        await self.vault.create_path(self.account)
 
         if info.has_org:
             self.org = f'org-{info.org_id}'
-            self.vault.create_path(self.org)
+            await self.vault.create_path(self.org)
         else:
             self.org = None
 
@@ -85,23 +142,112 @@ class Vault(nanome.AsyncPluginInstance):
     def on_complex_list_changed(self):
         self.scene_viewer.on_scene_changed()
 
-    async def load_or_queue_file(self, temp_dir, name, out_queue):
-        item_name, extension = name.rsplit('.', 1)
+    async def prepare_file(self, temp_dir, folder, key, name, semaphore, files=None):
+        """Download a file and parse it in the worker pool.
 
-        path = os.path.join(self.menu.path, name)
-        key = self.menu.folder_key
+        Returns (file_path, item), where item is the parsed result, None for files
+        that don't need parsing, or the exception raised while parsing.
+        Raises if the download fails. files is the set of file names in folder, if known.
+        """
+        item_name, extension = name.rsplit('.', 1)
 
+        path = os.path.join(folder, name)
         file_path = os.path.join(temp_dir.name, name)
-        self.vault.get_file(path, key, file_path)
 
+        async with semaphore:
+            if not await self.vault.get_file(path, key, file_path):
+                raise OSError(f'Download of "{path}" failed')
+
+        if extension == 'nanome':
+            parse = partial(read_file, file_path, WorkspaceSerializer.workspace_from_file)
+        elif extension == 'nanoscenes':
+            parse = partial(read_file, file_path, WorkspaceSerializer.scenes_from_file)
+        elif extension == 'obj':
+            parse = partial(self.obj_loader.parse, item_name, file_path)
+        else:
+            return file_path, None
+
+        loop = asyncio.get_event_loop()
+        try:
+            item = await loop.run_in_executor(self.executor, parse)
+            if extension == 'obj':
+                await self.prepare_obj_materials(item, temp_dir, folder, key, item_name, semaphore, files)
+        except Exception as e:
+            item = e
+        return file_path, item
+
+    async def prepare_obj_materials(self, obj, temp_dir, folder, key, item_name, semaphore, files):
+        """Download the MTL files and textures used by an OBJ and apply them to its meshes.
+
+        All referenced files are fetched concurrently. If no material has a texture,
+        <item_name>.png/.jpg/.jpeg from the folder listing is used.
+        """
+        out_dir = tempfile.mkdtemp(dir=temp_dir.name)
+        count = 0
+
+        async def download(name):
+            nonlocal count
+            # only fetch files inside folder, and skip files known to be missing
+            name = os.path.normpath(name)
+            if name.startswith('..') or os.path.isabs(name):
+                return None
+            if files is not None and os.sep not in name and name not in files:
+                return None
+
+            count += 1
+            out_path = os.path.join(out_dir, f'{count}_{os.path.basename(name)}')
+            try:
+                async with semaphore:
+                    found = await self.vault.get_file(os.path.join(folder, name), key, out_path)
+            except Exception as e:
+                Logs.warning(f'Download of "{name}" failed: {e}')
+                return None
+            return out_path if found else None
+
+        materials = {}
+        mtl_paths = await asyncio.gather(*map(download, obj.mtllibs))
+        for mtl_name, mtl_path in zip(obj.mtllibs, mtl_paths):
+            if mtl_path is None:
+                continue
+            try:
+                mtl_materials = parse_mtl(mtl_path)
+            except Exception as e:
+                Logs.warning(e)
+                continue
+            # textures are relative to the MTL file, make them relative to folder
+            mtl_dir = os.path.dirname(os.path.normpath(mtl_name))
+            for material in mtl_materials.values():
+                if material.texture:
+                    material.texture = os.path.normpath(os.path.join(mtl_dir, material.texture))
+            materials.update(mtl_materials)
+
+        used = [materials[name] for name in obj.materials if name in materials]
+        tex_names = list(dict.fromkeys(m.texture for m in used if m.texture))
+        default_names = []
+        if not tex_names:
+            default_names = [f'{item_name}{ext}' for ext in TEXTURE_EXTENSIONS]
+            if files is not None:
+                default_names = [name for name in default_names if name in files][:1]
+
+        paths = await asyncio.gather(*map(download, tex_names + default_names))
+        textures = {name: path for name, path in zip(tex_names, paths) if path}
+        default_texture = next((path for path in paths[len(tex_names):] if path), None)
+
+        loop = asyncio.get_event_loop()
+        apply = partial(self.obj_loader.apply_materials, obj, materials, textures, default_texture)
+        await loop.run_in_executor(self.executor, apply)
+
+    async def load_or_queue_file(self, name, file_path, item, out_queue):
+        item_name, extension = name.rsplit('.', 1)
+        failed = isinstance(item, Exception)
         msg = None
 
         # workspace
         if extension == 'nanome':
             try:
-                with open(file_path, 'rb') as f:
-                    workspace = WorkspaceSerializer.workspace_from_data(f.read())
-                    await self.update_workspace(workspace)
+                if failed:
+                    raise item
+                await self.update_workspace(item)
                 msg = f'Workspace "{item_name}" loaded'
             except Exception:
                 out_queue.append(file_path)
@@ -109,9 +255,9 @@ class Vault(nanome.AsyncPluginInstance):
         # scene viewer
         elif extension == 'nanoscenes':
             try:
-                with open(file_path, 'rb') as f:
-                    scenes = WorkspaceSerializer.scenes_from_data(f.read())
-                self.scene_viewer.load(item_name, scenes)
+                if failed:
+                    raise item
+                self.scene_viewer.load(item_name, item)
                 msg = f'Scenes "{item_name}" loaded'
             except Exception as e:
                 error = f'Scenes: {item_name}" failed to load'
@@ -128,16 +274,10 @@ class Vault(nanome.AsyncPluginInstance):
             msg = f'Macro "{item_name}" added'
 
         elif extension == 'obj':
-            tex_path = None
-            for ext in ['.png', '.jpg', '.jpeg']:
-                tex_name = f'{item_name}{ext}'
-                tex_in = os.path.join(self.menu.path, tex_name)
-                tex_out = os.path.join(temp_dir.name, tex_name)
-                if self.vault.get_file(tex_in, key, tex_out):
-                    tex_path = tex_out
-                    break
             try:
-                await self.obj_loader.load(item_name, file_path, tex_path)
+                if failed:
+                    raise item
+                await self.obj_loader.add(item)
                 msg = f'OBJ "{item_name}" loaded'
             except Exception as e:
                 error = f'OBJ "{item_name}" failed to load'
@@ -155,19 +295,53 @@ class Vault(nanome.AsyncPluginInstance):
         if msg is not None:
             self.send_notification(NotificationTypes.success, msg)
 
-    async def load_files(self, names):
+    async def load_files(self, names, on_progress=None):
         temp = tempfile.TemporaryDirectory()
         send_files = []
 
-        for name in names:
-            await self.load_or_queue_file(temp, name, send_files)
-
-        if send_files:
-            self.send_files_to_load(send_files)
-
-        temp.cleanup()
-
-    def save_file(self, item, name, extension):
+        folder = self.menu.path
+        key = self.menu.folder_key
+        listing = self.menu.items
+        files = listing and {item['name'] for item in listing['files']}
+        semaphore = asyncio.Semaphore(LOAD_CONCURRENCY)
+        completed = 0
+
+        def on_prepared(_):
+            nonlocal completed
+            completed += 1
+            if on_progress is not None:
+                on_progress(completed, len(names))
+
+        # download and parse concurrently
+        tasks = []
+        try:
+            for name in names:
+                task = asyncio.ensure_future(self.prepare_file(temp, folder, key, name, semaphore, files))
+                task.add_done_callback(on_prepared)
+                tasks.append(task)
+
+            # apply results in selection order
+            for name, task in zip(names, tasks):
+                try:
+                    file_path, item = await task
+                except Exception as e:
+                    self.send_notification(NotificationTypes.error, f'"{name}" failed to download')
+                    Logs.warning(e)
+                    continue
+                await self.load_or_queue_file(name, file_path, item, send_files)
+
+            if send_files:
+                self.send_files_to_load(send_files)
+        finally:
+            # downloads still running write to temp, wait for them before removing it
+            await asyncio.gather(*tasks, return_exceptions=True)
+            temp.cleanup()
+
+        cache = self.vault.manager.cache
+        if cache:
+            Logs.message(f'File cache: {cache}')
+
+    async def save_file(self, item, name, extension):
         temp = tempfile.NamedTemporaryFile(delete=False, suffix=extension)
 
         # structures / workspace
@@ -181,7 +355,7 @@ class Vault(nanome.AsyncPluginInstance):
             key = self.menu.folder_key
             file_name = f'{name}.{extension}'
 
-            r = self.vault.add_file(path, file_name, f.read(), key)
+            r = await self.vault.add_file(path, file_name, f, key)
             if r.ok:
                 self.send_notification(NotificationTypes.success, f'"{file_name}" saved')
             else:
@@ -239,6 +413,14 @@ def create_parser():
         default=os.environ.get('VAULT_WEB_PORT', None),
         help='Custom port for connecting to Vault Web UI.',
         required=False)
+    vault_group.add_argument(
+        '--compression-level',
+        dest='compression_level',
+        type=int,
+        choices=range(-1, 10),
+        default=int(os.environ.get('COMPRESSION_LEVEL', WorkspaceSerializer.COMPRESSION_LEVEL)),
+        help='zlib level for saved scene decks, from 1 (fastest) to 9 (smallest). Default -1 is zlib default.',
+        required=False)
     return parser
 
 
@@ -264,6 +446,7 @@ def main():
     port = args.web_port
     external_url = args.external_url
     internal_url = args.internal_url
+    compression_level = args.compression_level
 
     if external_url is None:
         external_url = get_default_url()
@@ -280,7 +463,7 @@ def main():
     ]
     plugin = nanome.Plugin('Vault', 'Use your browser to upload files and folders to make them available in Nanome.', 'Files', False, integrations=integrations)
     plugin.set_plugin_class(Vault)
-    plugin.set_custom_data(external_url, api_key, internal_url)
+    plugin.set_custom_data(external_url, api_key, internal_url, compression_level)
     plugin.run()
 
 
@@ -1,37 +1,186 @@
+import asyncio
+import copy
+import hashlib
+import os
+import posixpath
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .ContentCache import ContentCache
+
+POOL_SIZE = 32
+RETRIES = 3
+RETRY_BACKOFF = 0.3
+RETRY_STATUSES = [502, 503, 504]
+# (connect, read) timeouts in seconds
+TIMEOUT = (5, 60)
+# download chunk size, bounds memory used by get_file
+CHUNK_SIZE = 1024 * 1024
+# uploads larger than threshold are sent in chunks, bounds memory used by add_file
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_CHUNK_THRESHOLD = 16 * 1024 * 1024
+# sha256 hex digest of file contents, sent by vault-server when known
+CHECKSUM_HEADER = 'X-Content-SHA256'
+# on-disk cache for downloaded files, shared by plugin processes
+CACHE_DIR = os.path.join(tempfile.gettempdir(), 'nanome-vault-cache')
+CACHE_SIZE = 2 * 1024 ** 3
+# number of folder listings kept for conditional requests
+LISTING_CACHE_SIZE = 100
+# max concurrent blocking requests made by AsyncVaultManagers
+MAX_WORKERS = 8
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_executor = None
+
+
+# pooled keep-alive session shared by all VaultManagers in this process
+def get_session(pool_size=POOL_SIZE, retries=RETRIES, backoff=RETRY_BACKOFF):
+    config = (pool_size, retries, backoff)
+    with _sessions_lock:
+        session = _sessions.get(config)
+        if session is None:
+            # POST is not idempotent, only retried when connection fails
+            retry = Retry(
+                total=retries, backoff_factor=backoff,
+                status_forcelist=RETRY_STATUSES, raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[config] = session
+    return session
+
+
+# bounded thread pool shared by all AsyncVaultManagers in this process
+def get_executor():
+    global _executor
+    with _sessions_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(MAX_WORKERS, thread_name_prefix='vault')
+    return _executor
+
+
+# size of bytes or binary file object
+def get_size(data):
+    if hasattr(data, 'read'):
+        data.seek(0, os.SEEK_END)
+        return data.tell()
+    return len(data)
+
+
+# read size bytes at offset from bytes or binary file object
+def read_chunk(data, offset, size):
+    if hasattr(data, 'read'):
+        data.seek(offset)
+        return data.read(size)
+    return data[offset:offset + size]
 
 
 class VaultManager:
-    def __init__(self, api_key, server_url):
+    def __init__(self, api_key, server_url, pool_size=POOL_SIZE, retries=RETRIES, timeout=TIMEOUT, cache_dir=CACHE_DIR, cache_size=CACHE_SIZE):
         self.api_key = api_key
         if server_url.endswith('/'):
             server_url = server_url[:-1]
         self.server_url = server_url
+        self.session = get_session(pool_size, retries)
+        self.timeout = timeout
+        # set cache_dir to None to disable file cache
+        self.cache = cache_dir and ContentCache(cache_dir, cache_size)
+        # (path, key) -> (etag, listing), listed from multiple threads
+        self.listings = {}
+        self.listings_lock = threading.Lock()
 
-    def command(self, command, path, data=None, files=None):
-        headers = {}
+    def command(self, command, path, data=None, files=None, headers=None, timeout=None):
+        headers = dict(headers or {})
         if self.api_key:
             headers['vault-api-key'] = self.api_key
         if data is None:
             data = {}
         data['command'] = command
         url = self.server_url + '/files/' + path
-        return requests.post(url, headers=headers, data=data, files=files)
+        timeout = timeout or self.timeout
+        return self.session.post(url, headers=headers, data=data, files=files, timeout=timeout)
 
-    def get(self, path, key):
-        headers = {}
+    def get(self, path, key, timeout=None, stream=False, headers=None):
+        headers = dict(headers or {})
         if self.api_key:
             headers['vault-api-key'] = self.api_key
         if key:
             headers['vault-key'] = key
         url = self.server_url + '/files/' + (path or '')
-        return requests.get(url, headers=headers)
+        timeout = timeout or self.timeout
+        return self.session.get(url, headers=headers, timeout=timeout, stream=stream)
 
     # add data to vault at path/filename, where filename can contain a path
-
+    # data can be bytes or a binary file object
     def add_file(self, path, filename, data, key=None):
+        # the server takes plain file names, folders in filename are added to path
+        folder, filename = posixpath.split(filename.replace('\\', '/'))
+        if folder:
+            path = posixpath.join(path or '', folder)
+
+        size = get_size(data)
+        if size > UPLOAD_CHUNK_THRESHOLD:
+            return self.add_file_chunked(path, filename, data, size, key)
+        if hasattr(data, 'read'):
+            data.seek(0)
         return self.command('upload', path, {'key': key}, {'files': (filename, data)})
 
+    # upload data in sequential chunks, resuming from the server offset on failure
+    def add_file_chunked(self, path, filename, data, size, key=None):
+        r = self.command('upload-init', path, {'name': filename, 'size': size, 'key': key})
+        if not r.ok:
+            return r
+
+        upload_id = r.json()['id']
+        offset = 0
+        failures = 0
+
+        while offset < size:
+            chunk = read_chunk(data, offset, UPLOAD_CHUNK_SIZE)
+            end = offset + len(chunk)
+            headers = {
+                'X-Upload-Id': upload_id,
+                'X-File-Name': filename,
+                # end is exclusive, matching vault-server
+                'Content-Range': f'bytes {offset}-{end}/{size}',
+            }
+
+            try:
+                r = self.command('upload-chunk', path, files={'chunk': (filename, chunk)}, headers=headers)
+                error = None
+            except requests.RequestException as e:
+                r = None
+                error = e
+
+            if r is not None and r.ok:
+                offset = end
+                failures = 0
+                continue
+
+            # auth and storage errors won't succeed on retry
+            failures += 1
+            if failures > RETRIES or (r is not None and r.status_code in [401, 403, 413]):
+                self.command('upload-cancel', path, {'id': upload_id})
+                if error is not None:
+                    raise error
+                return r
+
+            # the server reports the full size if the upload completed, but its response was lost
+            r = self.command('upload-status', path, {'id': upload_id, 'name': filename})
+            if not r.ok:
+                return r
+            offset = r.json()['offset']
+
+        return r
+
     # creates a path and returns True. returns False if path exists
     def create_path(self, path, key=None):
         return self.command('create', path, {'key': key})
@@ -51,16 +200,53 @@ class VaultManager:
     # get supported file extensions
     def get_extensions(self):
         url = f'{self.server_url}/info'
-        r = requests.get(url)
+        r = self.session.get(url, timeout=self.timeout)
         return r.json()['extensions']
 
-    # write decrypted file to out_put
-    def get_file(self, path, key, out_path):
-        r = self.get(path, key)
-        if not r.ok:
+    # stream decrypted file to out_path, returns False on error or checksum mismatch
+    # on_progress(received, total) is called per chunk, total is None if unknown
+    def get_file(self, path, key, out_path, on_progress=None, checksum=None):
+        # files from encrypted folders are never cached, only plaintext is received
+        cache_key = os.path.normpath(path)
+        use_cache = self.cache and not key
+        tag = use_cache and self.cache.get_tag(cache_key)
+
+        headers = {'If-None-Match': tag} if tag else None
+        with self.get(path, key, stream=True, headers=headers) as r:
+            if r.status_code == 304:
+                if self.cache.fetch(cache_key, out_path):
+                    return True
+                # entry evicted by another process, fetch without cache
+                return self.get_file(path, key, out_path, on_progress, checksum)
+
+            # hits are counted by the cache when it serves a request
+            if use_cache:
+                self.cache.misses += 1
+            if not r.ok:
+                return False
+
+            etag = r.headers.get('ETag')
+
+            total = r.headers.get('Content-Length')
+            total = int(total) if total else None
+            checksum = checksum or r.headers.get(CHECKSUM_HEADER)
+            digest = hashlib.sha256()
+            received = 0
+
+            with open(out_path, 'wb') as f:
+                for chunk in r.iter_content(CHUNK_SIZE):
+                    f.write(chunk)
+                    digest.update(chunk)
+                    received += len(chunk)
+                    if on_progress is not None:
+                        on_progress(received, total)
+
+        if checksum and digest.hexdigest() != checksum.lower():
+            os.remove(out_path)
             return False
-        with open(out_path, 'wb') as f:
-            f.write(r.content)
+
+        if use_cache and etag:
+            self.cache.store(cache_key, etag, out_path)
         return True
 
     # check if key is correct to decrypt
@@ -69,10 +255,71 @@ class VaultManager:
         return r.json()['success']
 
     # list files, folders, and locked folders in path
+    # reuses last listing for path when server responds 304 not modified
     def list_path(self, path=None, key=None):
-        r = self.get(path, key)
-        return r.json()
+        with self.listings_lock:
+            cached = self.listings.get((path, key))
+        headers = {'If-None-Match': cached[0]} if cached else None
+        r = self.get(path, key, headers=headers)
+
+        if r.status_code == 304:
+            result = cached[1]
+        else:
+            result = r.json()
+            etag = r.headers.get('ETag')
+            if etag:
+                with self.listings_lock:
+                    self.listings.pop((path, key), None)
+                    self.listings[(path, key)] = (etag, result)
+                    if len(self.listings) > LISTING_CACHE_SIZE:
+                        del self.listings[next(iter(self.listings))]
+
+        # callers may modify listing
+        return copy.deepcopy(result)
 
     # renames a file/folder at path and returns True on success, False on error
     def rename_path(self, path, name, key=None):
         return self.command('rename', path, {'name': name, 'key': key})
+
+
+class AsyncVaultManager:
+    """Awaitable VaultManager, runs requests in a bounded thread pool."""
+
+    def __init__(self, api_key, server_url, **kwargs):
+        self.manager = VaultManager(api_key, server_url, **kwargs)
+        self.executor = get_executor()
+
+    def run(self, fn, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.executor, partial(fn, *args, **kwargs))
+
+    async def add_file(self, path, filename, data, key=None):
+        return await self.run(self.manager.add_file, path, filename, data, key)
+
+    async def create_path(self, path, key=None):
+        return await self.run(self.manager.create_path, path, key)
+
+    async def decrypt_folder(self, path, key):
+        return await self.run(self.manager.decrypt_folder, path, key)
+
+    async def delete_path(self, path, key=None):
+        return await self.run(self.manager.delete_path, path, key)
+
+    async def encrypt_folder(self, path, key):
+        return await self.run(self.manager.encrypt_folder, path, key)
+
+    async def get_extensions(self):
+        return await self.run(self.manager.get_extensions)
+
+    # on_progress is called from a worker thread
+    async def get_file(self, path, key, out_path, on_progress=None, checksum=None):
+        return await self.run(self.manager.get_file, path, key, out_path, on_progress, checksum)
+
+    async def is_key_valid(self, path, key):
+        return await self.run(self.manager.is_key_valid, path, key)
+
+    async def list_path(self, path=None, key=None):
+        return await self.run(self.manager.list_path, path, key)
+
+    async def rename_path(self, path, name, key=None):
+        return await self.run(self.manager.rename_path, path, name, key)
@@ -1,5 +1,16 @@
+import hashlib
+import io
+import itertools
+import json
+import shutil
+import struct
+import tempfile
+import threading
+import weakref
 import zlib
+from collections import OrderedDict
 from dataclasses import dataclass, field
+from functools import partial
 
 from typing import List
 
@@ -8,10 +19,24 @@ from nanome.api.interactions.serializers import InteractionSerializer
 from nanome.api.structure import Workspace
 from nanome.api.structure.serializers import WorkspaceSerializer, AtomSerializer
 from nanome._internal.network.context import ContextSerialization, ContextDeserialization
+from nanome._internal.network.data import Data
 from nanome._internal.serializer_fields import ArrayField, DictionaryField, StringField, ByteField, TypeSerializer, LongField
 
+from .ComplexDelta import apply_delta, canonical_state, extract_delta
+
 # This package uses undocumented network code, in order to reuse already available serialization code
 
+# bytes compressed or decompressed at once when streaming to or from files
+CHUNK_SIZE = 1024 * 1024
+# zlib level for writing, 1 is fastest and 9 is smallest
+COMPRESSION_LEVEL = zlib.Z_DEFAULT_COMPRESSION
+# scene deck container: magic, version, json index, separately compressed complexes and scenes
+# version 2 stores each complex once, scenes reference them with a delta of per scene state
+DECK_MAGIC = b'NANOSCNS'
+DECK_VERSION = 2
+# decoded scenes kept in memory per deck, the selected scene and its neighbours
+SCENE_CACHE_SIZE = 3
+
 workspace_serializer = WorkspaceSerializer()
 string_serializer = StringField()
 dictionary_serializer = DictionaryField()
@@ -77,37 +102,466 @@ scene_list_serializer = ArrayField()
 scene_list_serializer.set_type(scene_serializer)
 
 
-def _write_using_serializer(serializer, data):
+class DeckSceneSerializer(TypeSerializer):
+    """Scene in a version 2 deck, as (scene, deltas). The scene workspace has no
+    complexes, deltas are the per scene state of the complexes it references."""
+
+    def name(self):
+        return "DeckSceneSerializer"
+
+    def version(self):
+        return 0
+
+    def serialize(self, version, value, context):
+        scene, deltas = value
+        context.write_using_serializer(scene_serializer, scene)
+        context.write_using_serializer(string_serializer, json.dumps(deltas))
+
+    def deserialize(self, version, context):
+        scene = context.read_using_serializer(scene_serializer)
+        deltas = json.loads(context.read_using_serializer(string_serializer))
+        return scene, deltas
+
+
+deck_scene_serializer = DeckSceneSerializer()
+
+
+# returns uncompressed serialized data
+def _serialize(serializer, data):
     context = ContextSerialization(0, TypeSerializer.get_version_table())
     context.write_uint(0)  # Version
     context.write_using_serializer(dictionary_serializer, TypeSerializer.get_version_table())
     context.write_using_serializer(serializer, data)
-    return zlib.compress(context.to_array())
-
-
-def _read_using_serializer(serializer, data):
-    data = zlib.decompress(data)
-    context = ContextDeserialization(data, TypeSerializer.get_version_table())
-    context.read_uint()
+    return context.to_array()
+
+
+# serialize data and write it compressed to binary file object f, one chunk at a time
+def _write_using_serializer(serializer, data, f, level=COMPRESSION_LEVEL):
+    _compress(_serialize(serializer, data), f, level)
+
+
+def _compress(array, f, level=COMPRESSION_LEVEL):
+    compressor = zlib.compressobj(level)
+    for start in range(0, len(array), CHUNK_SIZE):
+        f.write(compressor.compress(array[start:start + CHUNK_SIZE]))
+    f.write(compressor.flush())
+
+
+class BufferData(Data):
+    """Read only Data over an existing buffer, without copying it."""
+
+    def __init__(self, buffer):
+        super().__init__()
+        self._received_bytes = memoryview(buffer)
+        self._buffered_bytes = len(self._received_bytes)
+        self._end = self._buffered_bytes
+
+    # nothing to compact, reads are offsets into the view
+    def consume_data(self, size):
+        self._buffered_bytes -= size
+        self._buffered_computed += size
+
+    # return bytes, callers decode them
+    def read_bytes(self, size):
+        return bytes(super().read_bytes(size))
+
+
+class BufferContextDeserialization(ContextDeserialization):
+    """Deserialization context over a buffer, with a version table that can be
+    replaced once the file header has been read."""
+
+    def __init__(self, buffer, version_table):
+        super().__init__(b'')
+        self._data = BufferData(buffer)
+        self.set_version_table(version_table)
+
+    def set_version_table(self, version_table):
+        self.version_table = version_table
+        # serializer -> version, looked up once per serializer instead of per read
+        self.versions = {}
+
+    def read_using_serializer(self, serializer):
+        version = self.versions.get(serializer)
+        if version is None:
+            # field serializers have no name, and are always version 0
+            try:
+                version = self.version_table[serializer.name()]
+            except (AttributeError, KeyError):
+                version = 0
+            self.versions[serializer] = version
+        return serializer.deserialize(version, self)
+
+    def get_version_table(self):
+        return self.version_table
+
+
+# read compressed data from binary file object f, one chunk at a time
+def _decompress(f):
+    decompressor = zlib.decompressobj()
+    data = bytearray()
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+        data += decompressor.decompress(chunk)
+        if decompressor.eof:
+            break
+    data += decompressor.flush()
+    if not decompressor.eof:
+        raise zlib.error('Incomplete or truncated stream')
+    return data
+
+
+def _deserialize(serializer, data):
+    context = BufferContextDeserialization(data, TypeSerializer.get_version_table())
+    context.read_uint()  # Version
     file_version_table = context.read_using_serializer(dictionary_serializer)
-    version_table = TypeSerializer.get_best_version_table(file_version_table)
-    context = ContextDeserialization(data, version_table)
-    context.read_uint()
-    context.read_using_serializer(dictionary_serializer)
+    context.set_version_table(TypeSerializer.get_best_version_table(file_version_table))
     return context.read_using_serializer(serializer)
 
 
-def workspace_to_data(workspace):
-    return _write_using_serializer(vault_workspace_serializer, workspace)
+def _read_using_serializer(serializer, f):
+    return _deserialize(serializer, _decompress(f))
+
+
+# f is a binary file object, level is the zlib compression level
+def workspace_to_file(workspace, f, level=COMPRESSION_LEVEL):
+    _write_using_serializer(vault_workspace_serializer, workspace, f, level)
+
+
+def workspace_from_file(f):
+    return _read_using_serializer(vault_workspace_serializer, f)
+
+
+def workspace_to_data(workspace, level=COMPRESSION_LEVEL):
+    f = io.BytesIO()
+    workspace_to_file(workspace, f, level)
+    return f.getvalue()
 
 
 def workspace_from_data(data):
-    return _read_using_serializer(vault_workspace_serializer, data)
+    return workspace_from_file(io.BytesIO(data))
+
+
+# returns a copy of complex that can be modified without affecting it
+def copy_complex(complex):
+    workspace = Workspace()
+    workspace.complexes = [complex]
+    data = _serialize(vault_workspace_serializer, workspace)
+    return _deserialize(vault_workspace_serializer, data).complexes[0]
+
+
+class CanonicalView:
+    """Shallow copy of a structure for serializing, with attributes in state and
+    attributes replacing those of the structure. The structure is only read,
+    properties of its class are read from it."""
+
+    def __init__(self, structure, state, **attributes):
+        self.__dict__.update(structure.__dict__)
+        self.__dict__.update(state)
+        self.__dict__.update(attributes)
+        self._structure = structure
+
+    def __getattr__(self, name):
+        return getattr(self._structure, name)
+
+
+class SizedIterable:
+    """Iterable of known length, serialized as an array without being stored."""
+
+    def __init__(self, length, iterable):
+        self.length = length
+        self.iterable = iterable
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+
+class AtomIndex:
+    """Reference to an atom of a canonical complex, by its number."""
+    __slots__ = ['_unique_identifier']
+
+    def __init__(self, number):
+        self._unique_identifier = number
+
+
+class CanonicalAtoms(dict):
+    """Atom payload while serializing a canonical complex. Atoms of the complex
+    are written in order from atoms when the payload is written, only atoms from
+    outside the complex are kept when referenced."""
+
+    def __init__(self, atoms, view):
+        super().__init__()
+        self.atoms = atoms
+        self.view = view
+
+    def __setitem__(self, uid, atom):
+        if not isinstance(atom, AtomIndex):
+            super().__setitem__(uid, atom)
+
+    def items(self):
+        views = ((i, self.view(i, atom)) for i, atom in enumerate(self.atoms))
+        outside = super().items()
+        return SizedIterable(len(self.atoms) + len(outside), itertools.chain(views, outside))
+
+
+class CanonicalComplexSerializer:
+    """Writes a complex as vault_workspace_serializer writes a workspace holding
+    apply_delta(copy_complex(complex), {}), with atoms numbered in order.
+
+    Instead of copying, structures are written through views made while
+    serializing, so they are freed as they are written. complex is only read."""
+
+    def serialize(self, version, complex, context):
+        states = {level: canonical_state(level) for level in ('complex', 'molecule', 'chain', 'residue', 'atom', 'bond')}
+        atoms = list(complex.atoms)
+        # atoms are keyed by process unique ids while serializing, number them in order instead
+        numbers = {atom: i for i, atom in enumerate(atoms)}
+
+        def index(atom):
+            number = numbers.get(atom)
+            return atom if number is None else AtomIndex(number)
+
+        def views(structures, view):
+            return SizedIterable(len(structures), map(view, structures))
+
+        def view_atom(number, atom):
+            return CanonicalView(atom, states['atom'], _unique_identifier=number)
+
+        def view_bond(bond):
+            return CanonicalView(bond, states['bond'], _atom1=index(bond._atom1), _atom2=index(bond._atom2))
+
+        def view_residue(residue):
+            residue_atoms = views(residue._atoms, index)
+            bonds = views(residue._bonds, view_bond)
+            return CanonicalView(residue, states['residue'], _atoms=residue_atoms, _bonds=bonds)
+
+        def view_chain(chain):
+            return CanonicalView(chain, states['chain'], _residues=views(chain._residues, view_residue))
+
+        def view_molecule(molecule):
+            return CanonicalView(molecule, states['molecule'], _chains=views(molecule._chains, view_chain))
+
+        molecules = views(complex._molecules, view_molecule)
+        workspace = Workspace()
+        workspace.complexes = [CanonicalView(complex, states['complex'], _molecules=molecules)]
+
+        subcontext = context.create_sub_context()
+        subcontext.payload["Atom"] = CanonicalAtoms(atoms, view_atom)
+        subcontext.write_using_serializer(workspace_serializer, workspace)
+        context.write_using_serializer(atom_dictionary_serializer, subcontext.payload["Atom"])
+        context.write_bytes(subcontext.to_array())
 
 
-def scenes_to_data(scenes):
-    return _write_using_serializer(scene_list_serializer, scenes)
+canonical_complex_serializer = CanonicalComplexSerializer()
+
+
+# returns uncompressed complex without per scene state, equal for complexes that differ only in delta
+# complex is only read, scenes can be saved, hashed and shown from different threads at once
+def _serialize_complex(complex):
+    return _serialize(canonical_complex_serializer, complex)
+
+
+# complex -> content hash, set for complexes decoded from version 2 decks
+_complex_hashes = weakref.WeakKeyDictionary()
+
+
+# returns hash of complex content without per scene state, same as used in version 2 decks
+def complex_hash(complex):
+    return _hash_complex(complex)[0]
+
+
+# returns (hash, serialized complex or None if the hash was known) for complex
+def _hash_complex(complex):
+    digest = _complex_hashes.get(complex)
+    if digest is not None:
+        return digest, None
+    data = _serialize_complex(complex)
+    digest = hashlib.sha256(data).hexdigest()
+    _complex_hashes[complex] = digest
+    return digest, data
+
+
+class LazyScene:
+    """Scene in a SceneDeck, decoded by load when needed.
+
+    name and description come from the deck index, and are applied to the
+    decoded Scene. complexes are the deck complexes the scene references.
+    """
+
+    def __init__(self, deck, offset, size, name="", description="", complexes=None):
+        self.deck = deck
+        self.offset = offset
+        self.size = size
+        self.name = name
+        self.description = description
+        self.complexes = complexes or []
+        self.lock = threading.Lock()
+
+    # returns decoded Scene, blocks while decoding
+    def load(self):
+        return self.deck.load(self)
+
+
+class SceneDeck:
+    """Indexed scene deck file, with scenes decoded on demand.
+
+    The SCENE_CACHE_SIZE most recently loaded scenes are kept in memory.
+    Safe to load from multiple threads.
+    """
+
+    def __init__(self, f, cache_size=SCENE_CACHE_SIZE):
+        if f.read(len(DECK_MAGIC)) != DECK_MAGIC:
+            raise ValueError('Not a scene deck')
+        version, length = struct.unpack('<II', f.read(8))
+        if version > DECK_VERSION:
+            raise ValueError(f'Unsupported scene deck version {version}')
+        header = json.loads(f.read(length))
+
+        self.file = f
+        self.version = version
+        self.start = f.tell()
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        # offset, size and content hash of each complex
+        self.complexes = header.get('complexes', [])
+        self.scenes = [
+            LazyScene(
+                self, entry['offset'], entry['size'], entry['name'],
+                entry['description'], entry.get('complexes'))
+            for entry in header['scenes']]
+
+    # returns compressed data at offset in deck
+    def read_blob(self, offset, size):
+        with self.lock:
+            self.file.seek(self.start + offset)
+            return self.file.read(size)
+
+    def load(self, scene):
+        # one decode per scene when loaded by multiple threads at once
+        with scene.lock:
+            with self.lock:
+                decoded = self.cache.pop(scene, None)
+            if decoded is None:
+                decoded = self.decode(scene)
+            with self.lock:
+                self.cache[scene] = decoded
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+
+        decoded.name = scene.name
+        decoded.description = scene.description
+        return decoded
+
+    def decode(self, scene):
+        blob = io.BytesIO(self.read_blob(scene.offset, scene.size))
+        if self.version < 2:
+            return _read_using_serializer(scene_serializer, blob)
+
+        decoded, deltas = _read_using_serializer(deck_scene_serializer, blob)
+        complexes = []
+        for index, delta in zip(scene.complexes, deltas):
+            entry = self.complexes[index]
+            blob = io.BytesIO(self.read_blob(entry['offset'], entry['size']))
+            complex = _read_using_serializer(vault_workspace_serializer, blob).complexes[0]
+            apply_delta(complex, delta)
+            _complex_hashes[complex] = entry['hash']
+            complexes.append(complex)
+        decoded.workspace.complexes = complexes
+        return decoded
+
+
+# scenes can be Scene or LazyScene, LazyScenes from current version decks are copied without decoding
+# complexes are stored once per deck, identified by hash of their content without per scene state
+def scenes_to_file(scenes, f, level=COMPRESSION_LEVEL):
+    complexes = []
+    hashes = {}
+    index = []
+
+    # scenes and complexes are compressed before the index is known, buffer them on disk
+    with tempfile.TemporaryFile() as blobs:
+        # returns deck index of complex with hash, write(blobs) is called for new complexes
+        def add_complex(digest, write):
+            if digest not in hashes:
+                offset = blobs.tell()
+                write(blobs)
+                hashes[digest] = len(complexes)
+                complexes.append({'hash': digest, 'offset': offset, 'size': blobs.tell() - offset})
+            return hashes[digest]
+
+        # data is the complex serialized while hashing, reused instead of serializing again
+        def write_complex(complex, data, out):
+            if data is None:
+                data = _serialize_complex(complex)
+            _compress(data, out, level)
+
+        for scene in scenes:
+            if isinstance(scene, LazyScene) and scene.deck.version == DECK_VERSION:
+                deck = scene.deck
+                refs = []
+                for i in scene.complexes:
+                    entry = deck.complexes[i]
+                    blob = partial(deck.read_blob, entry['offset'], entry['size'])
+                    refs.append(add_complex(entry['hash'], lambda out: out.write(blob())))
+                offset = blobs.tell()
+                blobs.write(deck.read_blob(scene.offset, scene.size))
+            else:
+                if isinstance(scene, LazyScene):
+                    scene = scene.load()
+                refs = []
+                deltas = []
+                for complex in scene.workspace.complexes:
+                    delta = extract_delta(complex)
+                    digest, data = _hash_complex(complex)
+                    refs.append(add_complex(digest, partial(write_complex, complex, data)))
+                    deltas.append(delta)
+
+                workspace = Workspace()
+                workspace.position = scene.workspace.position
+                workspace.rotation = scene.workspace.rotation
+                workspace.scale = scene.workspace.scale
+                shell = Scene(workspace, scene.name, scene.description, scene.interactions)
+                offset = blobs.tell()
+                _write_using_serializer(deck_scene_serializer, (shell, deltas), blobs, level)
+
+            index.append({
+                'name': scene.name,
+                'description': scene.description,
+                'offset': offset,
+                'size': blobs.tell() - offset,
+                'complexes': refs,
+            })
+
+        header = json.dumps({'complexes': complexes, 'scenes': index}).encode('utf-8')
+        f.write(DECK_MAGIC)
+        f.write(struct.pack('<II', DECK_VERSION, len(header)))
+        f.write(header)
+        blobs.seek(0)
+        shutil.copyfileobj(blobs, f, CHUNK_SIZE)
+
+
+# returns list of LazyScene for indexed decks, or Scene for older decks
+def scenes_from_file(f):
+    start = f.tell()
+    if f.read(len(DECK_MAGIC)) != DECK_MAGIC:
+        # decks saved before the index was added are decoded up front
+        f.seek(start)
+        return _read_using_serializer(scene_list_serializer, f)
+
+    # copied, scenes are read after f is closed
+    deck_file = tempfile.TemporaryFile()
+    f.seek(start)
+    shutil.copyfileobj(f, deck_file, CHUNK_SIZE)
+    deck_file.seek(0)
+    return SceneDeck(deck_file).scenes
+
+
+def scenes_to_data(scenes, level=COMPRESSION_LEVEL):
+    f = io.BytesIO()
+    scenes_to_file(scenes, f, level)
+    return f.getvalue()
 
 
 def scenes_from_data(data):
-    return _read_using_serializer(scene_list_serializer, data)
+    return scenes_from_file(io.BytesIO(data))
@@ -34,6 +34,7 @@ class VaultMenu:
         self.sort_btn = None
         self.sort_by = 'name'
         self.sort_order = 1
+        self.items = None
 
         self.locked_folders = []
         self.locked_path = None
@@ -201,9 +202,10 @@ class VaultMenu:
         self.pending_integration.send_response(False)
         self.integration_complete()
 
-    def integration_save(self, button=None):
+    @async_callback
+    async def integration_save(self, button=None):
         (_, filename, data) = self.pending_integration.get_args()
-        r = self.plugin.vault.add_file(self.path, filename, data, self.folder_key)
+        r = await self.plugin.vault.add_file(self.path, filename, data, self.folder_key)
         self.pending_integration.send_response(r.ok)
         self.integration_complete()
 
@@ -220,9 +222,15 @@ class VaultMenu:
             path = path.replace(self.plugin.org, org_folder)
         return path
 
-    def update(self):
+    @async_callback
+    async def update(self):
+        path = self.path
+        items = await self.plugin.vault.list_path(path + '/', self.folder_key)
+        # skip stale listing if folder changed while waiting
+        if path != self.path:
+            return
+
         self.selected_items.clear()
-        items = self.plugin.vault.list_path(self.path + '/', self.folder_key)
         at_root = self.path == '.'
 
         if at_root:
@@ -245,6 +253,7 @@ class VaultMenu:
                 'created_text': '',
             })
 
+        self.items = items
         self.update_crumbs()
         self.update_explorer(items)
         self.update_controls()
@@ -421,13 +430,15 @@ class VaultMenu:
         if self.path[:2] == '..':
             self.path = '.'
 
+        self.items = None
         self.update()
 
-    def open_locked_folder(self, button=None):
+    @async_callback
+    async def open_locked_folder(self, button=None):
         key = self.inp_unlock.input_text
         path = os.path.join(self.path, self.folder_to_unlock)
 
-        if self.plugin.vault.is_key_valid(path, key):
+        if await self.plugin.vault.is_key_valid(path, key):
             self.folder_key = key
             self.open_folder(self.folder_to_unlock)
             self.cancel_open_locked()
@@ -448,20 +459,25 @@ class VaultMenu:
         n = len(self.selected_items)
         self.lst_files.parent.enabled = False
         self.lbl_loading.parent.enabled = True
-        self.lbl_loading.text_value = f'loading...\n{n} item{"s" if n > 1 else ""}'
+        self.lbl_loading.text_value = f'loading...\n0/{n} item{"s" if n > 1 else ""}'
         self.plugin.update_node(self.ln_explorer)
 
+        def on_progress(completed, total):
+            self.lbl_loading.text_value = f'loading...\n{completed}/{total} item{"s" if total > 1 else ""}'
+            self.plugin.update_content(self.lbl_loading)
+
         load_items = []
         for btn in self.selected_items:
             load_items.append(btn.item_name)
             btn.selected = False
-        await self.plugin.load_files(load_items)
-
-        self.selected_items = []
-        self.lst_files.parent.enabled = True
-        self.lbl_loading.parent.enabled = False
-        self.update_controls()
-        self.plugin.update_menu(self.menu)
+        try:
+            await self.plugin.load_files(load_items, on_progress)
+        finally:
+            self.selected_items = []
+            self.lst_files.parent.enabled = True
+            self.lbl_loading.parent.enabled = False
+            self.update_controls()
+            self.plugin.update_menu(self.menu)
 
     def on_action_pressed(self, button):
         if button.name == 'Open Website':
@@ -513,28 +529,29 @@ class VaultMenu:
         self.ln_actions_dialog.enabled = False
         self.plugin.update_node(self.ln_actions_panel)
 
-    def on_action_confirm(self, button):
+    @async_callback
+    async def on_action_confirm(self, button):
         inp_text = self.ln_actions_dialog.find_node('Input').get_content().input_text
         key = self.folder_key
 
         if self.pending_action == 'New Folder':
-            self.plugin.vault.create_path(f'{self.path}/{inp_text}', key)
+            await self.plugin.vault.create_path(f'{self.path}/{inp_text}', key)
 
         elif self.pending_action == 'Rename':
             name = self.selected_items[0].item_name
             ext = name.split('.')[-1]
             new_name = inp_text + '.' + ext
-            self.plugin.vault.rename_path(f'{self.path}/{name}', new_name, key)
+            await self.plugin.vault.rename_path(f'{self.path}/{name}', new_name, key)
 
         elif self.pending_action == 'Delete':
             for item in self.selected_items:
-                self.plugin.vault.delete_path(f'{self.path}/{item.item_name}', key)
+                await self.plugin.vault.delete_path(f'{self.path}/{item.item_name}', key)
 
         elif self.pending_action == 'Rename Folder':
-            self.plugin.vault.rename_path(self.path, inp_text, key)
+            await self.plugin.vault.rename_path(self.path, inp_text, key)
 
         elif self.pending_action == 'Delete Folder':
-            self.plugin.vault.delete_path(self.path, key)
+            await self.plugin.vault.delete_path(self.path, key)
 
         self.toggle_actions()
 
@@ -583,7 +600,15 @@ class VaultMenu:
             button.icon.active = True
 
         self.plugin.update_content(self.sort_btn)
-        self.update()
+
+        if self.items is None:
+            self.update()
+            return
+
+        # re-sort last listing locally
+        self.selected_items.clear()
+        self.update_explorer(self.items)
+        self.update_controls()
 
     def select_all(self, button):
         if self.selected_items:
@@ -746,7 +771,8 @@ class VaultMenu:
         self.lbl_upload_confirm.text_value = f'upload {self.upload_name}.{self.upload_ext}?'
         self.plugin.update_menu(self.menu)
 
-    def confirm_upload(self, button):
-        self.plugin.save_file(self.upload_item, self.upload_name, self.upload_ext)
+    @async_callback
+    async def confirm_upload(self, button):
+        await self.plugin.save_file(self.upload_item, self.upload_name, self.upload_ext)
         self.toggle_upload(show=False)
         self.update()
@@ -0,0 +1,68 @@
+// Compares folder sizes from `du -sk` with the size index, on a synthetic tree
+// of 100k files: 10 x 10 folders of 1,000 files each.
+// Run from the server folder: node bench/size-index.js
+const { execSync } = require('child_process')
+const fs = require('fs')
+const os = require('os')
+const ospath = require('path')
+const { performance } = require('perf_hooks')
+
+const SizeIndex = require('../src/services/size-index')
+
+const FOLDERS = 10
+const FILES = 1000
+const LOOKUPS = 100000
+
+const time = fn => {
+  const start = performance.now()
+  const result = fn()
+  return [result, performance.now() - start]
+}
+
+const makeTree = root => {
+  for (let i = 0; i < FOLDERS; i++) {
+    for (let j = 0; j < FOLDERS; j++) {
+      const dir = ospath.join(root, `${i}`, `${j}`)
+      fs.mkdirSync(dir, { recursive: true })
+      for (let k = 0; k < FILES; k++) {
+        fs.writeFileSync(ospath.join(dir, `${k}.pdb`), 'x'.repeat(k % 100))
+      }
+    }
+  }
+}
+
+const du = path => +execSync(`du -sk "${path}"`).toString().split('\t')[0]
+
+const main = async () => {
+  const root = fs.mkdtempSync(ospath.join(os.tmpdir(), 'size-index-bench-'))
+  try {
+    console.log(`creating ${FOLDERS * FOLDERS * FILES} files...`)
+    makeTree(root)
+    const folder = ospath.join(root, '0')
+
+    const [, duFolder] = time(() => du(folder))
+    const [, duTree] = time(() => du(root))
+    console.log(`du -sk: ${duFolder.toFixed(1)}ms per ${FOLDERS * FILES} file folder, ${duTree.toFixed(1)}ms for the tree`)
+
+    const [, build] = time(() => SizeIndex.getSize(root))
+    const [, lookups] = time(() => {
+      for (let i = 0; i < LOOKUPS; i++) SizeIndex.getSize(folder)
+    })
+    const start = performance.now()
+    await SizeIndex.reconcile(root)
+    const reconcile = performance.now() - start
+    console.log(
+      `size index: build ${build.toFixed(0)}ms, lookup ${((lookups * 1000) / LOOKUPS).toFixed(2)}us, ` +
+        `background reconcile ${reconcile.toFixed(0)}ms`
+    )
+
+    const file = ospath.join(folder, 'new.pdb')
+    fs.writeFileSync(file, 'x'.repeat(1000))
+    const [, add] = time(() => SizeIndex.addFile(file))
+    console.log(`addFile update: ${(add * 1000).toFixed(1)}us`)
+  } finally {
+    fs.rmSync(root, { recursive: true })
+  }
+}
+
+main()
@@ -1,4 +1,5 @@
 const express = require('express')
+const { pipeline } = require('stream')
 const router = express.Router()
 
 const config = require('@/config')
@@ -27,12 +28,26 @@ router.get('/files(/*)?', auth, (req, res) => {
 
   const isFile = /\.[^/]+$/.test(path)
   if (!isFile) {
-    const result = Vault.listPath(path)
-    return res.success(result)
+    res.set('ETag', Vault.getListTag(path))
+    if (req.fresh) return res.status(304).end()
+    return res.success(Vault.listPath(path))
   }
 
-  const data = Vault.getFile(path, key)
-  return res.send(data)
+  // cheap validator so clients can revalidate cached files without a download
+  res.set('ETag', Vault.getFileTag(path))
+  if (req.fresh) return res.status(304).end()
+
+  // stream files so they don't need to fit in memory
+  res.type('application/octet-stream')
+  if (key !== undefined) {
+    return pipeline(Vault.getFileStream(path, key), res, () => {})
+  }
+
+  // checksum is sent when known from upload or an earlier download
+  const { stream, size, checksum } = Vault.openFile(path)
+  res.set('Content-Length', size)
+  if (checksum) res.set('X-Content-SHA256', checksum)
+  return pipeline(stream, res, () => {})
 })
 
 router.post(
@@ -102,7 +117,7 @@ router.post(
       case 'upload-init':
         if (!name) throw new HTTPError(400, 'Missing arg: "name"')
         if (!req.fields.size) throw new HTTPError(400, 'Missing arg: "size"')
-        const id = Upload.initUpload(path, name, key, req.fields.size)
+        const id = Upload.initUpload(path, name, key, +req.fields.size)
         return res.success({ id })
 
       case 'upload-cancel':
@@ -110,6 +125,12 @@ router.post(
         Upload.cancelUpload(req.fields.id)
         break
 
+      case 'upload-status':
+        if (!req.fields.id) throw new HTTPError(400, 'Missing arg: "id"')
+        if (!name) throw new HTTPError(400, 'Missing arg: "name"')
+        const offset = Upload.getUploadOffset(req.fields.id, name)
+        return res.success({ offset })
+
       case 'upload-chunk':
         let { chunk } = req.files
         if (!chunk || Array.isArray(chunk)) {
@@ -1,17 +1,56 @@
 const crypto = require('crypto')
+const { Transform } = require('stream')
 
 const ALGORITHM = 'aes-256-cbc'
 const BLOCK_SIZE = 16
 const HASH_ITERS = 8192
 
+// derived keys are cached to avoid rehashing on every request
+const KEY_CACHE_SIZE = 100
+const KEY_CACHE_TTL = 10 * 60 * 1000
+// random per process so cache ids can't be used to check passwords
+const KEY_CACHE_SALT = crypto.randomBytes(32)
+const KEY_CACHE = new Map()
+
 // brute force protection, key is hashed many times
-const getKey = key => {
+const hashKey = key => {
   for (let i = 0; i < HASH_ITERS; i++) {
     key = crypto.createHash('sha256').update(key).digest()
   }
   return key
 }
 
+// returns derived key for password, cached by salted hash of (password, scope)
+// scope is the encryption root the password unlocks
+const getKey = (key, scope = '') => {
+  // already derived
+  if (Buffer.isBuffer(key)) return key
+
+  const id = crypto
+    .createHmac('sha256', KEY_CACHE_SALT)
+    .update(`${scope}\0${key}`)
+    .digest('base64')
+
+  const now = Date.now()
+  const cached = KEY_CACHE.get(id)
+  KEY_CACHE.delete(id)
+  if (cached && cached.expires > now) {
+    // reinsert to mark as most recently used
+    KEY_CACHE.set(id, cached)
+    return cached.key
+  }
+
+  const derived = hashKey(key)
+  KEY_CACHE.set(id, { key: derived, expires: now + KEY_CACHE_TTL })
+  if (KEY_CACHE.size > KEY_CACHE_SIZE) {
+    KEY_CACHE.delete(KEY_CACHE.keys().next().value)
+  }
+  return derived
+}
+
+exports.deriveKey = getKey
+
+// key can be a password or a key from deriveKey
 exports.encrypt = (data, key) => {
   const iv = crypto.randomBytes(BLOCK_SIZE)
   const cipher = crypto.createCipheriv(ALGORITHM, getKey(key), iv)
@@ -24,3 +63,57 @@ exports.decrypt = (data, key) => {
   const decipher = crypto.createDecipheriv(ALGORITHM, getKey(key), iv)
   return Buffer.concat([decipher.update(data), decipher.final()])
 }
+
+// streaming encrypt, output is IV followed by ciphertext, same as encrypt
+class EncryptStream extends Transform {
+  constructor(key) {
+    super()
+    const iv = crypto.randomBytes(BLOCK_SIZE)
+    this.cipher = crypto.createCipheriv(ALGORITHM, getKey(key), iv)
+    this.push(iv)
+  }
+
+  _transform(chunk, encoding, callback) {
+    callback(null, this.cipher.update(chunk))
+  }
+
+  _flush(callback) {
+    callback(null, this.cipher.final())
+  }
+}
+
+// streaming decrypt of IV-prefixed ciphertext, same as decrypt
+class DecryptStream extends Transform {
+  constructor(key) {
+    super()
+    this.key = getKey(key)
+    this.iv = Buffer.alloc(0)
+    this.decipher = null
+  }
+
+  _transform(chunk, encoding, callback) {
+    if (!this.decipher) {
+      this.iv = Buffer.concat([this.iv, chunk])
+      if (this.iv.length < BLOCK_SIZE) return callback()
+
+      chunk = this.iv.slice(BLOCK_SIZE)
+      this.iv = this.iv.slice(0, BLOCK_SIZE)
+      this.decipher = crypto.createDecipheriv(ALGORITHM, this.key, this.iv)
+    }
+    callback(null, this.decipher.update(chunk))
+  }
+
+  _flush(callback) {
+    if (!this.decipher) {
+      return callback(new Error('Invalid encrypted data'))
+    }
+    try {
+      callback(null, this.decipher.final())
+    } catch (e) {
+      callback(e)
+    }
+  }
+}
+
+exports.createEncryptStream = key => new EncryptStream(key)
+exports.createDecryptStream = key => new DecryptStream(key)
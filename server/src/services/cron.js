@@ -4,6 +4,7 @@ const ospath = require('path')
 const walk = require('@nodelib/fs.walk')
 const config = require('@/config')
 const auth = require('@/utils/auth')
+const SizeIndex = require('@/services/size-index')
 const Vault = require('@/services/vault-manager')
 
 const WALK_SETTINGS = new walk.Settings({
@@ -31,11 +32,17 @@ const fileCleanup = () => {
   const files = walk.walkSync(Vault.FILES_DIR, WALK_SETTINGS)
   for (const file of files) {
     if (file.stats.atime < expiryTime) {
+      SizeIndex.remove(file.path)
       fs.removeSync(file.path)
     }
   }
 }
 
+// rebuild folder size index to correct drift from changes made outside vault
+const sizeIndexReconcile = () => {
+  SizeIndex.reconcile(Vault.FILES_DIR).catch(console.error)
+}
+
 // remove abandoned uploads older than 10 min
 const uploadCleanup = () => {
   const expiryTime = new Date()
@@ -56,6 +63,10 @@ exports.init = () => {
   cron.schedule('*/10 * * * *', authCleanup)
   cron.schedule('*/10 * * * *', uploadCleanup)
 
+  // build size index at startup, then reconcile every hour
+  sizeIndexReconcile()
+  cron.schedule('30 * * * *', sizeIndexReconcile)
+
   if (config.KEEP_FILES_DAYS) {
     // run every hour
     cron.schedule('0 * * * *', fileCleanup)
@@ -0,0 +1,153 @@
+const fs = require('fs-extra')
+const ospath = require('path')
+const { promisify } = require('util')
+const walk = require('@nodelib/fs.walk')
+
+// walk settings to find all files, including lock files
+const WALK_SETTINGS = new walk.Settings({
+  entryFilter: e => e.dirent.isFile(),
+  stats: true
+})
+
+const walkAsync = promisify(walk.walk)
+
+// directory path -> total bytes of all files under it
+let SIZES = new Map()
+// paths changed while reconcile walks the tree, null when not reconciling
+let CHANGED = null
+
+// returns map of dir and all its subdirs to total size of files under them
+const computeSizes = (dir, files) => {
+  const sizes = new Map([[dir, 0]])
+  for (const file of files) {
+    let parent = ospath.dirname(file.path)
+    while (true) {
+      sizes.set(parent, (sizes.get(parent) || 0) + file.stats.size)
+      if (parent === dir) break
+      parent = ospath.dirname(parent)
+    }
+  }
+  return sizes
+}
+
+// adds delta bytes to all indexed folders containing path
+const update = (path, delta) => {
+  if (CHANGED) CHANGED.add(path)
+  if (!delta) return
+
+  let parent = ospath.dirname(path)
+  while (true) {
+    if (SIZES.has(parent)) {
+      SIZES.set(parent, SIZES.get(parent) + delta)
+    }
+    const next = ospath.dirname(parent)
+    if (next === parent) break
+    parent = next
+  }
+}
+
+// removes index entries for dir and all its subdirs
+const drop = dir => {
+  if (CHANGED) CHANGED.add(dir)
+  const prefix = dir + ospath.sep
+  for (const key of SIZES.keys()) {
+    if (key === dir || key.startsWith(prefix)) {
+      SIZES.delete(key)
+    }
+  }
+}
+
+// returns total size of files under dir, indexing it on first access
+exports.getSize = dir => {
+  if (SIZES.has(dir)) return SIZES.get(dir)
+  if (!fs.existsSync(dir)) return 0
+
+  const files = walk.walkSync(dir, WALK_SETTINGS)
+  const sizes = computeSizes(dir, files)
+  for (const [key, size] of sizes) {
+    SIZES.set(key, size)
+  }
+  return sizes.get(dir)
+}
+
+// returns size of file or folder at path
+const sizeOf = path => {
+  const stats = fs.statSync(path)
+  return stats.isDirectory() ? exports.getSize(path) : stats.size
+}
+
+// call after file at path is written, with its previous size if overwritten
+exports.addFile = (path, oldSize = 0) => {
+  update(path, fs.statSync(path).size - oldSize)
+}
+
+// call before file or folder at path is removed
+exports.remove = path => {
+  if (!fs.existsSync(path)) return
+  update(path, -sizeOf(path))
+  drop(path)
+}
+
+// call after file or folder at oldPath is renamed to newPath
+exports.move = (oldPath, newPath) => {
+  if (CHANGED) CHANGED.add(oldPath).add(newPath)
+  const prefix = oldPath + ospath.sep
+  for (const [key, size] of Array.from(SIZES)) {
+    if (key === oldPath || key.startsWith(prefix)) {
+      SIZES.delete(key)
+      SIZES.set(newPath + key.slice(oldPath.length), size)
+    }
+  }
+
+  const size = sizeOf(newPath)
+  update(oldPath, -size)
+  update(newPath, size)
+}
+
+// call after files in dir are rewritten in place, e.g. encrypted
+exports.refresh = dir => {
+  const oldSize = exports.getSize(dir)
+  drop(dir)
+  update(dir, exports.getSize(dir) - oldSize)
+}
+
+// returns true if path is one of paths or under one of them
+const isUnder = (path, paths) => {
+  while (true) {
+    if (paths.has(path)) return true
+    const parent = ospath.dirname(path)
+    if (parent === path) return false
+    path = parent
+  }
+}
+
+// rebuild index from disk in background, correcting any drift
+exports.reconcile = async root => {
+  CHANGED = new Set()
+  let files, changed
+  try {
+    files = await walkAsync(root, WALK_SETTINGS)
+  } finally {
+    changed = CHANGED
+    CHANGED = null
+  }
+
+  // paths changed during the walk may have been read before or after the change,
+  // read them again now, without yielding, so no change is missed or counted twice
+  const prefix = root + ospath.sep
+  const paths = new Set(
+    Array.from(changed).filter(p => p.startsWith(prefix) && !isUnder(ospath.dirname(p), changed))
+  )
+  files = files.filter(file => !isUnder(file.path, paths))
+  for (const path of paths) {
+    if (!fs.existsSync(path)) continue
+    const stats = fs.statSync(path)
+    if (stats.isDirectory()) {
+      files.push(...walk.walkSync(path, WALK_SETTINGS))
+    } else {
+      files.push({ path, stats })
+    }
+  }
+
+  SIZES = computeSizes(root, files)
+}
@@ -7,6 +7,21 @@ const config = require('@/config')
 const Vault = require('@/services/vault-manager')
 const { HTTPError } = require('@/utils/error')
 
+const UPLOAD_ID = /^[0-9a-z]{16}$/
+// written when an upload is finalized, so retries after a lost response see it completed
+const DONE_FILE = '.done'
+
+// returns folder of upload id and path of filename in it, both from the request
+const getUploadPaths = (id, filename) => {
+  if (!UPLOAD_ID.test(id)) throw new HTTPError(400, 'Invalid upload')
+
+  const isName = ospath.basename(filename) === filename && !filename.startsWith('.')
+  if (!isName) throw new HTTPError(400, 'Invalid file name')
+
+  const dir = ospath.join(Vault.UPLOADS_DIR, id)
+  return [dir, ospath.join(dir, filename)]
+}
+
 const initUpload = (path, filename, key, size) => {
   Vault.checkStorageLimit(path, size)
 
@@ -14,18 +29,35 @@ const initUpload = (path, filename, key, size) => {
     Math.floor(Math.random() * 36).toString(36)
   ).join('')
 
-  const dir = ospath.join(Vault.UPLOADS_DIR, id)
+  const [dir, filepath] = getUploadPaths(id, filename)
   fs.mkdirsSync(dir)
   fs.writeFileSync(ospath.join(dir, '.vinfo'), JSON.stringify({ path, key }))
-  fs.writeFileSync(ospath.join(dir, filename), '')
+  fs.writeFileSync(filepath, '')
   return id
 }
 
 const cancelUpload = id => {
+  if (!UPLOAD_ID.test(id)) throw new HTTPError(400, 'Invalid upload')
   const dir = ospath.join(Vault.UPLOADS_DIR, id)
   fs.removeSync(dir)
 }
 
+// returns number of bytes received so far, used to resume failed uploads
+// completed uploads return their full size
+const getUploadOffset = (id, filename) => {
+  const [dir, filepath] = getUploadPaths(id, filename)
+
+  const donePath = ospath.join(dir, DONE_FILE)
+  if (fs.existsSync(donePath)) {
+    return JSON.parse(fs.readFileSync(donePath, 'utf8')).size
+  }
+
+  if (!fs.existsSync(filepath)) {
+    throw new HTTPError(400, 'Invalid upload')
+  }
+  return fs.statSync(filepath).size
+}
+
 const uploadChunk = async (headers, chunk) => {
   const id = headers['x-upload-id']
   if (!id) throw new HTTPError(400, 'Missing header: "X-Upload-Id"')
@@ -33,8 +65,7 @@ const uploadChunk = async (headers, chunk) => {
   const filename = headers['x-file-name']
   if (!filename) throw new HTTPError(400, 'Missing header: "X-File-Name"')
 
-  const dir = ospath.join(Vault.UPLOADS_DIR, id)
-  const filepath = ospath.join(dir, filename)
+  const [dir, filepath] = getUploadPaths(id, filename)
   if (!fs.existsSync(filepath)) {
     throw new HTTPError(400, 'Invalid upload')
   }
@@ -61,7 +92,11 @@ const uploadChunk = async (headers, chunk) => {
     const vinfo = fs.readFileSync(ospath.join(dir, '.vinfo'), 'utf8')
     const { path, key } = JSON.parse(vinfo)
     await finalizeUpload(filename, filepath, path, key)
-    fs.removeSync(dir)
+
+    // keep only the marker, removed with abandoned uploads
+    fs.removeSync(filepath)
+    fs.removeSync(ospath.join(dir, '.vinfo'))
+    fs.writeFileSync(ospath.join(dir, DONE_FILE), JSON.stringify({ size: total }))
   }
 }
 
@@ -72,15 +107,19 @@ const finalizeUpload = async (filename, filepath, path, key) => {
   const base = split.join('.')
   name = `${base}.${ext}`
 
+  // stream file into vault, encrypting if key
+  if (!Vault.EXTENSIONS.converted.includes(ext)) {
+    await Vault.addFileFromPath(path, name, filepath, key)
+    return
+  }
+
   let data = fs.readFileSync(filepath)
-  if (Vault.EXTENSIONS.converted.includes(ext)) {
-    const body = new FormData()
-    body.append('files', data, name)
+  const body = new FormData()
+  body.append('files', data, name)
 
-    const url = config.CONVERTER_URL + '/convert/office'
-    data = await fetch(url, { method: 'POST', body }).then(res => res.buffer())
-    name = base + '.pdf'
-  }
+  const url = config.CONVERTER_URL + '/convert/office'
+  data = await fetch(url, { method: 'POST', body }).then(res => res.buffer())
+  name = base + '.pdf'
 
   if (data) {
     Vault.addFile(path, name, data, key)
@@ -90,6 +129,7 @@ const finalizeUpload = async (filename, filepath, path, key) => {
 module.exports = {
   initUpload,
   cancelUpload,
+  getUploadOffset,
   uploadChunk,
   finalizeUpload
 }
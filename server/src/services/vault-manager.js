@@ -1,12 +1,15 @@
+const crypto = require('crypto')
 const fs = require('fs-extra')
 const moment = require('moment')
 const os = require('os')
 const ospath = require('path')
+const { Transform } = require('stream')
+const { pipeline } = require('stream/promises')
 const walk = require('@nodelib/fs.walk')
 
 const aes = require('./aes-cipher')
+const SizeIndex = require('./size-index')
 const config = require('@/config')
-const du = require('@/utils/du')
 const { HTTPError } = require('@/utils/error')
 
 // walk settings to find all files not starting with '.'
@@ -22,6 +25,11 @@ fs.ensureDirSync(UPLOADS_DIR)
 const SHARED_DIR = ospath.join(FILES_DIR, 'shared')
 fs.ensureDirSync(SHARED_DIR)
 
+// full path -> { version, checksum } of unencrypted files, sha256 of contents
+// computed on upload or on the first full download, valid while version matches
+const CHECKSUMS = new Map()
+const CHECKSUM_CACHE_SIZE = 100000
+
 // prettier-ignore
 exports.EXTENSIONS = {
   supported: ['pdb', 'sdf', 'cif', 'pdf', 'png', 'jpg', 'nanome', 'nanoscenes', 'nanosr', 'lua', 'obj'],
@@ -35,14 +43,9 @@ exports.ALL_EXTENSIONS = [].concat(...Object.values(exports.EXTENSIONS))
 exports.FILES_DIR = FILES_DIR
 exports.UPLOADS_DIR = UPLOADS_DIR
 
-// add data to vault at path/filename, where filename can contain a path
-exports.addFile = (path, filename, data, key) => {
-  exports.checkStorageLimit(path, data.length)
-
-  if (key !== undefined) {
-    data = aes.encrypt(data, key)
-  }
-
+// returns free file path for path/filename, creating folders and an empty file
+// to reserve it. filename can contain a path
+const reserveFilePath = (path, filename) => {
   // create folder paths
   path = exports.getVaultPath(path, false)
   const subFolder = ospath.join(path, ospath.dirname(filename))
@@ -58,7 +61,64 @@ exports.addFile = (path, filename, data, key) => {
     filePath = `${dir}${name} (${++copy})${ext}`
   }
 
+  fs.writeFileSync(filePath, '')
+  return filePath
+}
+
+// returns version of file contents from its size and modified time
+const fileVersion = stats => `${stats.size}-${stats.mtimeMs}`
+
+// remember checksum of file at filePath, if it still has version
+const storeChecksum = (filePath, version, checksum) => {
+  try {
+    if (fileVersion(fs.statSync(filePath)) !== version) return
+  } catch (e) {
+    return
+  }
+
+  CHECKSUMS.delete(filePath)
+  CHECKSUMS.set(filePath, { version, checksum })
+  if (CHECKSUMS.size > CHECKSUM_CACHE_SIZE) {
+    CHECKSUMS.delete(CHECKSUMS.keys().next().value)
+  }
+}
+
+// add data to vault at path/filename, where filename can contain a path
+exports.addFile = (path, filename, data, key) => {
+  exports.checkStorageLimit(path, data.length)
+
+  let checksum = null
+  if (key !== undefined) {
+    data = aes.encrypt(data, exports.getKey(path, key))
+  } else {
+    checksum = crypto.createHash('sha256').update(data).digest('hex')
+  }
+
+  const filePath = reserveFilePath(path, filename)
   fs.writeFileSync(filePath, data)
+  SizeIndex.addFile(filePath)
+  if (checksum) {
+    storeChecksum(filePath, fileVersion(fs.statSync(filePath)), checksum)
+  }
+}
+
+// move file at srcPath into vault at path/filename, streaming through cipher if key
+exports.addFileFromPath = async (path, filename, srcPath, key) => {
+  exports.checkStorageLimit(path, fs.statSync(srcPath).size)
+
+  const filePath = reserveFilePath(path, filename)
+  if (key === undefined) {
+    const hash = crypto.createHash('sha256')
+    for await (const chunk of fs.createReadStream(srcPath)) {
+      hash.update(chunk)
+    }
+    fs.moveSync(srcPath, filePath, { overwrite: true })
+    storeChecksum(filePath, fileVersion(fs.statSync(filePath)), hash.digest('hex'))
+  } else {
+    const cipher = aes.createEncryptStream(exports.getKey(path, key))
+    await pipeline(fs.createReadStream(srcPath), cipher, fs.createWriteStream(filePath))
+  }
+  SizeIndex.addFile(filePath)
 }
 
 // throws error if size exceeds user storage limit
@@ -66,7 +126,7 @@ exports.checkStorageLimit = (path, size) => {
   const match = /^(user-[0-9a-f]{8})/.exec(path)
   if (match && config.USER_STORAGE) {
     const userPath = exports.getVaultPath(match[1], false)
-    if (du(userPath) + size > config.USER_STORAGE) {
+    if (SizeIndex.getSize(userPath) + size > config.USER_STORAGE) {
       const msg = `User storage exceeded (max ${config.USER_STORAGE_MSG})`
       throw new HTTPError(413, msg)
     }
@@ -101,6 +161,7 @@ exports.decryptFolder = (path, key) => {
   }
 
   // decrypt all files not starting with '.'
+  key = exports.getKey(path, key)
   const files = walk.walkSync(path, WALK_SETTINGS)
   for (const file of files) {
     const data = fs.readFileSync(file.path)
@@ -110,6 +171,7 @@ exports.decryptFolder = (path, key) => {
   // remove lock file
   const lock = ospath.join(path, '.locked')
   fs.removeSync(lock)
+  SizeIndex.refresh(path)
 }
 
 // deletes a path
@@ -119,6 +181,7 @@ exports.deletePath = path => {
   }
 
   path = exports.getVaultPath(path)
+  SizeIndex.remove(path)
   fs.removeSync(path)
 }
 
@@ -139,6 +202,7 @@ exports.encryptFolder = (path, key) => {
   }
 
   // encrypt all files not starting with '.'
+  key = aes.deriveKey(key, ospath.resolve(path))
   const files = walk.walkSync(path, WALK_SETTINGS)
   for (const file of files) {
     const data = fs.readFileSync(file.path)
@@ -149,18 +213,76 @@ exports.encryptFolder = (path, key) => {
   const lock = ospath.join(path, '.locked')
   const data = aes.encrypt(LOCK_TEXT, key)
   fs.writeFileSync(lock, data)
+  SizeIndex.refresh(path)
 }
 
-// returns file data of path, decrypted with key if exists
-exports.getFile = (path, key) => {
+// returns stream of file data at path, decrypted with key
+exports.getFileStream = (path, key) => {
   path = exports.getVaultPath(path)
-  let data = fs.readFileSync(path)
+  const decipher = aes.createDecryptStream(exports.getKey(path, key))
+  return fs.createReadStream(path).on('error', e => decipher.destroy(e)).pipe(decipher)
+}
 
-  if (key !== undefined) {
-    data = exports.decryptData(data, key)
+// returns stream of unencrypted file at path, its size, and its sha256 checksum if known
+// unknown checksums are computed while streaming, for later requests
+exports.openFile = path => {
+  const filePath = exports.getVaultPath(path)
+  const stats = fs.statSync(filePath)
+  const version = fileVersion(stats)
+  const known = CHECKSUMS.get(filePath)
+  const checksum = known && known.version === version ? known.checksum : null
+
+  const stream = fs.createReadStream(filePath)
+  if (checksum) return { stream, size: stats.size, checksum }
+
+  const hash = crypto.createHash('sha256')
+  const hasher = new Transform({
+    transform(chunk, encoding, callback) {
+      hash.update(chunk)
+      callback(null, chunk)
+    },
+    flush(callback) {
+      storeChecksum(filePath, version, hash.digest('hex'))
+      callback()
+    }
+  })
+  stream.on('error', e => hasher.destroy(e)).pipe(hasher)
+  return { stream: hasher, size: stats.size, checksum: null }
+}
+
+// returns ETag for listPath(path) from names, sizes and modified times of its entries,
+// without building the listing, so unchanged folders are answered with 304 cheaply
+exports.getListTag = path => {
+  path = exports.getVaultPath(path)
+  const hash = crypto.createHash('sha1')
+  hash.update(`${exports.getLockedPath(path)}\0`)
+
+  // root lists only 'shared' folder
+  const items = path === FILES_DIR ? [] : fs.readdirSync(path).sort()
+  for (const item of items) {
+    if (item.startsWith('.')) continue
+    const itemPath = ospath.join(path, item)
+    const stats = fs.statSync(itemPath)
+    const isDir = stats.isDirectory()
+    const size = isDir ? SizeIndex.getSize(itemPath) : stats.size
+    const locked = isDir && fs.existsSync(ospath.join(itemPath, '.locked'))
+    hash.update(`${item}\0${isDir}\0${size}\0${stats.mtimeMs}\0${locked}\0`)
   }
 
-  return data
+  return `"${hash.digest('base64')}"`
+}
+
+// returns ETag for file at path derived from its size and modified time
+exports.getFileTag = path => {
+  const stats = fs.statSync(exports.getVaultPath(path))
+  return `"${stats.size}-${stats.mtimeMs}"`
+}
+
+// returns derived key for password, cached per encryption root of path
+exports.getKey = (path, key) => {
+  const lockedPath = exports.getLockedPath(path)
+  const scope = lockedPath ? ospath.resolve(FILES_DIR, lockedPath) : ''
+  return aes.deriveKey(key, scope)
 }
 
 // return encryption root of path, or null if not encrypted
@@ -201,7 +323,7 @@ exports.isKeyValid = (path, key) => {
   try {
     const lock = ospath.join(FILES_DIR, path, '.locked')
     const enc = fs.readFileSync(lock)
-    const dec = aes.decrypt(enc, key)
+    const dec = aes.decrypt(enc, aes.deriveKey(key, ospath.resolve(FILES_DIR, path)))
     return dec.toString() === LOCK_TEXT
   } catch (e) {
     return false
@@ -256,7 +378,7 @@ exports.listPath = path => {
     const stats = fs.statSync(itemPath)
     const isDir = stats.isDirectory()
 
-    const bytes = isDir ? du(itemPath) : stats.size
+    const bytes = isDir ? SizeIndex.getSize(itemPath) : stats.size
     const power = bytes && Math.floor(Math.log(bytes) / Math.log(1024))
     const unit = ['B', 'KB', 'MB', 'GB'][power]
     const size = `${(bytes / 1024 ** power).toFixed(1)}${unit}`
@@ -294,6 +416,7 @@ exports.movePath = (path, folder) => {
   }
 
   fs.renameSync(oldPath, newPath)
+  SizeIndex.move(oldPath, newPath)
 }
 
 // renames a file/folder at path
@@ -307,4 +430,5 @@ exports.renamePath = (path, name) => {
   }
 
   fs.renameSync(oldPath, newPath)
+  SizeIndex.move(oldPath, newPath)
 }
@@ -0,0 +1,129 @@
+const assert = require('assert')
+const fs = require('fs')
+const os = require('os')
+const ospath = require('path')
+const { after, test } = require('node:test')
+
+const SizeIndex = require('../src/services/size-index')
+
+const roots = []
+after(() => roots.forEach(root => fs.rmSync(root, { recursive: true })))
+
+// creates a temporary tree from { 'dir/file': size } and returns its root
+const makeTree = files => {
+  const root = fs.mkdtempSync(ospath.join(os.tmpdir(), 'size-index-'))
+  roots.push(root)
+  for (const [path, size] of Object.entries(files)) {
+    writeFile(ospath.join(root, path), size)
+  }
+  return root
+}
+
+const writeFile = (path, size) => {
+  fs.mkdirSync(ospath.dirname(path), { recursive: true })
+  fs.writeFileSync(path, Buffer.alloc(size))
+}
+
+// total size of files under dir, read from disk
+const diskSize = dir => {
+  if (!fs.existsSync(dir)) return 0
+  let size = 0
+  for (const entry of fs.readdirSync(dir, { withFileTypes: true })) {
+    const path = ospath.join(dir, entry.name)
+    size += entry.isDirectory() ? diskSize(path) : fs.statSync(path).size
+  }
+  return size
+}
+
+const assertSizes = (root, dirs) => {
+  for (const dir of dirs) {
+    const path = ospath.join(root, dir)
+    assert.strictEqual(SizeIndex.getSize(path), diskSize(path), dir || 'root')
+  }
+}
+
+const TREE = { 'a/x': 10, 'a/b/y': 20, 'a/b/.locked': 3, 'c/z': 40 }
+
+test('indexes folders on first access', () => {
+  const root = makeTree(TREE)
+  assert.strictEqual(SizeIndex.getSize(root), 73)
+  assert.strictEqual(SizeIndex.getSize(ospath.join(root, 'a/b')), 23)
+  assert.strictEqual(SizeIndex.getSize(ospath.join(root, 'missing')), 0)
+})
+
+test('adds and overwrites files', () => {
+  const root = makeTree(TREE)
+  SizeIndex.getSize(root)
+
+  const path = ospath.join(root, 'a/b/new')
+  writeFile(path, 100)
+  SizeIndex.addFile(path)
+  assertSizes(root, ['', 'a', 'a/b', 'c'])
+
+  writeFile(path, 30)
+  SizeIndex.addFile(path, 100)
+  assertSizes(root, ['', 'a', 'a/b'])
+})
+
+test('removes files and folders', () => {
+  const root = makeTree(TREE)
+  SizeIndex.getSize(root)
+
+  const file = ospath.join(root, 'a/x')
+  SizeIndex.remove(file)
+  fs.rmSync(file)
+  assertSizes(root, ['', 'a', 'a/b'])
+
+  const folder = ospath.join(root, 'a/b')
+  SizeIndex.remove(folder)
+  fs.rmSync(folder, { recursive: true })
+  assertSizes(root, ['', 'a', 'a/b', 'c'])
+})
+
+test('moves folders', () => {
+  const root = makeTree(TREE)
+  SizeIndex.getSize(root)
+
+  const oldPath = ospath.join(root, 'a/b')
+  const newPath = ospath.join(root, 'c/b')
+  fs.renameSync(oldPath, newPath)
+  SizeIndex.move(oldPath, newPath)
+  assertSizes(root, ['', 'a', 'a/b', 'c', 'c/b'])
+})
+
+test('refreshes folders rewritten in place', () => {
+  const root = makeTree(TREE)
+  SizeIndex.getSize(root)
+
+  writeFile(ospath.join(root, 'a/x'), 16)
+  writeFile(ospath.join(root, 'a/b/y'), 36)
+  SizeIndex.refresh(ospath.join(root, 'a'))
+  assertSizes(root, ['', 'a', 'a/b', 'c'])
+})
+
+test('reconcile corrects changes made outside the index', async () => {
+  const root = makeTree(TREE)
+  SizeIndex.getSize(root)
+
+  writeFile(ospath.join(root, 'c/d/w'), 50)
+  fs.rmSync(ospath.join(root, 'a/x'))
+  assert.notStrictEqual(SizeIndex.getSize(root), diskSize(root))
+
+  await SizeIndex.reconcile(root)
+  assertSizes(root, ['', 'a', 'c', 'c/d'])
+})
+
+test('reconcile keeps changes made while it runs', async () => {
+  const root = makeTree(TREE)
+  SizeIndex.getSize(root)
+
+  const reconcile = SizeIndex.reconcile(root)
+  const path = ospath.join(root, 'a/b/z')
+  writeFile(path, 5)
+  SizeIndex.addFile(path)
+  SizeIndex.remove(ospath.join(root, 'a/x'))
+  fs.rmSync(ospath.join(root, 'a/x'))
+  await reconcile
+
+  assertSizes(root, ['', 'a', 'a/b', 'c'])
+})
@@ -0,0 +1,91 @@
+"""Times saving 5 scenes of a 20,000 atom workspace with 2 complexes.
+
+Compares legacy decks, which store every scene in full, with version 2 decks,
+saved with and without complex hashes known. Also measures the longest event
+loop stall while a deck is built in the worker pool, as the Scene Viewer does.
+
+Run from the repository root: python tests/benchmark_deck.py
+"""
+import asyncio
+import io
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from nanome.util import Color
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from conftest import make_workspace  # noqa: E402
+from plugin.SceneViewer import build_deck  # noqa: E402
+from plugin.WorkspaceSerializer import (  # noqa: E402
+    Scene, _write_using_serializer, complex_hash, scene_list_serializer, scenes_to_data, workspace_from_data, workspace_to_data)
+
+ATOM_COUNT = 20000
+SCENE_COUNT = 5
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+# scenes hold copies of the workspace, with different colors and selection, as captured in Nanome
+def make_scenes():
+    data = workspace_to_data(make_workspace(ATOM_COUNT, 2))
+    scenes = []
+    for k in range(SCENE_COUNT):
+        workspace = workspace_from_data(data)
+        for i, atom in enumerate(workspace.complexes[0].atoms):
+            atom.selected = i < 1000 * k
+            atom.atom_color = Color(50 * k, 0, 255 - 50 * k)
+        scenes.append(Scene(workspace, f'scene {k}'))
+    return scenes
+
+
+def save_legacy(scenes):
+    f = io.BytesIO()
+    _write_using_serializer(scene_list_serializer, scenes, f)
+    return f.getvalue()
+
+
+# returns seconds to build deck in executor, and longest gap between event loop ticks meanwhile
+async def save_in_executor(scenes, executor):
+    loop = asyncio.get_running_loop()
+    stall = 0
+    start = time.perf_counter()
+    future = loop.run_in_executor(executor, build_deck, scenes)
+    last = time.perf_counter()
+    while not future.done():
+        await asyncio.sleep(0.001)
+        now = time.perf_counter()
+        stall = max(stall, now - last)
+        last = now
+    (await future).close()
+    return time.perf_counter() - start, stall
+
+
+def main():
+    legacy, legacy_time = timed(save_legacy, make_scenes())
+    deck, deck_time = timed(scenes_to_data, make_scenes())
+    print(f'{SCENE_COUNT} scenes of {ATOM_COUNT} atoms in 2 complexes')
+    print(f'legacy: save {legacy_time:.2f}s, {len(legacy) / 1e6:.1f}MB')
+    print(f'version 2: save {deck_time:.2f}s, {len(deck) / 1e6:.1f}MB')
+
+    # scenes are hashed in the worker pool when staged for transitions, before most saves
+    scenes = make_scenes()
+    for scene in scenes:
+        for complex in scene.workspace.complexes:
+            complex_hash(complex)
+    _, hashed = timed(scenes_to_data, scenes)
+    print(f'version 2, complexes hashed when shown: save {hashed:.2f}s')
+
+    with ThreadPoolExecutor(1) as executor:
+        duration, stall = asyncio.run(save_in_executor(make_scenes(), executor))
+    print(f'version 2 in executor: save {duration:.2f}s, longest event loop stall {stall * 1000:.0f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""Times loading, cached loading and decimation of OBJ grid meshes at a few sizes.
+
+Run from the repository root: python tests/benchmark_obj.py
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from conftest import write_grid_obj  # noqa: E402
+from plugin.MeshCache import MeshCache  # noqa: E402
+from plugin.MeshDecimator import decimate  # noqa: E402
+from plugin.OBJParser import parse_obj  # noqa: E402
+
+GRID_SIZES = [100, 300, 700]
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def main(directory):
+    cache = MeshCache(os.path.join(directory, 'cache'))
+    for n in GRID_SIZES:
+        path = write_grid_obj(os.path.join(directory, f'grid{n}.obj'), n)
+        data, parse = timed(parse_obj, path)
+        unwelded, parse_unwelded = timed(parse_obj, path, False)
+        cache.parse(path)
+        _, cached = timed(cache.parse, path)
+        # a quarter of the triangles
+        result, decimation = timed(decimate, data, len(data.triangles) // 12)
+        print(
+            f'{2 * n * n} triangles: parse {parse:.3f}s to {len(data.vertices)} vertices, '
+            f'unwelded {parse_unwelded:.3f}s to {len(unwelded.vertices)} vertices, cached {cached:.4f}s, '
+            f'decimate {decimation:.3f}s to {len(result.triangles) // 3} triangles')
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as directory:
+        main(directory)
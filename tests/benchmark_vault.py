@@ -0,0 +1,51 @@
+"""Times 1,000 sequential folder listings against a local stand-in vault-server.
+
+Compares a new connection per request, as made by requests.get, with the pooled
+session used by VaultManager, for new folders and for revalidated listings.
+
+Run from the repository root: python tests/benchmark_vault.py
+"""
+import os
+import statistics
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from conftest import StandInServer  # noqa: E402
+from plugin.VaultManager import TIMEOUT, VaultManager  # noqa: E402
+
+CALLS = 1000
+
+
+def measure(name, server, call):
+    connections = server.connections
+    durations = []
+    for i in range(CALLS):
+        start = time.perf_counter()
+        call(i)
+        durations.append(time.perf_counter() - start)
+
+    durations.sort()
+    mean = statistics.mean(durations) * 1000
+    p50 = durations[len(durations) // 2] * 1000
+    p99 = durations[int(len(durations) * 0.99)] * 1000
+    print(
+        f'{name}: {sum(durations):.2f}s total, mean {mean:.2f}ms, p50 {p50:.2f}ms, p99 {p99:.2f}ms, '
+        f'{server.connections - connections} connections')
+
+
+def main():
+    with StandInServer() as server:
+        manager = VaultManager(None, server.url, cache_dir=None)
+        measure(
+            'new connection per call', server,
+            lambda i: requests.get(f'{server.url}/files/folder {i}', timeout=TIMEOUT).json())
+        measure('pooled session', server, lambda i: manager.list_path(f'folder {i}'))
+        measure('pooled session, revalidated', server, lambda i: manager.list_path('folder'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote
+
+import numpy as np
+import pytest
+from nanome.api.structure import Atom, Bond, Chain, Complex, Molecule, Residue, Workspace
+
+
+# writes an OBJ of a n x n grid of quads, with corners of format 'v', 'vt', 'vn' or 'vtn'
+def write_grid_obj(path, n, fmt='vtn', quads=True, colors=False, negative=False):
+    u, v = np.meshgrid(np.linspace(0, 1, n + 1), np.linspace(0, 1, n + 1))
+    x, y, z = u.ravel(), v.ravel(), np.sin(u.ravel() * 6) * 0.2
+    count = len(x)
+
+    def corner(i):
+        i = i + 1 - (count + 1 if negative else 0)
+        return {'v': f'{i}', 'vt': f'{i}/{i}', 'vn': f'{i}//{i}', 'vtn': f'{i}/{i}/{i}'}[fmt]
+
+    lines = []
+    for i in range(count):
+        lines.append(f'v {x[i]:.5f} {y[i]:.5f} {z[i]:.5f}' + (' 0.5 0.2 0.1' if colors else ''))
+    if 't' in fmt:
+        lines.extend(f'vt {x[i]:.5f} {y[i]:.5f}' for i in range(count))
+    if 'n' in fmt:
+        lines.extend('vn 0 0 1' for _ in range(count))
+    for row in range(n):
+        for column in range(n):
+            a = row * (n + 1) + column
+            b, d = a + 1, a + n + 1
+            e = d + 1
+            if quads:
+                lines.append(f'f {corner(a)} {corner(b)} {corner(e)} {corner(d)}')
+            else:
+                lines.append(f'f {corner(a)} {corner(b)} {corner(e)}')
+                lines.append(f'f {corner(a)} {corner(e)} {corner(d)}')
+
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return str(path)
+
+
+# returns a workspace of complexes with chains of bonded carbon atoms, 10 per residue
+def make_workspace(atom_count, complex_count=1):
+    workspace = Workspace()
+    for c in range(complex_count):
+        complex = Complex()
+        complex.name = f'complex {c}'
+        molecule = Molecule()
+        chain = Chain()
+        chain.name = 'A'
+        complex.add_molecule(molecule)
+        molecule.add_chain(chain)
+        for i in range(atom_count // complex_count):
+            if i % 10 == 0:
+                residue = Residue()
+                residue.name = 'ALA'
+                residue.serial = i // 10
+                chain.add_residue(residue)
+                previous = None
+            atom = Atom()
+            atom.symbol = 'C'
+            atom.name = f'C{i % 10}'
+            atom.serial = i
+            atom.position.x, atom.position.y, atom.position.z = i * 0.1, i * 0.2, c
+            residue.add_atom(atom)
+            if previous is not None:
+                bond = Bond()
+                bond.atom1 = previous
+                bond.atom2 = atom
+                residue.add_bond(bond)
+            previous = atom
+        workspace.add_complex(complex)
+    return workspace
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # send each response in one write, small writes wait on delayed acks
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
+    # called once per connection
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, value, headers=None):
+        body = json.dumps(value).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    # returns True if the request should fail, from the server's remaining failures for path
+    def should_fail(self, path):
+        with self.server.lock:
+            self.server.requests.append((self.command, path, dict(self.headers)))
+            failures = self.server.failures.get(path, 0)
+            if failures:
+                self.server.failures[path] = failures - 1
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        return failures > 0
+
+    def do_GET(self):
+        path = unquote(self.path)
+        if self.should_fail(path):
+            return self.send_json(503, {'success': False})
+
+        if path == '/info':
+            return self.send_json(200, {'success': True, 'extensions': {'supported': ['pdb']}})
+
+        folder = path[len('/files/'):]
+        etag = f'"{folder}"' if self.server.etags else None
+        if etag and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.send_header('ETag', etag)
+            return self.end_headers()
+
+        listing = {
+            'success': True,
+            'locked': [],
+            'folders': [{'name': f'folder {i}', 'size': '1 KB'} for i in range(5)],
+            'files': [{'name': f'file {i}.pdb', 'size': '10 KB'} for i in range(20)],
+        }
+        self.send_json(200, listing, {'ETag': etag} if etag else None)
+
+    def do_POST(self):
+        path = unquote(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        fields = {}
+        if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+            fields = {key: values[0] for key, values in parse_qs(body.decode('utf-8')).items()}
+        with self.server.lock:
+            self.server.posts.append((path, fields, dict(self.headers)))
+        if self.should_fail(path):
+            return self.send_json(503, {'success': False})
+        self.send_json(200, self.server.respond(path, fields, self.headers))
+
+
+class StandInServer(ThreadingHTTPServer):
+    """Local stand-in for vault-server, answers folder listings and commands.
+
+    Records requests and connections, and can fail or delay requests.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        # (method, path, headers) of each request
+        self.requests = []
+        # (path, form fields, headers) of each POST
+        self.posts = []
+        # path -> number of requests answered with 503 before succeeding
+        self.failures = {}
+        # seconds to wait before each response
+        self.delay = 0
+        # whether GET responses have ETags, for conditional requests
+        self.etags = True
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return f'http://{host}:{port}'
+
+    # response to a command, override to answer specific commands
+    def respond(self, path, fields, headers):
+        return {'success': True}
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+@pytest.fixture
+def server():
+    with StandInServer() as server:
+        yield server
+
+
+@pytest.fixture
+def grid_obj(tmp_path):
+    return lambda n, **kwargs: write_grid_obj(tmp_path / 'grid.obj', n, **kwargs)
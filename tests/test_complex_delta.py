@@ -0,0 +1,107 @@
+import pytest
+from nanome.util import Color, Vector3, enums
+
+from conftest import make_workspace
+from plugin.ComplexDelta import (
+    COLOR_ATTRIBUTES, FIELDS, apply_delta, apply_state, canonical_state, copy_state, diff_state, extract_delta)
+from plugin.WorkspaceSerializer import copy_complex
+
+
+def make_complex():
+    complex = make_workspace(200).complexes[0]
+    for i, atom in enumerate(complex.atoms):
+        atom.index = 1000 + i
+    return complex
+
+
+def edit_state(complex):
+    complex.position = Vector3(1, 2, 3)
+    atoms = list(complex.atoms)
+    for atom in atoms[:50]:
+        atom.selected = True
+        atom.atom_color = Color(255, 0, 0)
+    atoms[100].atom_mode = enums.AtomRenderingMode.VanDerWaals
+    list(complex.residues)[1].ribbon_color = Color(1, 2, 3)
+
+
+def test_delta_round_trip():
+    complex = make_complex()
+    edit_state(complex)
+    delta = extract_delta(complex)
+
+    other = make_complex()
+    apply_delta(other, delta)
+    assert extract_delta(other) == delta
+    assert not diff_state(complex, other)
+
+
+def test_delta_is_compact():
+    delta = extract_delta(make_complex())
+    # evenly spaced indices are stored as a range, canonical columns are omitted
+    assert delta['atom._index'] == {'start': 1000, 'step': 1}
+    assert 'atom._selected' not in delta
+
+    complex = make_complex()
+    for atom in complex.atoms:
+        atom.atom_color = Color(1, 2, 3)
+    assert extract_delta(complex)['atom._atom_color'] == [Color(1, 2, 3)._color]
+
+
+def test_empty_delta_sets_canonical_state():
+    complex = make_complex()
+    edit_state(complex)
+    apply_delta(complex, {})
+    assert extract_delta(complex) == {}
+
+
+def test_canonical_state():
+    complex = make_complex()
+    edit_state(complex)
+    apply_delta(complex, {})
+    for level, structure in [('complex', complex), ('residue', next(complex.residues)), ('atom', next(complex.atoms))]:
+        state = canonical_state(level)
+        for attr, _, (encode, _) in FIELDS[level]:
+            assert encode(state[attr]) == encode(getattr(structure, attr))
+
+
+def test_delta_must_match_complex():
+    delta = extract_delta(make_complex())
+    delta['atom._selected'] = [True, False]
+    with pytest.raises(ValueError):
+        apply_delta(make_complex(), delta)
+
+
+def test_copy_state():
+    source = make_complex()
+    edit_state(source)
+    target = copy_complex(make_complex())
+    for atom in target.atoms:
+        atom.index = -1
+
+    changed = copy_state(source, target)
+    # only structures whose state differ are changed
+    assert len(changed) == 1 + 51 + 1
+    assert not diff_state(source, target)
+    # indices are not copied
+    assert all(atom.index == -1 for atom in target.atoms)
+
+
+def test_diff_state_levels():
+    source = make_complex()
+    edit_state(source)
+    target = make_complex()
+
+    diff = diff_state(source, target, ('atom',))
+    assert len(diff) == 50 + 1
+    apply_state(diff)
+    assert diff_state(source, target, ('atom',)) == []
+    assert diff_state(source, target, ('complex',))
+
+
+def test_diff_state_requires_same_structure():
+    with pytest.raises(ValueError):
+        diff_state(make_complex(), make_workspace(100).complexes[0])
+
+
+def test_color_attributes():
+    assert COLOR_ATTRIBUTES == {'_atom_color', '_ribbon_color', '_surface_color'}
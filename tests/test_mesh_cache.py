@@ -0,0 +1,51 @@
+from dataclasses import fields
+
+import numpy as np
+
+from plugin.MeshCache import MeshCache, read_mesh, write_mesh
+from plugin.OBJParser import MeshData, parse_obj
+
+
+def assert_same_mesh(a, b):
+    for field in fields(MeshData):
+        np.testing.assert_array_equal(getattr(a, field.name), getattr(b, field.name))
+
+
+def test_write_read_round_trip(grid_obj, tmp_path):
+    data = parse_obj(grid_obj(8, fmt='vn'))
+    path = str(tmp_path / 'grid.mesh')
+    write_mesh(data, path)
+    assert_same_mesh(read_mesh(path), data)
+
+
+def test_parses_once_per_content(grid_obj, tmp_path):
+    cache = MeshCache(str(tmp_path / 'cache'))
+    calls = []
+
+    def parse(path, weld):
+        calls.append(weld)
+        return parse_obj(path, weld)
+
+    path = grid_obj(8)
+    first = cache.parse(path, parse=parse)
+    assert_same_mesh(cache.parse(path, parse=parse), first)
+    assert calls == [True]
+    assert (cache.cache.hits, cache.cache.misses) == (1, 1)
+
+    # weld option is part of the key
+    cache.parse(path, weld=False, parse=parse)
+    assert calls == [True, False]
+
+    # so is the file content
+    path = grid_obj(9)
+    assert len(cache.parse(path, parse=parse).triangles) == 9 * 9 * 6
+    assert calls == [True, False, True]
+
+
+def test_cached_arrays_are_memory_mapped(grid_obj, tmp_path):
+    cache = MeshCache(str(tmp_path / 'cache'))
+    path = grid_obj(8)
+    cache.parse(path)
+    data = cache.parse(path)
+    assert isinstance(data.vertices, np.memmap)
+    assert not data.vertices.flags.writeable
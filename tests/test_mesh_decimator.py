@@ -0,0 +1,65 @@
+import numpy as np
+
+from plugin.MeshDecimator import decimate
+from plugin.OBJParser import parse_obj
+
+
+def test_within_budget_unchanged(grid_obj):
+    data = parse_obj(grid_obj(4))
+    assert decimate(data, 1000) is data
+
+
+def test_decimates_to_budget(grid_obj):
+    data = parse_obj(grid_obj(60))
+    result = decimate(data, 500)
+    count = len(result.triangles) // 3
+    assert 0 < count <= 500
+    assert result.triangles.max() < len(result.vertices)
+    np.testing.assert_allclose(result.vertices.min(0), data.vertices.min(0), atol=0.05)
+    np.testing.assert_allclose(result.vertices.max(0), data.vertices.max(0), atol=0.05)
+
+
+def test_tiny_budget_keeps_triangles(grid_obj):
+    data = parse_obj(grid_obj(30))
+    for budget in (1, 2):
+        assert len(decimate(data, budget).triangles) > 0
+
+
+def test_texture_seams_are_kept(tmp_path):
+    # grid over x in [0, 2] with a texture seam at x = 1, left half uses u in [0, 0.4]
+    # and right half u in [0.6, 1], vertices on the seam have one uv for each side
+    n = 20
+    lines = []
+    for j in range(n + 1):
+        lines.extend(f'v {2 * i / n} {j / n} 0' for i in range(n + 1))
+    for j in range(n + 1):
+        lines.extend(f'vt {0.8 * i / n if i <= n // 2 else 0.2 + 0.8 * i / n} {j / n}' for i in range(n + 1))
+        lines.append(f'vt 0.6 {j / n}')
+    for j in range(n):
+        for i in range(n):
+            corners = [(i, j), (i + 1, j), (i + 1, j + 1), (i, j + 1)]
+            lines.append('f ' + ' '.join(
+                f'{y * (n + 1) + x + 1}/{(y + 1) * (n + 2) if x == n // 2 and i == n // 2 else y * (n + 2) + x + 1}'
+                for x, y in corners))
+    path = tmp_path / 'seam.obj'
+    path.write_text('\n'.join(lines) + '\n')
+
+    data = parse_obj(str(path))
+    result = decimate(data, len(data.triangles) // 12)
+
+    # merging vertices across the seam would average their uvs into the gap
+    u = result.uvs[:, 0]
+    assert not np.any((u > 0.41) & (u < 0.59))
+
+
+def test_degenerate_mesh_unchanged(tmp_path):
+    # triangles whose corners share a position have no area at any resolution
+    lines = []
+    for i in range(50):
+        lines.extend([f'v {i} {i % 7} 0'] * 3)
+        lines.append(f'f {3 * i + 1} {3 * i + 2} {3 * i + 3}')
+    path = tmp_path / 'degenerate.obj'
+    path.write_text('\n'.join(lines) + '\n')
+
+    data = parse_obj(str(path))
+    assert decimate(data, 10) is data
@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+
+import plugin.OBJParser as OBJParser
+from plugin.OBJParser import parse_mtl, parse_obj, split_materials
+
+FORMATS = [
+    dict(fmt='vtn'),
+    dict(fmt='vn'),
+    dict(fmt='vt'),
+    dict(fmt='v', colors=True),
+    dict(fmt='vtn', quads=False, negative=True),
+]
+ATTRIBUTES = ['vertices', 'normals', 'uvs', 'colors']
+
+
+# attributes of each triangle corner, missing attributes are empty
+def corner_attributes(data):
+    return {
+        attr: getattr(data, attr)[data.triangles] if len(getattr(data, attr)) else getattr(data, attr)
+        for attr in ATTRIBUTES}
+
+
+@pytest.mark.parametrize('options', FORMATS)
+def test_welded_matches_unwelded(grid_obj, options):
+    path = grid_obj(12, **options)
+    unwelded = parse_obj(path, weld=False)
+    welded = parse_obj(path)
+
+    assert len(welded.vertices) < len(unwelded.vertices)
+    assert len(welded.triangles) == len(unwelded.triangles) == 12 * 12 * 6
+    expected = corner_attributes(unwelded)
+    for attr, values in corner_attributes(welded).items():
+        np.testing.assert_allclose(values, expected[attr])
+    np.testing.assert_array_equal(welded.min_bounds, unwelded.min_bounds)
+    np.testing.assert_array_equal(welded.max_bounds, unwelded.max_bounds)
+
+
+@pytest.mark.parametrize('options', FORMATS)
+@pytest.mark.parametrize('weld', [True, False])
+def test_small_blocks_match(grid_obj, monkeypatch, options, weld):
+    path = grid_obj(12, **options)
+    expected = parse_obj(path, weld)
+    # blocks end mid way through each kind of record
+    monkeypatch.setattr(OBJParser, 'BLOCK_SIZE', 100)
+    data = parse_obj(path, weld)
+
+    for attr in ATTRIBUTES + ['triangles', 'material_ids', 'min_bounds', 'max_bounds']:
+        np.testing.assert_array_equal(getattr(data, attr), getattr(expected, attr))
+
+
+def test_missing_attributes_are_empty(grid_obj):
+    data = parse_obj(grid_obj(3, fmt='v'))
+    assert data.vertices.shape == (16, 3)
+    assert len(data.normals) == len(data.uvs) == len(data.colors) == 0
+
+
+def test_materials(tmp_path):
+    path = tmp_path / 'materials.obj'
+    path.write_text(
+        'mtllib a.mtl\n'
+        'v 0 0 0\nv 1 0 0\nv 0 1 0\nv 1 1 0\n'
+        'f 1 2 3\n'
+        'usemtl red\n'
+        'f 2 4 3\n'
+        'usemtl blue\n'
+        'f 1 2 4\n')
+    data = parse_obj(str(path))
+    assert list(data.mtllibs) == ['a.mtl']
+    assert list(data.materials) == ['', 'red', 'blue']
+    assert list(data.material_ids) == [0, 1, 2]
+
+    parts = split_materials(data)
+    assert [len(part.triangles) for part in parts] == [3, 3, 3]
+    for part, triangle in zip(parts, data.triangles.reshape(-1, 3)):
+        np.testing.assert_array_equal(part.vertices[part.triangles], data.vertices[triangle])
+
+
+def test_parse_mtl(tmp_path):
+    path = tmp_path / 'a.mtl'
+    path.write_text(
+        'newmtl red\nKd 1 0 0\nd 0.5\n'
+        'newmtl skin\nmap_Kd -s 1 1 1 tex\\skin.png\n')
+    materials = parse_mtl(str(path))
+    assert materials['red'].color == (1.0, 0.0, 0.0)
+    assert materials['red'].opacity == 0.5
+    assert materials['skin'].texture == 'tex/skin.png'
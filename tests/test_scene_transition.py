@@ -0,0 +1,284 @@
+import asyncio
+import copy
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from nanome.api.interactions import Interaction
+from nanome.util import Color, enums
+
+from conftest import make_workspace
+from plugin.ComplexDelta import copy_state
+from plugin.SceneTransition import SceneTransition
+from plugin.SceneViewer import build_deck
+from plugin.WorkspaceSerializer import Scene, copy_complex, scenes_from_file, workspace_from_data, workspace_to_data
+
+
+class FakePlugin:
+    """Room workspace of a plugin, complexes added to it get new indices."""
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(2)
+        self.room = []
+        self.interactions = []
+        self.next_index = 1
+        self.reloads = 0
+        self.added = 0
+        self.removed = 0
+        self.updated = []
+
+    def assign_indices(self, complex):
+        structures = [complex, *complex.molecules, *complex.chains, *complex.residues, *complex.atoms, *complex.bonds]
+        for structure in structures:
+            structure.index = self.next_index
+            self.next_index += 1
+
+    async def request_complex_list(self):
+        return [copy.copy(complex) for complex in self.room]
+
+    async def request_complexes(self, indices):
+        return [next((c for c in self.room if c.index == index), None) for index in indices]
+
+    async def add_to_workspace(self, complexes):
+        added = [copy_complex(complex) for complex in complexes]
+        for complex in added:
+            self.assign_indices(complex)
+        self.room += added
+        self.added += len(added)
+        return added
+
+    async def remove_from_workspace(self, complexes):
+        indices = {complex.index for complex in complexes}
+        self.room = [complex for complex in self.room if complex.index not in indices]
+        self.removed += len(complexes)
+
+    async def update_workspace(self, workspace):
+        self.room = []
+        if workspace.complexes:
+            self.reloads += 1
+            await self.add_to_workspace(workspace.complexes)
+            self.added -= len(workspace.complexes)
+
+    def update_structures_shallow(self, structures):
+        self.updated.extend(structures)
+
+    # copy of a room complex, as received by complex updated callbacks
+    def request_update(self, complex):
+        update = copy_complex(complex)
+        update.index = complex.index
+        for updated, atom in zip(update.atoms, complex.atoms):
+            updated.index = atom.index
+        return update
+
+
+@pytest.fixture
+def plugin(monkeypatch):
+    plugin = FakePlugin()
+
+    async def get():
+        return list(plugin.interactions)
+
+    def destroy_multiple(interactions):
+        destroyed = {id(interaction) for interaction in interactions}
+        plugin.interactions = [i for i in plugin.interactions if id(i) not in destroyed]
+
+    async def upload_multiple(interactions):
+        plugin.interactions += interactions
+
+    monkeypatch.setattr(Interaction, 'get', staticmethod(get))
+    monkeypatch.setattr(Interaction, 'destroy_multiple', staticmethod(destroy_multiple))
+    monkeypatch.setattr(Interaction, 'upload_multiple', staticmethod(upload_multiple))
+    yield plugin
+    plugin.executor.shutdown()
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+# scenes of the same two complexes, with selection and an interaction that differ
+def make_scenes(count=3):
+    data = workspace_to_data(make_workspace(400, 2))
+    scenes = []
+    for k in range(count):
+        workspace = workspace_from_data(data)
+        atoms = list(workspace.complexes[0].atoms)
+        for i, atom in enumerate(atoms):
+            atom.index = 1000 + i
+            atom.selected = i < 10 * k
+        interaction = Interaction(enums.InteractionKind.HydrogenBond, [atoms[k].index], [atoms[k + 1].index])
+        scenes.append(Scene(workspace, f'scene {k}', '', [interaction]))
+    return scenes
+
+
+def selected(plugin):
+    return [sum(atom.selected for atom in complex.atoms) for complex in plugin.room]
+
+
+def interaction_atoms(plugin):
+    atoms = {atom.index: atom for complex in plugin.room for atom in complex.atoms}
+    return [
+        (atoms[i.atom1_idx_arr[0]].serial, atoms[i.atom2_idx_arr[0]].serial)
+        for i in plugin.interactions]
+
+
+def test_first_scene_reloads_workspace(plugin):
+    transition = SceneTransition(plugin)
+    scene = make_scenes(1)[0]
+    run(transition.apply(scene))
+    assert plugin.reloads == 1
+    assert len(plugin.room) == 2
+    assert [c for _, c in transition.loaded] == plugin.room
+    assert interaction_atoms(plugin) == [(0, 1)]
+
+
+def test_same_complexes_are_kept(plugin):
+    transition = SceneTransition(plugin)
+    scenes = make_scenes()
+
+    async def main():
+        for scene in scenes:
+            await transition.apply(scene)
+
+    run(main())
+    assert plugin.reloads == 1
+    assert plugin.added == plugin.removed == 0
+    assert selected(plugin) == [20, 0]
+    # only changed selection is sent
+    assert len(plugin.updated) == 10 + 10
+    assert interaction_atoms(plugin) == [(2, 3)]
+
+
+def test_staged_scene(plugin):
+    transition = SceneTransition(plugin)
+    scenes = make_scenes()
+
+    async def main():
+        await transition.apply(scenes[0])
+        transition.stage(scenes[1:])
+        staged, prestaged = await transition.take_staged(scenes[2])
+        assert prestaged
+        assert staged.matches == plugin.room
+
+        transition.stage(scenes[1:])
+        await transition.apply(scenes[2])
+
+    run(main())
+    assert plugin.added == plugin.removed == 0
+    assert selected(plugin) == [20, 0]
+
+
+def test_edited_complex_is_replaced(plugin):
+    transition = SceneTransition(plugin)
+    scenes = make_scenes()
+    list(scenes[1].workspace.complexes[1].atoms)[0].position.x += 5
+
+    async def main():
+        await transition.apply(scenes[0])
+        await transition.apply(scenes[1])
+
+    run(main())
+    assert plugin.reloads == 1
+    assert plugin.added == plugin.removed == 1
+    assert [atom.position.x for atom in plugin.room[1].atoms][0] == pytest.approx(5)
+    assert interaction_atoms(plugin) == [(1, 2)]
+
+
+def test_color_change_readds_complex(plugin):
+    transition = SceneTransition(plugin)
+    scenes = make_scenes()
+    for atom in scenes[1].workspace.complexes[1].atoms:
+        atom.atom_color = Color(1, 2, 3)
+
+    async def main():
+        await transition.apply(scenes[0])
+        await transition.apply(scenes[1])
+
+    run(main())
+    assert plugin.added == plugin.removed == 1
+    assert {atom.atom_color._color for atom in plugin.room[1].atoms} == {Color(1, 2, 3)._color}
+
+
+def test_complex_updates(plugin):
+    transition = SceneTransition(plugin)
+    scenes = make_scenes()
+
+    async def main():
+        await transition.apply(scenes[0])
+        await transition.apply(scenes[1])
+        generation = transition.generation
+
+        # updates with the state scenes loaded are echoes of the transitions
+        assert not await transition.on_complex_updated(plugin.request_update(plugin.room[0]))
+        late = plugin.request_update(plugin.room[0])
+        copy_state(scenes[0].workspace.complexes[0], late)
+        assert not await transition.on_complex_updated(late)
+        assert transition.generation == generation
+
+        # other changes are made by users
+        update = plugin.request_update(plugin.room[0])
+        list(update.atoms)[100].selected = True
+        assert await transition.on_complex_updated(update)
+        assert transition.generation > generation
+        assert transition.loaded[0][1] is update
+
+        # complexes that aren't loaded are unknown changes
+        unknown = plugin.request_update(plugin.room[0])
+        unknown.index = -5
+        assert await transition.on_complex_updated(unknown)
+
+    run(main())
+
+
+def test_edited_complex_invalidates_staged_scenes(plugin):
+    transition = SceneTransition(plugin)
+    scenes = make_scenes()
+
+    async def main():
+        await transition.apply(scenes[0])
+        transition.stage(scenes[1:])
+        update = plugin.request_update(plugin.room[1])
+        list(update.atoms)[0].position.x += 5
+        assert await transition.on_complex_updated(update)
+
+        # edited complex doesn't match scene complexes anymore
+        staged, prestaged = await transition.take_staged(scenes[1])
+        assert prestaged
+        assert staged.matches == [plugin.room[0], None]
+
+    run(main())
+
+
+def test_complexes_changed_outside_transitions_reload(plugin):
+    transition = SceneTransition(plugin)
+    scenes = make_scenes()
+
+    async def main():
+        await transition.apply(scenes[0])
+        await plugin.remove_from_workspace(plugin.room[:1])
+        await transition.apply(scenes[1])
+
+    run(main())
+    assert plugin.reloads == 2
+    assert len(plugin.room) == 2
+    assert selected(plugin) == [10, 0]
+
+
+def test_scenes_saved_while_staged(plugin):
+    transition = SceneTransition(plugin)
+    scenes = make_scenes()
+    expected = [[(atom.index, atom.selected) for atom in scene.workspace.complexes[0].atoms] for scene in scenes]
+
+    # decks are built and scenes hashed in the worker pool at once
+    async def save_while_staging():
+        loop = asyncio.get_event_loop()
+        transition.stage(scenes)
+        saves = [loop.run_in_executor(plugin.executor, build_deck, scenes) for _ in range(3)]
+        await asyncio.gather(*(staged for _, staged in transition.staged))
+        return await asyncio.gather(*saves)
+
+    for data in run(save_while_staging()):
+        data.seek(0)
+        saved = scenes_from_file(data)
+        data.close()
+        assert [sum(atom.selected for atom in scene.load().workspace.complexes[0].atoms) for scene in saved] == [0, 10, 20]
+    assert [[(atom.index, atom.selected) for atom in scene.workspace.complexes[0].atoms] for scene in scenes] == expected
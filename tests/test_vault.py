@@ -0,0 +1,77 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+import requests
+from nanome.util.enums import NotificationTypes
+
+from plugin.Vault import Vault
+
+
+class FakeVaultManager:
+    """Writes downloaded files, except those named in failures, which fail with their value."""
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.downloads = []
+        self.manager = SimpleNamespace(cache=None)
+
+    async def get_file(self, path, key, out_path, on_progress=None, checksum=None):
+        await asyncio.sleep(0.01)
+        self.downloads.append(path)
+        failure = self.failures.get(os.path.basename(path))
+        if isinstance(failure, Exception):
+            raise failure
+        if failure is False:
+            return False
+        with open(out_path, 'w') as f:
+            f.write(path)
+        return True
+
+
+def make_plugin(failures):
+    plugin = object.__new__(Vault)
+    plugin.vault = FakeVaultManager(failures)
+    plugin.menu = SimpleNamespace(path='folder', folder_key=None, items=None)
+    plugin.executor = ThreadPoolExecutor(2)
+    plugin.extensions = {'supported': ['pdb'], 'extras': []}
+    plugin.notifications = []
+    plugin.loaded = []
+    plugin.send_notification = lambda kind, message: plugin.notifications.append((kind, message))
+    plugin.send_files_to_load = lambda paths: plugin.loaded.extend((path, os.path.exists(path)) for path in paths)
+    return plugin
+
+
+def test_failed_downloads_are_skipped():
+    failures = {'b.pdb': requests.ConnectionError('connection lost'), 'c.pdb': False}
+    plugin = make_plugin(failures)
+    progress = []
+    asyncio.run(plugin.load_files(['a.pdb', 'b.pdb', 'c.pdb', 'd.pdb'], lambda *args: progress.append(args)))
+
+    assert [os.path.basename(path) for path, _ in plugin.loaded] == ['a.pdb', 'd.pdb']
+    assert all(exists for _, exists in plugin.loaded)
+    assert plugin.notifications == [
+        (NotificationTypes.error, '"b.pdb" failed to download'),
+        (NotificationTypes.error, '"c.pdb" failed to download')]
+    assert progress[-1] == (4, 4)
+    # temporary files are removed
+    assert not any(os.path.exists(path) for path, _ in plugin.loaded)
+
+
+def test_temporary_files_removed_on_error(monkeypatch):
+    plugin = make_plugin({})
+    paths = []
+
+    async def load_or_queue_file(name, file_path, item, out_queue):
+        paths.append(file_path)
+        raise RuntimeError('load failed')
+
+    plugin.load_or_queue_file = load_or_queue_file
+    with pytest.raises(RuntimeError):
+        asyncio.run(plugin.load_files(['a.pdb', 'b.pdb', 'c.pdb']))
+
+    # remaining downloads finished before their folder was removed
+    assert len(plugin.vault.downloads) == 3
+    assert not os.path.exists(os.path.dirname(paths[0]))
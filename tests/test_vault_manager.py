@@ -0,0 +1,125 @@
+import pytest
+import requests
+
+import plugin.VaultManager as VaultManager
+from plugin.ContentCache import ContentCache
+from plugin.VaultManager import RETRIES, RETRY_BACKOFF, RETRY_STATUSES, get_session
+
+
+def make_manager(server, **kwargs):
+    return VaultManager.VaultManager(None, server.url, cache_dir=None, **kwargs)
+
+
+def test_session_shared_per_config():
+    assert get_session() is get_session()
+    assert get_session(pool_size=4) is get_session(pool_size=4)
+    assert get_session(pool_size=4) is not get_session()
+    assert get_session(retries=0) is not get_session()
+
+
+def test_adapter_config(server):
+    adapter = get_session(pool_size=6).get_adapter(server.url)
+    assert adapter._pool_connections == adapter._pool_maxsize == 6
+
+    retry = adapter.max_retries
+    assert retry.total == RETRIES
+    assert retry.backoff_factor == RETRY_BACKOFF
+    assert set(retry.status_forcelist) == set(RETRY_STATUSES)
+    # responses are returned after the last retry instead of raising
+    assert not retry.raise_on_status
+    # POST is not retried on status or read errors, only when connecting fails
+    assert 'POST' not in retry.allowed_methods
+
+
+def test_connections_reused(server):
+    managers = [make_manager(server) for _ in range(3)]
+    assert len({id(manager.session) for manager in managers}) == 1
+
+    for i in range(30):
+        managers[i % 3].list_path(f'folder {i}')
+    managers[0].create_path('new folder')
+    assert len(server.requests) == 31
+    assert server.connections == 1
+
+
+def test_listing_revalidated(server):
+    manager = make_manager(server)
+    first = manager.list_path('folder')
+    second = manager.list_path('folder')
+    assert first == second
+    assert server.requests[1][2]['If-None-Match'] == '"folder"'
+
+    # callers get copies they can modify
+    second['files'].clear()
+    assert manager.list_path('folder') == first
+
+
+def test_retries_unavailable_server(server):
+    manager = make_manager(server)
+    server.failures['/files/folder'] = RETRIES
+    assert manager.list_path('folder')['success']
+    assert len(server.requests) == RETRIES + 1
+
+    # commands are not retried on error responses
+    server.failures['/files/folder'] = 1
+    assert manager.create_path('folder').status_code == 503
+
+
+def test_timeout(server):
+    server.delay = 0.5
+    manager = make_manager(server, retries=0, timeout=(1, 0.1))
+    # urllib3 wraps timeouts in a connection error once retries are used up
+    for call in [lambda: manager.list_path('folder'), lambda: manager.create_path('folder'), manager.get_extensions]:
+        with pytest.raises(requests.RequestException, match=r'read timeout=0\.1'):
+            call()
+
+    # per call timeouts override the manager's
+    assert manager.command('create', 'folder', timeout=(1, 5)).ok
+
+
+def test_add_file_path_in_file_name(server, monkeypatch):
+    def respond(path, fields, headers):
+        if fields.get('command') == 'upload-init':
+            return {'success': True, 'id': '0123456789abcdef'}
+        return {'success': True}
+
+    server.respond = respond
+    monkeypatch.setattr(VaultManager, 'UPLOAD_CHUNK_THRESHOLD', 10)
+    monkeypatch.setattr(VaultManager, 'UPLOAD_CHUNK_SIZE', 10)
+    manager = make_manager(server)
+
+    assert manager.add_file('folder', 'sub/dir/file.pdb', b'x' * 25).ok
+    init, *chunks = server.posts
+    assert init[0] == '/files/folder/sub/dir'
+    assert init[1]['name'] == 'file.pdb'
+    assert [post[0] for post in chunks] == ['/files/folder/sub/dir'] * 3
+    assert [post[2]['X-File-Name'] for post in chunks] == ['file.pdb'] * 3
+    assert [post[2]['Content-Range'] for post in chunks] == ['bytes 0-10/25', 'bytes 10-20/25', 'bytes 20-25/25']
+
+    server.posts.clear()
+    assert manager.add_file('folder', 'sub/file.pdb', b'x').ok
+    assert server.posts[0][0] == '/files/folder/sub'
+    assert manager.add_file('', 'sub/file.pdb', b'x').ok
+    assert server.posts[1][0] == '/files/sub'
+
+
+def test_file_cache_counters(server, tmp_path):
+    manager = make_manager(server)
+    manager.cache = ContentCache(str(tmp_path / 'cache'), 1024 ** 2)
+    out_path = str(tmp_path / 'file.pdb')
+
+    assert manager.get_file('folder/file.pdb', None, out_path)
+    assert manager.get_file('folder/file.pdb', None, out_path)
+    assert server.requests[1][2]['If-None-Match'] == '"folder/file.pdb"'
+    assert (manager.cache.hits, manager.cache.misses) == (1, 1)
+
+    # responses that can't be cached are misses too
+    server.etags = False
+    assert manager.get_file('folder/other.pdb', None, out_path)
+    assert manager.get_file('folder/other.pdb', None, out_path)
+    assert (manager.cache.hits, manager.cache.misses) == (1, 3)
+
+    # files from encrypted folders don't use the cache
+    assert manager.get_file('folder/file.pdb', 'key', out_path)
+    assert (manager.cache.hits, manager.cache.misses) == (1, 3)
+    assert str(manager.cache) == '1 hits, 3 misses (25% hit rate)'
@@ -0,0 +1,156 @@
+import hashlib
+import io
+
+from nanome.api.interactions import Interaction
+from nanome.api.structure import Workspace
+from nanome.util import Color, Vector3, enums
+
+from conftest import make_workspace
+from plugin import WorkspaceSerializer
+from plugin.ComplexDelta import apply_delta
+from plugin.WorkspaceSerializer import (
+    LazyScene, Scene, _serialize, _write_using_serializer, complex_hash, copy_complex, scene_list_serializer,
+    scenes_from_data, scenes_to_data, vault_workspace_serializer, workspace_from_data, workspace_to_data)
+
+
+# per scene state that decks must keep, for each complex and atom of scene
+def scene_state(scene):
+    state = [scene.name, scene.description]
+    workspace = scene.workspace
+    state.append((workspace.position.unpack(), workspace.scale.unpack()))
+    for complex in workspace.complexes:
+        state.append((complex.name, complex.position.unpack(), complex.rotation.w))
+        state.append([
+            (atom.name, atom.position.unpack(), atom.atom_color._color, atom.selected, atom.atom_mode)
+            for atom in complex.atoms])
+    state.append([(i.kind, tuple(i.atom1_idx_arr), tuple(i.atom2_idx_arr)) for i in scene.interactions])
+    return state
+
+
+# three scenes of the same complexes, with different colors, selection and positions
+def make_scenes():
+    data = workspace_to_data(make_workspace(600, 2))
+    scenes = []
+    for k in range(3):
+        workspace = workspace_from_data(data)
+        workspace.position = Vector3(k, 0, 0)
+        complex = workspace.complexes[0]
+        complex.position = Vector3(k, 2 * k, 0)
+        atoms = list(complex.atoms)
+        for i, atom in enumerate(atoms):
+            atom.index = 1000 + i
+            atom.selected = i < 100 * k
+            atom.atom_color = Color(50 * k, 0, 255 - 50 * k)
+        atoms[k].atom_mode = enums.AtomRenderingMode.VanDerWaals
+        if k == 2:
+            # content change, stored as a separate complex
+            atoms[0].position = Vector3(99, 99, 99)
+        interaction = Interaction(enums.InteractionKind.HydrogenBond, [atoms[0].index], [atoms[1].index])
+        scenes.append(Scene(workspace, f'scene {k}', f'description {k}', [interaction]))
+    return scenes
+
+
+def test_deck_round_trip():
+    scenes = make_scenes()
+    expected = [scene_state(scene) for scene in scenes]
+    data = scenes_to_data(scenes)
+    # saving doesn't change the scenes
+    assert [scene_state(scene) for scene in scenes] == expected
+
+    lazy = scenes_from_data(data)
+    assert all(isinstance(scene, LazyScene) for scene in lazy)
+    assert [(scene.name, scene.description) for scene in lazy] == [(scene.name, scene.description) for scene in scenes]
+    assert [scene_state(scene.load()) for scene in lazy] == expected
+
+    # complexes with equal content are stored once
+    assert len(lazy[0].deck.complexes) == 3
+    assert lazy[0].complexes[1] == lazy[1].complexes[1] == lazy[2].complexes[1]
+    assert lazy[0].complexes[0] != lazy[2].complexes[0]
+
+
+def test_deck_resave():
+    scenes = make_scenes()
+    expected = [scene_state(scene) for scene in scenes]
+    lazy = scenes_from_data(scenes_to_data(scenes))
+
+    # lazy scenes are copied without decoding, mixed with new scenes
+    lazy[1].name = 'renamed'
+    again = scenes_from_data(scenes_to_data([lazy[2], lazy[1], scenes[0]]))
+    assert [scene.name for scene in again] == ['scene 2', 'renamed', 'scene 0']
+    assert scene_state(again[0].load()) == expected[2]
+    assert scene_state(again[1].load())[1:] == expected[1][1:]
+    assert scene_state(again[2].load()) == expected[0]
+
+
+def test_loads_legacy_decks():
+    scenes = make_scenes()
+    f = io.BytesIO()
+    _write_using_serializer(scene_list_serializer, scenes, f)
+    loaded = scenes_from_data(f.getvalue())
+    assert [scene_state(scene) for scene in loaded] == [scene_state(scene) for scene in scenes]
+
+
+def test_empty_deck():
+    assert scenes_from_data(scenes_to_data([])) == []
+
+
+def test_loaded_scenes_are_cached():
+    lazy = scenes_from_data(scenes_to_data(make_scenes()))
+    assert lazy[0].load() is lazy[0].load()
+
+
+def test_complex_hash_ignores_scene_state():
+    scenes = make_scenes()
+    hashes = [[complex_hash(complex) for complex in scene.workspace.complexes] for scene in scenes]
+    assert hashes[0] == hashes[1]
+    assert hashes[2][1] == hashes[0][1]
+    assert hashes[2][0] != hashes[0][0]
+
+
+def test_complex_hash_does_not_change_complex():
+    scene = make_scenes()[1]
+    complex = scene.workspace.complexes[0]
+    complex.index = 7
+    expected = scene_state(scene)
+    complex_hash(complex)
+    assert scene_state(scene) == expected
+    assert complex.index == 7
+    assert [atom.index for atom in complex.atoms] == list(range(1000, 1300))
+
+
+# hash of complex in decks saved before complexes were serialized through a canonical view
+def copied_complex_hash(complex):
+    complex = copy_complex(complex)
+    apply_delta(complex, {})
+    for i, atom in enumerate(complex.atoms):
+        atom._unique_identifier = i
+    workspace = Workspace()
+    workspace.complexes = [complex]
+    return hashlib.sha256(_serialize(vault_workspace_serializer, workspace)).hexdigest()
+
+
+def test_complex_hash_matches_saved_decks():
+    scenes = make_scenes()
+    fresh = make_workspace(300).complexes[0]
+    fresh.position = Vector3(1, 2, 3)
+    for complex in scenes[1].workspace.complexes + scenes[2].workspace.complexes + [fresh]:
+        assert complex_hash(complex) == copied_complex_hash(complex)
+
+
+def test_save_serializes_complexes_once(monkeypatch):
+    calls = []
+    serialize_complex = WorkspaceSerializer._serialize_complex
+
+    def counted(complex):
+        calls.append(complex)
+        return serialize_complex(complex)
+
+    monkeypatch.setattr(WorkspaceSerializer, '_serialize_complex', counted)
+    scenes = make_scenes()
+    scenes_to_data(scenes)
+    # hashed once each, and written from the hashed data
+    assert len(calls) == 6
+    calls.clear()
+    scenes_to_data(scenes)
+    # hashes are kept, only new complexes of the deck are serialized again
+    assert len(calls) == 3